@@ -0,0 +1,51 @@
+'''
+Run the benchmark suite.
+
+    python -m benchmarks                              # run all scenarios
+    python -m benchmarks -k routing                   # run scenarios whose name contains `routing`
+    python -m benchmarks --save baseline.json         # store the results as a baseline
+    python -m benchmarks --baseline baseline.json     # fail if a scenario regressed more than --threshold percent
+'''
+import argparse
+import sys
+
+from . import scenarios  # noqa: F401, registers the scenarios
+from .harness import SCENARIOS, run_scenario, compare, load_results, save_results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='In-process BluePark benchmarks.')
+    parser.add_argument('-k', dest='keyword', default='', help='Only run scenarios whose name contains this.')
+    parser.add_argument('--iterations', type=int, default=10000)
+    parser.add_argument('--warmup', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=3, help='Run each scenario this many times, keep the best.')
+    parser.add_argument('--save', metavar='PATH', help='Write the results as JSON.')
+    parser.add_argument('--baseline', metavar='PATH', help='Compare the results with a saved baseline.')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='Allowed throughput regression compared to the baseline, in percent.')
+    args = parser.parse_args()
+
+    results = {}
+    print(f'{"scenario":<28}{"ops/sec":>12}{"p50 us":>10}{"p99 us":>10}')
+    for name in SCENARIOS:
+        if args.keyword not in name:
+            continue
+        result = run_scenario(name, iterations=args.iterations, warmup=args.warmup, repeat=args.repeat)
+        results[name] = result
+        print(f'{name:<28}{result["ops_per_sec"]:>12.0f}{result["p50_us"]:>10.1f}{result["p99_us"]:>10.1f}')
+
+    if args.save:
+        save_results(results, args.save)
+
+    if args.baseline:
+        regressions = compare(results, load_results(args.baseline), args.threshold)
+        if regressions:
+            print(f'\nRegressed more than {args.threshold}%:')
+            for regression in regressions:
+                print(f'  {regression}')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
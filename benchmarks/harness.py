@@ -0,0 +1,134 @@
+import asyncio
+import gc
+import inspect
+import json
+import time
+import typing
+
+# Factories of the benchmark scenarios by name. A factory sets up the scenario and returns a coroutine function
+# that runs a single operation.
+SCENARIOS: typing.MutableMapping[str, typing.Callable[[], typing.Callable[[], typing.Awaitable]]] = {}
+
+
+def scenario(name: str) -> typing.Callable:
+    '''A decorator that registers a scenario factory.'''
+
+    def wrapper(factory):
+        SCENARIOS[name] = factory
+        return factory
+
+    return wrapper
+
+
+def http_scope(method: str = 'GET', path: str = '/', headers: typing.Sequence[typing.Tuple[str, str]] = (),
+               query_string: bytes = b'') -> dict:
+    '''Return an ASGI HTTP connection scope.'''
+    return {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'query_string': query_string,
+        'root_path': '',
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+    }
+
+
+class ASGIClient:
+    '''
+    Call an ASGI application directly with synthetic receive and send callables, without any network.
+
+    Both ASGI 3 single callable and ASGI 2 double callable applications are supported.
+    '''
+
+    def __init__(self, app) -> None:
+        self.app = app
+        self.asgi3 = inspect.iscoroutinefunction(getattr(app, '__call__', None))
+
+    async def request(self, scope: dict, body: bytes = b'') -> typing.Tuple[int, list, bytes]:
+        '''Send a request and return the status, headers and body of the response.'''
+        request_message = {'type': 'http.request', 'body': body, 'more_body': False}
+        received = False
+        messages = []
+
+        async def receive() -> dict:
+            nonlocal received
+            if not received:
+                received = True
+                return request_message
+            return {'type': 'http.disconnect'}
+
+        async def send(message: dict) -> None:
+            messages.append(message)
+
+        if self.asgi3:
+            await self.app(scope, receive, send)
+        else:
+            await self.app(scope)(receive, send)
+
+        status = messages[0]['status']
+        headers = messages[0]['headers']
+        response_body = b''.join(message.get('body', b'') for message in messages[1:])
+        return status, headers, response_body
+
+
+def _percentile(sorted_values: typing.Sequence[int], percent: float) -> int:
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))
+    return sorted_values[index]
+
+
+async def _measure(operation: typing.Callable[[], typing.Awaitable], iterations: int, warmup: int) -> dict:
+    for _ in range(warmup):
+        await operation()
+
+    latencies = []
+    gc.collect()
+    start = time.perf_counter_ns()
+    for _ in range(iterations):
+        operation_start = time.perf_counter_ns()
+        await operation()
+        latencies.append(time.perf_counter_ns() - operation_start)
+    total = time.perf_counter_ns() - start
+
+    latencies.sort()
+    return {
+        'iterations': iterations,
+        'ops_per_sec': iterations / (total / 1e9),
+        'p50_us': _percentile(latencies, 50) / 1000,
+        'p99_us': _percentile(latencies, 99) / 1000,
+    }
+
+
+def run_scenario(name: str, iterations: int = 10000, warmup: int = 500, repeat: int = 3) -> dict:
+    '''Set up the scenario, measure it `repeat` times and return the fastest run to reduce noise.'''
+    operation = SCENARIOS[name]()
+    runs = [asyncio.run(_measure(operation, iterations, warmup)) for _ in range(repeat)]
+    return max(runs, key=lambda run: run['ops_per_sec'])
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> typing.List[str]:
+    '''
+    Return the scenarios whose throughput regressed by more than `threshold` percent compared to the baseline.
+    Scenarios missing from the baseline are ignored.
+    '''
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        baseline_ops = baseline[name]['ops_per_sec']
+        change = (result['ops_per_sec'] - baseline_ops) / baseline_ops * 100
+        if change < -threshold:
+            regressions.append(f'{name}: {change:.1f}% ({baseline_ops:.0f} -> {result["ops_per_sec"]:.0f} ops/sec)')
+    return regressions
+
+
+def load_results(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_results(results: dict, path: str) -> None:
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
@@ -0,0 +1,202 @@
+'''
+Replay a recorded request log against a BluePark app in-process or against a local server.
+
+    python -m benchmarks.replay requests.jsonl --app test:app
+    python -m benchmarks.replay requests.jsonl --url http://127.0.0.1:8000 --concurrency 64 --speed 2
+
+The log has a JSON object per line:
+
+    {"method": "GET", "path": "/api/v1/users/10/", "headers": {"cookie": "session=..."}, "body_size": 0,
+     "interarrival": 0.004}
+
+`interarrival` is the number of seconds since the previous request. Requests are sent on that schedule whether the
+previous ones have completed or not (open loop). When `--concurrency` requests are in flight, new requests wait for a
+slot and the wait is included in their latency, so a slow server is not hidden by a slow load generator.
+'''
+import argparse
+import asyncio
+import bisect
+import importlib
+import json
+import sys
+import time
+import typing
+from urllib.parse import urlsplit
+
+from .harness import ASGIClient, http_scope
+
+# Upper bounds of the latency histogram buckets in milliseconds
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class RecordedRequest(typing.NamedTuple):
+    method: str
+    path: str
+    headers: typing.List[typing.Tuple[str, str]]
+    body_size: int
+    interarrival: float
+
+
+def read_log(path: str) -> typing.List[RecordedRequest]:
+    requests = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            headers = record.get('headers', {})
+            if isinstance(headers, dict):
+                headers = list(headers.items())
+            requests.append(RecordedRequest(
+                method=record.get('method', 'GET').upper(),
+                path=record['path'],
+                headers=[(name, value) for name, value in headers],
+                body_size=record.get('body_size', 0),
+                interarrival=record.get('interarrival', 0.0),
+            ))
+    return requests
+
+
+class LatencyHistogram:
+    '''Bucketed latencies of a single route. Raw latencies are kept for percentiles.'''
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.latencies: typing.List[float] = []
+        self.errors = 0
+
+    def add(self, latency_ms: float, ok: bool) -> None:
+        self.counts[bisect.bisect_left(BUCKETS_MS, latency_ms)] += 1
+        self.latencies.append(latency_ms)
+        if not ok:
+            self.errors += 1
+
+    def percentile(self, percent: float) -> float:
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100))]
+
+    def format(self) -> str:
+        lines = []
+        total = len(self.latencies)
+        for i, count in enumerate(self.counts):
+            if not count:
+                continue
+            bound = f'<= {BUCKETS_MS[i]}ms' if i < len(BUCKETS_MS) else f'>  {BUCKETS_MS[-1]}ms'
+            lines.append(f'    {bound:>12} {count:>8} {"#" * max(1, int(count / total * 40))}')
+        return '\n'.join(lines)
+
+
+class InProcessTarget:
+    '''Send requests to the ASGI app directly. Requests are grouped by the name of the matched URL rule.'''
+
+    def __init__(self, app) -> None:
+        self.app = app
+        self.client = ASGIClient(app)
+
+    def route_key(self, request: RecordedRequest) -> str:
+        rule = self.app.router.get_rule_for_path(request.path.partition('?')[0])
+        return rule.rule_name if rule is not None else 'unmatched'
+
+    async def send(self, request: RecordedRequest) -> int:
+        path, _, query_string = request.path.partition('?')
+        scope = http_scope(request.method, path, request.headers, query_string.encode('latin-1'))
+        status, _, _ = await self.client.request(scope, b'x' * request.body_size)
+        return status
+
+
+class HTTPTarget:
+    '''Send requests to a server over HTTP/1.1, a connection per request. Requests are grouped by path.'''
+
+    def __init__(self, url: str) -> None:
+        url = urlsplit(url)
+        self.host = url.hostname
+        self.port = url.port or 80
+
+    def route_key(self, request: RecordedRequest) -> str:
+        return f'{request.method} {request.path.partition("?")[0]}'
+
+    async def send(self, request: RecordedRequest) -> int:
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        body = b'x' * request.body_size
+        headers = [(name, value) for name, value in request.headers
+                   if name.lower() not in ('host', 'content-length', 'connection')]
+        headers += [('host', f'{self.host}:{self.port}'), ('content-length', str(len(body))),
+                    ('connection', 'close')]
+        head = f'{request.method} {request.path} HTTP/1.1\r\n'
+        head += ''.join(f'{name}: {value}\r\n' for name, value in headers)
+        writer.write(head.encode('latin-1') + b'\r\n' + body)
+        await writer.drain()
+        status_line = await reader.readline()
+        # Read the rest of the response until the server closes the connection
+        await reader.read()
+        writer.close()
+        return int(status_line.split()[1])
+
+
+async def replay(requests: typing.Sequence[RecordedRequest], target, concurrency: int = 64,
+                 speed: float = 1.0) -> typing.Dict[str, LatencyHistogram]:
+    '''Replay the requests with their recorded inter-arrival times divided by `speed`.'''
+    histograms: typing.Dict[str, LatencyHistogram] = {}
+    slots = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_event_loop()
+
+    async def fire(request: RecordedRequest, scheduled: float) -> None:
+        async with slots:
+            try:
+                ok = (await target.send(request)) < 500
+            except Exception:
+                ok = False
+        latency_ms = (loop.time() - scheduled) * 1000
+        key = target.route_key(request)
+        if key not in histograms:
+            histograms[key] = LatencyHistogram()
+        histograms[key].add(latency_ms, ok)
+
+    tasks = []
+    scheduled = loop.time()
+    for request in requests:
+        scheduled += request.interarrival / speed
+        delay = scheduled - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(loop.create_task(fire(request, scheduled)))
+    await asyncio.gather(*tasks)
+    return histograms
+
+
+def print_report(histograms: typing.Dict[str, LatencyHistogram], elapsed: float) -> None:
+    total = sum(len(histogram.latencies) for histogram in histograms.values())
+    print(f'{total} requests in {elapsed:.2f}s, {total / elapsed:.0f} req/s\n')
+    for key, histogram in sorted(histograms.items(), key=lambda item: -len(item[1].latencies)):
+        print(f'{key}: {len(histogram.latencies)} requests, {histogram.errors} errors, '
+              f'p50 {histogram.percentile(50):.2f}ms p90 {histogram.percentile(90):.2f}ms '
+              f'p99 {histogram.percentile(99):.2f}ms max {max(histogram.latencies):.2f}ms')
+        print(histogram.format())
+
+
+def load_app(path: str):
+    '''Import `module:attribute`.'''
+    module_name, _, attribute = path.partition(':')
+    return getattr(importlib.import_module(module_name), attribute or 'app')
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.replay', description='Replay a request log.')
+    parser.add_argument('log', help='JSON lines request log.')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--app', help='BluePark app to call in-process, as module:attribute.')
+    target.add_argument('--url', help='Base URL of a local server.')
+    parser.add_argument('--concurrency', type=int, default=64, help='Maximum number of requests in flight.')
+    parser.add_argument('--speed', type=float, default=1.0, help='Replay speed multiplier.')
+    args = parser.parse_args()
+
+    requests = read_log(args.log)
+    target = InProcessTarget(load_app(args.app)) if args.app else HTTPTarget(args.url)
+    start = time.perf_counter()
+    histograms = asyncio.run(replay(requests, target, args.concurrency, args.speed))
+    print_report(histograms, time.perf_counter() - start)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
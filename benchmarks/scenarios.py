@@ -0,0 +1,417 @@
+import asyncio
+import functools
+import json
+from http.cookies import SimpleCookie
+
+from bluepark.app import BluePark
+from bluepark.batch import BatchDispatcher
+from bluepark.exceptions import HTTPException
+from bluepark.response import JSONResponse, TextResponse
+from bluepark.routing import Router
+from bluepark.session.backend import CookieSession, StoreSession
+from bluepark.session.middleware import session_middleware
+from bluepark.session.stores import MemorySessionStore
+from bluepark.utils.cache import async_cache, request_key
+from bluepark.utils.cookies import parse_cookie_header, set_cookie_header
+from bluepark.utils.signing import hmac_json_dumps, get_signer
+from .harness import ASGIClient, http_scope, scenario
+
+
+async def _text_view(request, **params):
+    return TextResponse('ok')
+
+
+def _routing(route_count: int):
+    app = BluePark()
+    router = Router(prefix='/api')
+    app.add_router(router)
+    for i in range(route_count):
+        router.add_rule(f'/resource{i}/<int:id>/', _text_view, rule_name=f'resource{i}')
+
+    client = ASGIClient(app)
+    # The last registered rule is the worst case for the router
+    scope = http_scope(path=f'/api/resource{route_count - 1}/42/')
+    return lambda: client.request(scope)
+
+
+@scenario('routing_10')
+def routing_10():
+    return _routing(10)
+
+
+@scenario('routing_100')
+def routing_100():
+    return _routing(100)
+
+
+@scenario('routing_1000')
+def routing_1000():
+    return _routing(1000)
+
+
+@scenario('routing_static_1000')
+def routing_static_1000():
+    app = BluePark()
+    router = Router(prefix='/api')
+    app.add_router(router)
+    for i in range(1000):
+        router.add_rule(f'/resource{i}/', _text_view, rule_name=f'resource{i}')
+
+    client = ASGIClient(app)
+    scope = http_scope(path='/api/resource999/')
+    return lambda: client.request(scope)
+
+
+async def _pass_through(request, nxt):
+    return await nxt()
+
+
+def _middleware_depth(depth: int):
+    app = BluePark()
+    for _ in range(depth):
+        app.add_http_middleware(_pass_through)
+    app.router.add_rule('/', _text_view)
+    client = ASGIClient(app)
+    scope = http_scope(path='/')
+    return lambda: client.request(scope)
+
+
+@scenario('middleware_0')
+def middleware_0():
+    return _middleware_depth(0)
+
+
+@scenario('middleware_5')
+def middleware_5():
+    return _middleware_depth(5)
+
+
+@scenario('middleware_20')
+def middleware_20():
+    return _middleware_depth(20)
+
+
+@scenario('sync_view')
+def sync_view():
+    '''A sync view, called in the default thread pool.'''
+    app = BluePark()
+
+    @app.router.route('/')
+    def view(request):
+        return TextResponse('ok')
+
+    client = ASGIClient(app)
+    scope = http_scope(path='/')
+    return lambda: client.request(scope)
+
+
+@scenario('request_headers_cookies')
+def request_headers_cookies():
+    '''A request with 40 headers and 20 cookies, the view reads a header and a cookie.'''
+    app = BluePark()
+
+    @app.router.route('/')
+    async def view(request):
+        return TextResponse(request.headers['x-header-39'] + request.cookies['cookie19'])
+
+    headers = [(f'x-header-{i}', f'value-{i}') for i in range(40)]
+    headers.append(('cookie', '; '.join(f'cookie{i}=value{i}' for i in range(20))))
+    client = ASGIClient(app)
+    scope = http_scope(path='/', headers=headers)
+    return lambda: client.request(scope)
+
+
+def _cookie_header(count: int) -> str:
+    return '; '.join(f'cookie{i}=value-{i:04d}-abcdefghijklmnopqrstuvwxyz' for i in range(count))
+
+
+def _parse_cookies(count: int):
+    header = _cookie_header(count)
+
+    async def operation():
+        parse_cookie_header(header)
+
+    return operation
+
+
+def _parse_cookies_simplecookie(count: int):
+    '''The parser that was used before `parse_cookie_header`.'''
+    header = _cookie_header(count)
+
+    async def operation():
+        cookie = SimpleCookie()
+        cookie.load(header)
+        {key: morsel.value for key, morsel in cookie.items()}
+
+    return operation
+
+
+def _set_cookies(count: int):
+    async def operation():
+        for i in range(count):
+            set_cookie_header(f'cookie{i}', 'value', max_age=3600, path='/', http_only=True, same_site='Lax')
+
+    return operation
+
+
+def _set_cookies_simplecookie(count: int):
+    '''The serializer that was used before `set_cookie_header`.'''
+    async def operation():
+        for i in range(count):
+            cookie = SimpleCookie()
+            key = f'cookie{i}'
+            cookie[key] = 'value'
+            cookie[key]['path'] = '/'
+            cookie[key]['max-age'] = 3600
+            cookie[key]['httponly'] = True
+            (cookie.output(header='').strip() + '; SameSite=Lax').encode('latin-1')
+
+    return operation
+
+
+for _count in (1, 20, 100):
+    scenario(f'parse_cookies_{_count}')(functools.partial(_parse_cookies, _count))
+    scenario(f'parse_cookies_simplecookie_{_count}')(functools.partial(_parse_cookies_simplecookie, _count))
+    scenario(f'set_cookies_{_count}')(functools.partial(_set_cookies, _count))
+    scenario(f'set_cookies_simplecookie_{_count}')(functools.partial(_set_cookies_simplecookie, _count))
+
+
+_DOCUMENT = {
+    'items': [{'id': i, 'name': f'item {i}', 'price': i * 1.5, 'tags': ['a', 'b', 'c'], 'active': i % 2 == 0}
+              for i in range(50)],
+    'total': 50,
+}
+
+
+@scenario('json_encode')
+def json_encode():
+    app = BluePark()
+
+    @app.router.route('/')
+    async def view(request):
+        return JSONResponse(_DOCUMENT)
+
+    client = ASGIClient(app)
+    scope = http_scope(path='/')
+    return lambda: client.request(scope)
+
+
+@scenario('json_frozen')
+def json_frozen():
+    '''Serve the JSON document of `json_encode` from a frozen response, rendered once.'''
+    app = BluePark()
+    response = JSONResponse(_DOCUMENT).freeze()
+
+    @app.router.route('/')
+    async def view(request):
+        return response
+
+    client = ASGIClient(app)
+    scope = http_scope(path='/')
+    return lambda: client.request(scope)
+
+
+@scenario('json_decode')
+def json_decode():
+    app = BluePark()
+
+    @app.router.route('/', methods=['POST'])
+    async def view(request):
+        document = await request.body_as_json()
+        return TextResponse(str(document['total']))
+
+    body = json.dumps(_DOCUMENT).encode()
+    client = ASGIClient(app)
+    scope = http_scope(method='POST', path='/', headers=[('content-type', 'application/json')])
+    return lambda: client.request(scope, body)
+
+
+@scenario('ndjson_ingest_1000')
+def ndjson_ingest_1000():
+    '''Read a body of 1000 newline delimited JSON records in batches of 100.'''
+    app = BluePark()
+
+    @app.router.route('/', methods=['POST'])
+    async def view(request):
+        count = 0
+        async for batch in request.iter_ndjson(batch_size=100):
+            count += len(batch)
+        return TextResponse(str(count))
+
+    body = b''.join(json.dumps(item).encode() + b'\n' for item in _DOCUMENT['items'] * 20)
+    client = ASGIClient(app)
+    scope = http_scope(method='POST', path='/', headers=[('content-type', 'application/x-ndjson')])
+    return lambda: client.request(scope, body)
+
+
+@scenario('cached_json_view')
+def cached_json_view():
+    '''Serve the JSON document from the response cache of the view.'''
+    app = BluePark()
+
+    @async_cache(ttl=3600, key=request_key)
+    async def view(request):
+        return JSONResponse(_DOCUMENT)
+
+    app.router.add_rule('/', view)
+    client = ASGIClient(app)
+    scope = http_scope(path='/')
+    return lambda: client.request(scope)
+
+
+@scenario('batch_10')
+def batch_10():
+    '''A batch of 10 GET requests to a JSON view, dispatched in-process and streamed as JSON lines.'''
+    app = BluePark()
+    app.router.add_rule('/batch/', BatchDispatcher().view, methods=['POST'])
+
+    @app.router.route('/items/<int:id>/')
+    async def item(request, id):
+        return JSONResponse({'id': id, 'name': f'item {id}'})
+
+    body = json.dumps([{'path': f'/items/{i}/'} for i in range(10)]).encode()
+    client = ASGIClient(app)
+    scope = http_scope(method='POST', path='/batch/', headers=[('content-type', 'application/json')])
+    return lambda: client.request(scope, body)
+
+
+def _session(view):
+    app = BluePark()
+    app.add_http_middleware(session_middleware(backend=CookieSession))
+    app.router.add_rule('/', view)
+
+    cookie = hmac_json_dumps({'visits': 1, 'user_id': 42, 'roles': ['admin', 'staff']},
+                             key=app.settings['SESSION_SECRET_KEY'])
+    client = ASGIClient(app)
+    scope = http_scope(path='/', headers=[('cookie', f'{app.settings["SESSION_COOKIE_NAME"]}={cookie}')])
+    return lambda: client.request(scope)
+
+
+@scenario('session_load_save')
+def session_load_save():
+    '''Load a signed session cookie, modify the session and sign it again.'''
+    async def view(request):
+        request.session['visits'] = request.session.get('visits', 0) + 1
+        return TextResponse('ok')
+
+    return _session(view)
+
+
+@scenario('session_read')
+def session_read():
+    '''Read a value from the session without modifying it.'''
+    async def view(request):
+        return TextResponse(str(request.session.get('user_id')))
+
+    return _session(view)
+
+
+@scenario('session_unused')
+def session_unused():
+    '''A request with a session cookie, the view does not use the session.'''
+    return _session(_text_view)
+
+
+def _store_session(view):
+    app = BluePark()
+    store = MemorySessionStore()
+    app.add_http_middleware(session_middleware(StoreSession, store=store))
+    app.router.add_rule('/', view)
+
+    asyncio.run(store.set('benchmark', {'visits': 1, 'user_id': 42, 'roles': ['admin', 'staff']}, 3600))
+    cookie = get_signer(app.settings['SESSION_SECRET_KEY']).sign(b'benchmark')
+    client = ASGIClient(app)
+    scope = http_scope(path='/', headers=[('cookie', f'{app.settings["SESSION_COOKIE_NAME"]}={cookie}')])
+    return lambda: client.request(scope)
+
+
+@scenario('store_session_load_save')
+def store_session_load_save():
+    '''Load a session from the memory store by its signed id, modify it and write it back.'''
+    async def view(request):
+        request.session['visits'] = request.session.get('visits', 0) + 1
+        return TextResponse('ok')
+
+    return _store_session(view)
+
+
+@scenario('store_session_read')
+def store_session_read():
+    '''Read a value from a session in the memory store without modifying it, nothing is written.'''
+    async def view(request):
+        return TextResponse(str(request.session.get('user_id')))
+
+    return _store_session(view)
+
+
+def _sign(digest: str):
+    signer = get_signer('secret', digest=digest)
+    payload = json.dumps({'visits': 1, 'user_id': 42, 'roles': ['admin', 'staff']}).encode()
+
+    async def operation():
+        signer.sign(payload)
+
+    return operation
+
+
+def _verify(digest: str):
+    signer = get_signer('secret', old_keys=['old secret'], digest=digest)
+    token = signer.sign(json.dumps({'visits': 1, 'user_id': 42, 'roles': ['admin', 'staff']}).encode())
+
+    async def operation():
+        signer.unsign(token, max_age=60)
+
+    return operation
+
+
+@scenario('sign_sha256')
+def sign_sha256():
+    return _sign('sha256')
+
+
+@scenario('verify_sha256')
+def verify_sha256():
+    return _verify('sha256')
+
+
+@scenario('sign_blake2b')
+def sign_blake2b():
+    return _sign('blake2b')
+
+
+@scenario('verify_blake2b')
+def verify_blake2b():
+    return _verify('blake2b')
+
+
+@scenario('error_404')
+def error_404():
+    app = BluePark()
+    app.router.add_rule('/', _text_view)
+    client = ASGIClient(app)
+    scope = http_scope(path='/missing/')
+    return lambda: client.request(scope)
+
+
+class _ServiceError(HTTPException):
+    status_code = 503
+    message = 'Service Unavailable'
+
+
+@scenario('error_handler')
+def error_handler():
+    '''A view raises an exception that is handled by an error handler registered for its parent class.'''
+    app = BluePark()
+
+    async def handler(request, e):
+        return JSONResponse({'error': e.message}, status=e.status_code)
+
+    app.add_error_handler(HTTPException, handler)
+
+    @app.router.route('/')
+    async def view(request):
+        raise _ServiceError()
+
+    client = ASGIClient(app)
+    scope = http_scope(path='/')
+    return lambda: client.request(scope)
@@ -1 +1 @@
-from .globals import current_app
\ No newline at end of file
+from .globals import current_app, current_request, get_current_app, get_current_request
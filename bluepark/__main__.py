@@ -0,0 +1,46 @@
+'''
+Serve an app with a pre-fork server, see `bluepark.server`.
+
+    python -m bluepark test:app                                   # a worker for every CPU on 127.0.0.1:8000
+    python -m bluepark test:app --host 0.0.0.0 --workers 8 --reuse-port
+    python -m bluepark test:app --max-requests 10000 --max-requests-jitter 1000 --max-memory 512
+
+Send SIGHUP to the supervisor to reload the workers.
+'''
+import argparse
+import logging
+
+from .server import Supervisor
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='python -m bluepark', description='Serve a BluePark app with workers.')
+    parser.add_argument('app', help='The app to serve, as module:attribute.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=None, help='Number of workers, defaults to the number of CPUs.')
+    parser.add_argument('--reuse-port', action='store_true',
+                        help='Bind a socket with SO_REUSEPORT in every worker instead of sharing one socket.')
+    parser.add_argument('--max-requests', type=int, default=0, help='Replace a worker after this many requests.')
+    parser.add_argument('--max-requests-jitter', type=int, default=0,
+                        help='Add a random number up to this to --max-requests of each worker.')
+    parser.add_argument('--max-memory', type=int, default=0, help='Replace a worker that uses more MB of memory.')
+    parser.add_argument('--graceful-timeout', type=float, default=30,
+                        help='Seconds a stopping worker has to finish its requests.')
+    parser.add_argument('--check-interval', type=float, default=1.0,
+                        help='Seconds between two checks of the memory of the workers.')
+    parser.add_argument('--log-level', default='info')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level.upper(), format='[%(process)d] %(levelname)s %(message)s')
+    supervisor = Supervisor(
+        args.app, host=args.host, port=args.port, workers=args.workers, reuse_port=args.reuse_port,
+        max_requests=args.max_requests, max_requests_jitter=args.max_requests_jitter,
+        max_memory=args.max_memory * 1024 * 1024, graceful_timeout=args.graceful_timeout,
+        check_interval=args.check_interval, log_level=args.log_level
+    )
+    return supervisor.run()
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,164 @@
+import asyncio
+import collections
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import typing
+
+from .request import HTTPRequest
+from .response import HTTPBaseResponse
+from .utils.types import HTTPMiddleware, HTTPView
+
+logger = logging.getLogger('bluepark.accesslog')
+
+# Format access records as JSON lines
+JSON_FORMAT = 'json'
+
+# Similar to the common log format, with the matched rule and duration
+DEFAULT_TEXT_FORMAT = '{method} {path} {rule} {status} {bytes} {duration_ms:.3f}ms {request_id}'
+
+
+class access_log_middleware:
+    '''
+    Log a compact record for every request without blocking the event loop.
+
+    Records are plain dicts with `time`, `method`, `path`, `rule`, `status`, `bytes`, `duration_ms` and
+    `request_id` keys. They are put on a bounded queue and a background thread formats and writes them in batches.
+    When the queue is full, records are dropped and counted in `dropped`, the request is never blocked. Records that
+    can't be formatted with `log_format` are dropped too, the error is logged once.
+
+    Use `install` to add the middleware to the app, so the records in the queue are written when the app shuts down:
+
+        access_log_middleware('access.log').install(app)
+
+    The request id is taken from `request_id_header` or generated when the request does not have one.
+
+    :param output: Path of a file to append to or a writable text stream.
+    :param log_format: `json` for JSON lines or a `str.format` template that is formatted with the record.
+    :param max_queue_size: Number of records that can wait to be written.
+    :param batch_size: Maximum number of records written at once.
+    :param flush_interval: Seconds between two writes.
+    '''
+
+    def __init__(self, output: typing.Union[str, typing.TextIO], log_format: str = JSON_FORMAT,
+                 max_queue_size: int = 10000, batch_size: int = 1000, flush_interval: float = 0.1,
+                 request_id_header: str = 'x-request-id') -> None:
+        if isinstance(output, str):
+            self._stream = open(output, 'a')
+            self._owns_stream = True
+        else:
+            self._stream = output
+            self._owns_stream = False
+
+        self.log_format = log_format
+        self.max_queue_size = max_queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.request_id_header = request_id_header.lower()
+
+        # Records dropped because the queue was full, counted by the event loop, and records that could not be
+        # formatted, counted by the writer thread
+        self._queue_full_count = 0
+        self._format_error_count = 0
+
+        # deque.append and deque.popleft are thread safe and do not take a lock
+        self._queue: typing.Deque[dict] = collections.deque()
+        self._request_ids = itertools.count(1)
+        self._request_id_prefix = f'{os.getpid():x}-'
+        self._stop_event = threading.Event()
+        self._writer: typing.Optional[threading.Thread] = None
+
+    @property
+    def dropped(self) -> int:
+        '''Number of records that were not written.'''
+        return self._queue_full_count + self._format_error_count
+
+    def install(self, app) -> None:
+        '''Add the middleware to the app and write the records in the queue at the lifespan shutdown of the app.'''
+        app.add_http_middleware(self)
+        app.add_shutdown_handler(self.aclose)
+
+    def _start_writer(self) -> None:
+        self._writer = threading.Thread(target=self._run, name='bluepark-access-log', daemon=True)
+        self._writer.start()
+
+    async def __call__(self, request: HTTPRequest, nxt: typing.Union[HTTPMiddleware, HTTPView]) -> HTTPBaseResponse:
+        start = time.perf_counter()
+        try:
+            response = await nxt()
+        except Exception as e:
+            # The exception is turned into a response by an error handler after this middleware returns
+            self._log(request, getattr(e, 'status_code', 500), None, start)
+            raise
+        self._log(request, response.status, None if response.streaming else len(response.render()), start)
+        return response
+
+    def _log(self, request: HTTPRequest, status: int, body_size: typing.Optional[int], start: float) -> None:
+        duration = time.perf_counter() - start
+        if len(self._queue) >= self.max_queue_size:
+            self._queue_full_count += 1
+            return
+
+        request_id = request.headers.get(self.request_id_header)
+        if request_id is None:
+            request_id = f'{self._request_id_prefix}{next(self._request_ids):x}'
+        self._queue.append({
+            'time': time.time(),
+            'method': request.method,
+            'path': request.path,
+            'rule': request.url_rule.rule_name if request.url_rule is not None else None,
+            'status': status,
+            'bytes': body_size,
+            'duration_ms': duration * 1000,
+            'request_id': request_id,
+        })
+        if self._writer is None:
+            self._start_writer()
+
+    def _format(self, record: dict) -> typing.Optional[str]:
+        '''Return the line of the record, or None if the format is not valid for it.'''
+        if self.log_format == JSON_FORMAT:
+            return json.dumps(record, separators=(',', ':'))
+        try:
+            return self.log_format.format(**record)
+        except (KeyError, IndexError, ValueError, TypeError, AttributeError):
+            if not self._format_error_count:
+                logger.exception('Access log records can not be formatted with %r, they are dropped', self.log_format)
+            self._format_error_count += 1
+            return None
+
+    def _write_batches(self) -> None:
+        while self._queue:
+            lines = []
+            while self._queue and len(lines) < self.batch_size:
+                line = self._format(self._queue.popleft())
+                if line is not None:
+                    lines.append(line)
+            if lines:
+                lines.append('')
+                self._stream.write('\n'.join(lines))
+        self._stream.flush()
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self.flush_interval):
+            if self._queue:
+                self._write_batches()
+        self._write_batches()
+
+    def close(self) -> None:
+        '''Stop the writer thread after writing the records in the queue.'''
+        if self._writer is not None:
+            self._stop_event.set()
+            self._writer.join()
+            self._writer = None
+        else:
+            self._write_batches()
+        if self._owns_stream:
+            self._stream.close()
+
+    async def aclose(self) -> None:
+        '''Call `close` without blocking the event loop.'''
+        await asyncio.get_event_loop().run_in_executor(None, self.close)
@@ -0,0 +1,121 @@
+import collections
+import json
+import random
+import time
+import tracemalloc
+import typing
+
+from .response import JSONResponse
+from .tracing import REQUEST_START, ROUTE_MATCHED, RESPONSE_END
+from .utils.types import ASGIScope
+
+
+class RouteAllocations:
+    '''Allocation deltas of the sampled requests of a single route.'''
+
+    def __init__(self, history_size: int) -> None:
+        self.requests = 0
+        # Sum of net allocated bytes of all sampled requests
+        self.total_size = 0
+        # Net allocated bytes by `filename:lineno`
+        self.lines: typing.Counter[str] = collections.Counter()
+        # (unix time, total size) pairs to follow the growth over time
+        self.history: typing.Deque[typing.Tuple[float, int]] = collections.deque(maxlen=history_size)
+
+    def add(self, stats: typing.List[tracemalloc.StatisticDiff]) -> None:
+        self.requests += 1
+        for stat in stats:
+            if stat.size_diff == 0:
+                continue
+            frame = stat.traceback[0]
+            self.lines[f'{frame.filename}:{frame.lineno}'] += stat.size_diff
+            self.total_size += stat.size_diff
+        self.history.append((time.time(), self.total_size))
+
+    def report(self, top: int) -> dict:
+        return {
+            'requests': self.requests,
+            'total_size': self.total_size,
+            'average_size': self.total_size // self.requests if self.requests else 0,
+            'top_lines': [{'line': line, 'size': size} for line, size in self.lines.most_common(top)],
+            'history': list(self.history),
+        }
+
+
+class AllocationTracker:
+    '''
+    Attribute heap allocations to routes using tracemalloc snapshots.
+
+    A snapshot is taken when a sampled request starts and another one when its response ends, so request parsing,
+    middleware, the view and building and sending the response are all covered. The difference is grouped by the
+    `rule_name` of the matched URL rule.
+
+    Snapshots are process wide, allocations of other requests that are handled concurrently are attributed to the
+    sampled request as well. Keep the sample rate low, taking a snapshot is expensive.
+
+    Use `install` to subscribe to the lifecycle hooks of an app and register `view` on an admin route or call
+    `dump` periodically to read the results.
+
+    :param sample_rate: Ratio of the requests to track, between 0 and 1.
+    :param top: Number of top allocating lines to report for each route.
+    :param frames: Number of frames to store for each allocation, see `tracemalloc.start`.
+    :param history_size: Number of growth points to keep for each route.
+    '''
+
+    def __init__(self, sample_rate: float = 0.01, top: int = 10, frames: int = 1, history_size: int = 100) -> None:
+        self.sample_rate = sample_rate
+        self.top = top
+        self.frames = frames
+        self.history_size = history_size
+
+        self.routes: typing.MutableMapping[str, RouteAllocations] = {}
+        # Start snapshot and route name of the sampled requests in progress by id of their scope
+        self._pending: typing.MutableMapping[int, typing.List] = {}
+        self._filters = [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ]
+
+    def install(self, app) -> None:
+        '''Start tracing allocations and subscribe to the lifecycle hooks of the app.'''
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        for event in (REQUEST_START, ROUTE_MATCHED, RESPONSE_END):
+            app.add_hook(event, self)
+
+    def __call__(self, event: str, timestamp: int, scope: ASGIScope, **details) -> None:
+        if event == REQUEST_START:
+            if random.random() < self.sample_rate:
+                self._pending[id(scope)] = [self._snapshot(), 'unmatched']
+        elif event == ROUTE_MATCHED:
+            pending = self._pending.get(id(scope))
+            if pending is not None:
+                pending[1] = details['rule'].rule_name
+        elif event == RESPONSE_END:
+            pending = self._pending.pop(id(scope), None)
+            if pending is not None:
+                start_snapshot, route = pending
+                stats = self._snapshot().compare_to(start_snapshot, 'lineno')
+                if route not in self.routes:
+                    self.routes[route] = RouteAllocations(self.history_size)
+                self.routes[route].add(stats)
+
+    def _snapshot(self) -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces(self._filters)
+
+    def report(self) -> dict:
+        '''Return allocation statistics by route, routes that allocate the most come first.'''
+        routes = sorted(self.routes.items(), key=lambda item: item[1].total_size, reverse=True)
+        return {route: allocations.report(self.top) for route, allocations in routes}
+
+    async def view(self, request) -> JSONResponse:
+        '''A view function that returns the report as JSON.'''
+        return JSONResponse(self.report())
+
+    def dump(self, path: str) -> None:
+        '''Write the report to a file as JSON.'''
+        with open(path, 'w') as f:
+            json.dump(self.report(), f)
+
+    def reset(self) -> None:
+        self.routes = {}
@@ -1,11 +1,18 @@
+import functools
+import types
 import typing
+from concurrent.futures import ThreadPoolExecutor
 
-from .exceptions import HTTPException
+from .asgiapps import ASGIHTTPApplication, TracedASGIHTTPApplication, ASGILifespanApplication
+from .exceptions import HTTPException, AppFrozen
 from .globals import current_app
 from .response import TextResponse
 from .routing import MainRouter, Router
 from .settings import Settings, DEFAULT_SETTINGS
-from .utils.types import ASGIScope, ASGIAppInstance, HTTPMiddleware, ErrorHandler
+from .tracing import HOOK_EVENTS
+from .utils.concurrency import DEFAULT_THREAD_POOL, ensure_async_middleware
+from .utils.types import (ASGIScope, ASGIReceive, ASGISend, ASGIAppInstance, ASGIApp, HTTPMiddleware, ErrorHandler,
+                          Hook)
 
 
 # TODO type of request param
@@ -21,9 +28,13 @@ class BluePark:
 
     router: MainRouter = None
 
+    # Set by `freeze`, nothing can be registered to a frozen app.
+    _frozen = False
+
     def __init__(self) -> None:
         # TODO, settings from a file
-        self.settings = Settings(DEFAULT_SETTINGS)
+        self.settings = Settings(DEFAULT_SETTINGS, on_change=self._resolve_settings)
+        self._resolve_settings()
 
         # List of middleware functions for http connections.
         self._http_middleware = []
@@ -35,39 +46,178 @@ class BluePark:
         self._error_handlers_by_code: typing.MutableMapping[int, ErrorHandler] = {}
         self._error_handlers_by_exception: typing.List[typing.Tuple[typing.Any, ErrorHandler]] = []
 
+        # Error handlers by exception class, filled when the app is frozen and whenever a new exception class is seen
+        self._error_handler_cache: typing.MutableMapping[type, typing.Optional[ErrorHandler]] = {}
+
+        # Async functions to be called on lifespan startup and shutdown events
+        self._startup_handlers: typing.List[typing.Callable[[], typing.Awaitable]] = []
+        self._shutdown_handlers: typing.List[typing.Callable[[], typing.Awaitable]] = []
+
+        # Thread pools for sync views and middleware by name, and their sizes. Pools are created on first use.
+        self._thread_pool_sizes: typing.MutableMapping[str, typing.Optional[int]] = {DEFAULT_THREAD_POOL: None}
+        self._thread_pools: typing.MutableMapping[str, ThreadPoolExecutor] = {}
+
+        # Request lifecycle hooks by event name
+        self._hooks: typing.MutableMapping[str, typing.List[Hook]] = {}
+
+        # ASGI handlers by scope type
+        self._protocol_handlers: typing.MutableMapping[str, ASGIApp] = {}
+        self._build_protocol_handlers()
+
         # Add default handler for http exception
         self.add_error_handler(HTTPException, _http_exception_handler)
 
         # Set proxy object to point to current app.
         current_app._wrap(self)
 
-    def __call__(self, scope: ASGIScope) -> ASGIAppInstance:
+    async def __call__(self, scope: ASGIScope, receive: ASGIReceive, send: ASGISend) -> None:
+        '''
+        ASGI 3 single callable. Whenever there is a new connection, the ASGI protocol server calls the application
+        with the connection scope, and the receive and send awaitables to handle events and send data back to the
+        client.
+        '''
+        if not self._frozen and scope['type'] == 'http':
+            self.freeze()
+        handler = self._protocol_handlers.get(scope['type'])
+        if handler is not None:
+            await handler(scope, receive, send)
+
+    def asgi2(self, scope: ASGIScope) -> ASGIAppInstance:
         '''
-        Applications are instantiated with a connection scope, and then run in an event loop where they are expected
-        to handle events and send data back to the client. Whenever there is a new connection, the ASGI protocol
-        server calls the application instance.
+        ASGI 2 double callable, for servers that only support ASGI 2. Pass `app.asgi2` instead of `app` to them.
         '''
-        return self._dispatch(scope)
+        return functools.partial(self, scope)
 
-    def _dispatch(self, scope: ASGIScope) -> ASGIAppInstance:
+    def _build_protocol_handlers(self) -> None:
         '''
-        Create an ASGI app instance and return it.
+        Create the handlers of the supported protocols by scope type. They are resolved once, and again whenever the
+        hooks change, rather than on every connection.
         '''
+        # Lifecycle events are only emitted when there is a subscriber, so the default path pays nothing.
+        http_handler_class = TracedASGIHTTPApplication if self._hooks else ASGIHTTPApplication
+        self._protocol_handlers = {
+            'http': http_handler_class(self),
+            'lifespan': ASGILifespanApplication(self),
+        }
 
-        from bluepark.asgiapps import ASGIHTTPApplication
+    def freeze(self) -> None:
+        '''
+        Validate the routes and compile the router, the middleware chain and the error handler lookup into immutable
+        structures, so the request path only reads precomputed tables. Anything registered after this raises
+        `AppFrozen`.
 
-        if scope['type'] == 'http':
-            return ASGIHTTPApplication(self, scope)
+        It is called at lifespan startup or on the first request, so it is only needed to call it manually to move
+        the work or the validation errors to an earlier point.
+        '''
+        if self._frozen:
+            return
+        self.router.freeze(cache_path=self.settings['ROUTE_CACHE_PATH'])
+        self._http_middleware = tuple(self._http_middleware)
+        self._error_handlers_by_code = types.MappingProxyType(dict(self._error_handlers_by_code))
+        self._error_handlers_by_exception = tuple(self._error_handlers_by_exception)
+        for exception_class, _ in self._error_handlers_by_exception:
+            self._error_handler_cache[exception_class] = self._find_error_handler(exception_class)
+        self._resolve_settings()
+        self._build_protocol_handlers()
+        self._frozen = True
+
+    @property
+    def frozen(self) -> bool:
+        return self._frozen
+
+    def _check_not_frozen(self) -> None:
+        if self._frozen:
+            raise AppFrozen("You can't register anything after the app is frozen")
+
+    def add_startup_handler(self, handler: typing.Callable[[], typing.Awaitable]) -> None:
+        '''Add an async function to be called on lifespan startup, before the app is frozen.'''
+        self._check_not_frozen()
+        self._startup_handlers.append(handler)
+
+    def add_shutdown_handler(self, handler: typing.Callable[[], typing.Awaitable]) -> None:
+        '''Add an async function to be called on lifespan shutdown.'''
+        self._check_not_frozen()
+        self._shutdown_handlers.append(handler)
+
+    async def startup(self) -> None:
+        '''Run the startup handlers and freeze the app.'''
+        for handler in self._startup_handlers:
+            await handler()
+        self.freeze()
+
+    async def shutdown(self) -> None:
+        '''Run the shutdown handlers and stop the thread pools.'''
+        for handler in self._shutdown_handlers:
+            await handler()
+        for executor in self._thread_pools.values():
+            executor.shutdown(wait=False)
+        self._thread_pools.clear()
+
+    def add_thread_pool(self, name: str, max_workers: int) -> None:
+        '''
+        Add a named thread pool to run sync views and middleware in. Select it with the `pool` argument of
+        `Router`, `route` or `add_http_middleware`, so slow blocking code can't use up the threads of the rest.
+        '''
+        self._check_not_frozen()
+        self._thread_pool_sizes[name] = max_workers
+
+    def get_thread_pool(self, name: str = DEFAULT_THREAD_POOL) -> ThreadPoolExecutor:
+        '''Return the thread pool with the name, create it on first use.'''
+        try:
+            return self._thread_pools[name]
+        except KeyError:
+            pass
+
+        if name not in self._thread_pool_sizes:
+            raise ValueError(f'Unknown thread pool: {name}')
+        max_workers = self._thread_pool_sizes[name]
+        if max_workers is None:
+            max_workers = self.settings['THREAD_POOL_MAX_WORKERS']
+        executor = self._thread_pools[name] = ThreadPoolExecutor(max_workers, thread_name_prefix=f'bluepark-{name}')
+        return executor
+
+    def _resolve_settings(self) -> None:
+        '''
+        Copy the settings that are read by every request and response to attributes, so they are resolved once for
+        the app instead of once for every object. It is called whenever the settings change.
+        '''
+        self.header_encoding = self.settings['DEFAULT_HEADER_ENCODING']
+        self.request_charset = self.settings['DEFAULT_REQUEST_CHARSET']
+        self.response_charset = self.settings['DEFAULT_RESPONSE_CHARSET']
 
     @property
     def http_middleware_list(self):
         return self._http_middleware
 
-    def add_http_middleware(self, middleware: HTTPMiddleware):
-        self._http_middleware.append(middleware)
+    def add_http_middleware(self, middleware: HTTPMiddleware, pool: str = None):
+        '''Add a middleware for all requests. Sync middleware are called in the thread pool with the name `pool`.'''
+        self._check_not_frozen()
+        self._http_middleware.append(ensure_async_middleware(middleware, pool))
+
+    def add_hook(self, event: str, hook: Hook) -> None:
+        '''
+        Subscribe to a request lifecycle event. Events are listed in `bluepark.tracing.HOOK_EVENTS`.
+
+        Hooks are called synchronously as `hook(event, timestamp, scope, **details)` where timestamp is
+        `time.perf_counter_ns()`, so they must be cheap.
+        '''
+        if event not in HOOK_EVENTS:
+            raise ValueError(f'Unknown hook event: {event}')
+        self._hooks.setdefault(event, []).append(hook)
+        self._build_protocol_handlers()
+
+    def remove_hook(self, event: str, hook: Hook) -> None:
+        '''Unsubscribe the hook from the event.'''
+        hooks = self._hooks.get(event, [])
+        if hook in hooks:
+            hooks.remove(hook)
+        if not hooks:
+            self._hooks.pop(event, None)
+        self._build_protocol_handlers()
 
     def add_router(self, router: Router) -> None:
         '''Register a new router to app.'''
+        self._check_not_frozen()
         router._set_main_router(self.router)
 
     def error_handler_by_code(self, status_code: int) -> typing.Optional[ErrorHandler]:
@@ -76,13 +226,24 @@ class BluePark:
 
     def error_handler_by_exception(self, e: Exception) -> typing.Optional[ErrorHandler]:
         '''Return error handler function or None for given exception object'''
+        if not self._frozen:
+            return self._find_error_handler(type(e))
+
+        error_type = type(e)
+        try:
+            return self._error_handler_cache[error_type]
+        except KeyError:
+            handler = self._error_handler_cache[error_type] = self._find_error_handler(error_type)
+            return handler
+
+    def _find_error_handler(self, error_type: typing.Type[Exception]) -> typing.Optional[ErrorHandler]:
+        '''Return the handler registered for the closest class to `error_type` in its class hierarchy'''
 
         # Closest handler function and its distance in class hierarchy to given exception
         closest_handler = (None, 999)
-        error_type = type(e)
 
         for e_class, handler in self._error_handlers_by_exception:
-            if not isinstance(e, e_class):
+            if not issubclass(error_type, e_class):
                 continue
             if error_type == e_class:
                 closest_handler = (handler, 0)
@@ -113,6 +274,7 @@ class BluePark:
 
     def add_error_handler(self, indicator: typing.Union[int, typing.Type[Exception]], handler: ErrorHandler) -> None:
         '''Add an error handler for an exception either by status code (for HTTPExceptions) or exception class'''
+        self._check_not_frozen()
         if isinstance(indicator, int):
             self._error_handlers_by_code[indicator] = handler
         elif issubclass(indicator, Exception):
@@ -1,138 +1,183 @@
+import time
 import typing
 
-from .app import BluePark
 from .request import HTTPRequest
 from .response import HTTPBaseResponse
-from .utils.types import ASGIScope, ASGIReceive, ASGISend, HTTPView, ASGIHeaders, ErrorHandler
+from .utils.types import ASGIScope, ASGIReceive, ASGISend, HTTPView, ASGIHeaders, ErrorHandler, HTTPMiddleware
 from .exceptions import HTTPException, HTTP404, HTTP405
+from .globals import app_context, request_context
+from .routing import URLRule
+from .tracing import (REQUEST_START, ROUTE_MATCHED, MIDDLEWARE_ENTER, MIDDLEWARE_EXIT, VIEW_ENTER, VIEW_EXIT,
+                      RESPONSE_START, RESPONSE_END)
+
+if typing.TYPE_CHECKING:
+    from .app import BluePark
 
 
 class BaseASGIApplication:
     '''
-    Base class for creating ASGI applications.
+    Base class for creating ASGI protocol handlers.
 
-    Each application instance maps to a single incoming “socket” or connection, and is expected to last the lifetime
-    of that connection plus a little longer if there is cleanup to do. Some protocols may not use traditional sockets;
-    ASGI specifications for those protocols are expected to define what the scope (instance) lifetime is and when it
-    gets shut down.
+    Handlers follow the ASGI 3 single callable interface. A handler is created once for each app and protocol, and
+    it is called with the scope, receive and send callables of every connection, so there is no per-connection
+    application instance. Per-connection state lives in the objects created for the connection, like the request.
     '''
 
-    def __init__(self, app: BluePark, scope: ASGIScope) -> None:
+    def __init__(self, app: 'BluePark') -> None:
         self.app = app
-        self.scope = scope
-        self._response_started = False
 
-    async def __call__(self, receive: ASGIReceive, send: ASGISend) -> None:
+    async def __call__(self, scope: ASGIScope, receive: ASGIReceive, send: ASGISend) -> None:
         '''
         The receive awaitable provides events as dicts as they occur, and the send awaitable sends events back to
         the client in a similar dict format.
         '''
-
-        self.receive = receive
-        self.send = send
-        await self.handle_connection()
-
-    async def handle_connection(self):
         raise NotImplementedError()
 
 
 class ASGIHTTPApplication(BaseASGIApplication):
     '''
-    ASGI app for Http connections.
+    ASGI handler for Http connections.
 
-    HTTP connections have a single-request connection scope - that is, your applications will be instantiated at
-    the start of the request, and destroyed at the end, even if the underlying socket is still open and serving
-    multiple requests.
+    HTTP connections have a single-request connection scope, a request object is created at the start of the
+    request, and destroyed at the end, even if the underlying socket is still open and serving multiple requests.
     '''
 
-    async def start_response(self, status: int, headers: ASGIHeaders) -> None:
-        '''Start the http response if it is not started yet.'''
-        if self._response_started:
-            return
-        self._response_started = True
-        await self.send({
+    async def __call__(self, scope: ASGIScope, receive: ASGIReceive, send: ASGISend) -> None:
+        '''This method will be called whenever there is a new connection from ASGI server'''
+        request = HTTPRequest(self.app, scope, receive)
+
+        # Make the app and the request available to the code running in this task as current_app and current_request
+        app_token = app_context.set(self.app)
+        request_token = request_context.set(request)
+        try:
+            # Run all middleware and wait for them
+            response = await self.dispatch(request)
+            await self.send_response(send, response)
+        finally:
+            request_context.reset(request_token)
+            app_context.reset(app_token)
+
+    async def dispatch(self, request: HTTPRequest) -> HTTPBaseResponse:
+        '''Dispatch the incoming request to the view through middleware and get the response'''
+        return await HTTPDispatcher(self, request)()
+
+    async def start_response(self, send: ASGISend, status: int, headers: ASGIHeaders) -> None:
+        '''Start the http response.'''
+        await send({
             'type': 'http.response.start',
             'status': status,
             'headers': headers
         })
 
-    async def send_http_body(self, body: bytes, more_body: bool = False) -> None:
+    async def send_http_body(self, send: ASGISend, body: bytes, more_body: bool = False) -> None:
         '''Send a http body message.'''
-        await self.send({
+        await send({
             'type': 'http.response.body',
             'body': body,
             'more_body': more_body
         })
 
-    async def end_response(self) -> None:
+    async def end_response(self, send: ASGISend) -> None:
         '''End the http response. It is not possible to send http messages after calling this method.'''
-        await self.send_http_body(b'', more_body=False)
-
-    async def handle_connection(self) -> None:
-        '''This method will be called whenever there is a new connection from ASGI server'''
-        self.request = HTTPRequest(self.app, self.scope, self.receive)
-
-        # Run all middleware and wait for them
-        response = await self.dispatch()
-        await self.send_response(response)
-
-    async def dispatch(self) -> HTTPBaseResponse:
-        '''Dispatch the incoming request to the view through middleware and get the response'''
-        dispatcher = HTTPDispatcher(self)
-        return await dispatcher()
+        await self.send_http_body(send, b'', more_body=False)
+
+    async def send_response(self, send: ASGISend, response: HTTPBaseResponse) -> None:
+        if response.frozen:
+            # The messages are replaced together when the response is refreshed, they are read once
+            start_message, body_message = response.messages
+            await send(start_message)
+            await send(body_message)
+            return
 
-    async def send_response(self, response: HTTPBaseResponse) -> None:
-        await self.start_response(status=response.status, headers=response.get_headers())
-        await self.send_http_body(body=response.body_as_bytes())
+        await self.start_response(send, status=response.status, headers=response.get_headers())
+        if response.streaming:
+            async for chunk in response.iter_chunks():
+                if chunk:
+                    await self.send_http_body(send, body=chunk, more_body=True)
+            await self.end_response(send)
+        else:
+            await self.send_http_body(send, body=response.render())
 
 
 class HTTPDispatcher:
     '''Await for first middleware in the middleware list.
 
     Pass a callable to the middleware that returns the next middleware on the list.
-    If there is no next middleware, return the view function.
+    If there is no next middleware, match the URL rule and continue with the middleware of the rule, if there are any.
+    Then return the view function.
     '''
-    _middleware_iterator = None
+    __slots__ = ('asgi_app', 'request', '_middleware', '_index', '_rule', '_params')
 
-    def __init__(self, asgi_app: ASGIHTTPApplication) -> None:
+    def __init__(self, asgi_app: ASGIHTTPApplication, request: HTTPRequest) -> None:
         self.asgi_app = asgi_app
-        self._middleware_iterator = iter(asgi_app.app._http_middleware)
+        self.request = request
+        self._middleware = asgi_app.app._http_middleware
+        self._index = 0
+        self._rule: typing.Optional[URLRule] = None
+        self._params: typing.Optional[dict] = None
 
     async def __call__(self, *args, **kwargs) -> HTTPBaseResponse:
         '''Call the next middleware in the list and return the awaitable.'''
 
         # Call all middleware in order and await for their response
-        next_middleware = next(self._middleware_iterator, None)
-        if next_middleware is not None:
+        index = self._index
+        if index < len(self._middleware):
+            self._index = index + 1
             try:
-                response = await next_middleware(self.asgi_app.request, self)
+                response = await self.call_middleware(self._middleware[index])
             except Exception as e:
                 handler = self.get_exception_handler_or_raise(e)
-                return await handler(self.asgi_app.request, e)
+                return await handler(self.request, e)
             else:
                 return response
 
-        # At this point, all of the middleware are called and it is time to call view function
-        view_function, extra_kwargs = self.get_view_function()
+        # At this point, all of the app middleware are called and it is time to find the rule
+        if self._rule is None:
+            try:
+                _, self._params = self.get_view_function()
+            except Exception as e:
+                handler = self.get_exception_handler_or_raise(e)
+                return await handler(self.request, e)
+
+            if self._rule.middleware:
+                self._middleware = self._rule.middleware
+                self._index = 0
+                return await self()
+
+        # All of the middleware are called and it is time to call view function
         try:
-            response = await view_function(self.asgi_app.request, **extra_kwargs)
+            response = await self.call_view(self._rule.view_function, self._params)
         except Exception as e:
             handler = self.get_exception_handler_or_raise(e)
-            return await handler(self.asgi_app.request, e)
+            return await handler(self.request, e)
         else:
             return response
 
-    def get_view_function(self) -> typing.Tuple[HTTPView, dict]:
-        '''Return the view function that matches request path and URL param values.'''
-        rule = self.asgi_app.app.router.get_rule_for_path(self.asgi_app.request.path)
+    def call_middleware(self, middleware: HTTPMiddleware) -> typing.Awaitable:
+        return middleware(self.request, self)
+
+    def call_view(self, view_function: HTTPView, extra_kwargs: dict) -> typing.Awaitable:
+        return view_function(self.request, **extra_kwargs)
+
+    def match_rule(self) -> URLRule:
+        '''Return the URL rule that matches request path. Raise HTTP exception if there is no rule for the request.'''
+        rule = self.asgi_app.app.router.get_rule_for_path(self.request.path)
 
         if rule is None:
             raise HTTP404()
 
-        if not rule.is_method_allowed(self.asgi_app.request.method):
+        if not rule.is_method_allowed(self.request.method):
             raise HTTP405()
 
-        # Parsed params contains the dictionary of captured URL parameter and values
+        self.request.url_rule = self._rule = rule
+        return rule
+
+    def get_view_function(self) -> typing.Tuple[HTTPView, dict]:
+        '''Return the view function that matches request path and URL param values.'''
+        rule = self.match_rule()
+
+        # Parsed params contains the dictionary of captured URL parameter and values. The dict is replaced on every
+        # match, so it is kept for this request while the middleware of the rule run.
         return rule.view_function, rule.parsed_params
 
     def get_exception_handler_or_raise(self, e: Exception) -> ErrorHandler:
@@ -154,3 +199,95 @@ class HTTPDispatcher:
         if handler is not None:
             return handler
         raise e
+
+
+class ASGILifespanApplication(BaseASGIApplication):
+    '''
+    ASGI handler for the lifespan protocol. It runs the startup handlers and freezes the app when the server starts,
+    and runs the shutdown handlers when the server stops.
+    '''
+
+    async def __call__(self, scope: ASGIScope, receive: ASGIReceive, send: ASGISend) -> None:
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.app.startup()
+                except Exception as e:
+                    await send({'type': 'lifespan.startup.failed', 'message': repr(e)})
+                    raise
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                try:
+                    await self.app.shutdown()
+                except Exception as e:
+                    await send({'type': 'lifespan.shutdown.failed', 'message': repr(e)})
+                    raise
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+class TracedASGIHTTPApplication(ASGIHTTPApplication):
+    '''
+    ASGI handler for Http connections that emits request lifecycle events to the hooks registered on the app.
+
+    It is only used when there is at least one hook registered, see `BluePark.add_hook`.
+    '''
+
+    def emit(self, event: str, scope: ASGIScope, **details) -> None:
+        '''Call all hooks subscribed to the event.'''
+        hooks = self.app._hooks.get(event)
+        if not hooks:
+            return
+        timestamp = time.perf_counter_ns()
+        for hook in hooks:
+            hook(event, timestamp, scope, **details)
+
+    async def __call__(self, scope: ASGIScope, receive: ASGIReceive, send: ASGISend) -> None:
+        status = None
+        sent_bytes = 0
+
+        async def traced_send(message: dict) -> None:
+            nonlocal status, sent_bytes
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                self.emit(RESPONSE_START, scope, status=status)
+            else:
+                sent_bytes += len(message.get('body', b''))
+            await send(message)
+
+        self.emit(REQUEST_START, scope)
+        try:
+            await super().__call__(scope, receive, traced_send)
+        finally:
+            self.emit(RESPONSE_END, scope, status=status, bytes=sent_bytes)
+
+    async def dispatch(self, request: HTTPRequest) -> HTTPBaseResponse:
+        return await TracedHTTPDispatcher(self, request)()
+
+
+class TracedHTTPDispatcher(HTTPDispatcher):
+    '''HTTP dispatcher that emits routing, middleware and view events.'''
+    __slots__ = ()
+
+    asgi_app: TracedASGIHTTPApplication
+
+    async def call_middleware(self, middleware: HTTPMiddleware) -> HTTPBaseResponse:
+        self.asgi_app.emit(MIDDLEWARE_ENTER, self.request.scope, middleware=middleware)
+        try:
+            return await middleware(self.request, self)
+        finally:
+            self.asgi_app.emit(MIDDLEWARE_EXIT, self.request.scope, middleware=middleware)
+
+    async def call_view(self, view_function: HTTPView, extra_kwargs: dict) -> HTTPBaseResponse:
+        self.asgi_app.emit(VIEW_ENTER, self.request.scope, view=view_function)
+        try:
+            return await view_function(self.request, **extra_kwargs)
+        finally:
+            self.asgi_app.emit(VIEW_EXIT, self.request.scope, view=view_function)
+
+    def match_rule(self) -> URLRule:
+        start = time.perf_counter_ns()
+        rule = super().match_rule()
+        self.asgi_app.emit(ROUTE_MATCHED, self.request.scope, start=start, rule=rule)
+        return rule
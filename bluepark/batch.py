@@ -0,0 +1,261 @@
+import asyncio
+import base64
+import json
+import time
+import typing
+from email.utils import parsedate_to_datetime
+
+from .request import HTTPRequest
+from .response import JSONResponse, StreamingResponse
+from .utils.cookies import parse_cookie_header
+from .utils.types import ASGIHeaders, ASGIMessage, ASGIScope
+
+# Sub-requests with these methods don't change anything, consecutive ones run concurrently
+SAFE_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS'))
+
+# Headers of the batch request that are not passed to the sub-requests
+_batch_only_headers = frozenset((b'content-type', b'content-length', b'transfer-encoding', b'cookie'))
+
+
+class BatchError(ValueError):
+    '''An entry of the batch is not valid'''
+    pass
+
+
+class _SubRequest:
+    __slots__ = ('index', 'id', 'method', 'path', 'query_string', 'headers', 'body')
+
+    def __init__(self, index: int, entry: typing.Any) -> None:
+        if not isinstance(entry, dict):
+            raise BatchError('An entry must be an object')
+        self.index = index
+        self.id = entry.get('id')
+
+        method = entry.get('method', 'GET')
+        path = entry.get('path')
+        if not isinstance(method, str) or not isinstance(path, str) or not path.startswith('/'):
+            raise BatchError('An entry must have a `path` starting with `/` and a string `method`')
+        self.method = method.upper()
+        self.path, _, query_string = path.partition('?')
+        self.query_string = query_string.encode('latin-1')
+
+        headers = entry.get('headers') or {}
+        if isinstance(headers, dict):
+            headers = headers.items()
+        try:
+            self.headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+        except (AttributeError, TypeError, ValueError, UnicodeEncodeError):
+            raise BatchError('`headers` must be an object or a list of [name, value] strings')
+
+        body = entry.get('body')
+        if body is None:
+            self.body = b''
+        elif isinstance(body, str):
+            self.body = body.encode('utf8')
+        else:
+            # JSON bodies are sent encoded, with a JSON content type unless the entry has one
+            self.body = json.dumps(body, separators=(',', ':')).encode('utf8')
+            if not any(name == b'content-type' for name, _ in self.headers):
+                self.headers.append((b'content-type', b'application/json'))
+
+
+class BatchDispatcher:
+    '''
+    A view that runs a batch of requests in a single round trip. Register it on a route that accepts POST:
+
+        batch = BatchDispatcher(max_concurrency=8)
+        app.router.add_rule('/batch/', batch.view, methods=['POST'])
+
+    The body is a JSON array of `{"id", "method", "path", "headers", "body"}` objects, only `path` is required. `path`
+    can have a query string, `body` is a string or a JSON value.
+
+    Every entry is dispatched through the app as a separate request, with the app and rule middleware, routing and
+    error handlers, without going through the network. The headers of the batch request are passed to them, except
+    the body and cookie headers, the headers of an entry take precedence.
+
+    The response is streamed as JSON lines, one line for every entry as soon as it is completed:
+
+        {"index": 0, "id": "a", "status": 200, "headers": [["content-type", "application/json"]], "body": {...}}
+
+    JSON bodies are embedded as they are, text bodies as strings and other bodies as base64 strings with
+    `"encoding": "base64"`. Entries that are not valid or fail with an unhandled exception have status 400 or 500.
+
+    Entries run in the order of the batch, except that consecutive entries with safe methods (GET, HEAD, OPTIONS)
+    run concurrently. An entry with another method starts after all the entries before it are completed, and the
+    entries after it start after it is completed. Every entry is sent the cookies set by the entries before it, so
+    a session changed by an entry is seen by the following ones. The cookies are also returned in the headers of the
+    entry, the client is expected to store them.
+
+    :param max_concurrency: Maximum number of entries dispatched at the same time.
+    :param max_entries: Maximum number of entries in a batch, larger batches are rejected with status 400.
+    '''
+
+    def __init__(self, max_concurrency: int = 8, max_entries: int = 50) -> None:
+        self.max_concurrency = max_concurrency
+        self.max_entries = max_entries
+
+    async def view(self, request: HTTPRequest, **params) -> typing.Union[JSONResponse, StreamingResponse]:
+        try:
+            entries = await request.body_as_json()
+        except (ValueError, TypeError):
+            return JSONResponse({'error': 'The body must be a JSON array'}, status=400)
+        if not isinstance(entries, list):
+            return JSONResponse({'error': 'The body must be a JSON array'}, status=400)
+        if len(entries) > self.max_entries:
+            return JSONResponse({'error': f'A batch can have at most {self.max_entries} entries'}, status=400)
+        return StreamingResponse(self.run(request, entries), mime_type='application/x-ndjson')
+
+    async def run(self, request: HTTPRequest, entries: typing.Sequence[typing.Any]) -> typing.AsyncIterator[bytes]:
+        '''Dispatch the entries and yield a JSON line for every one of them as they are completed.'''
+        results: asyncio.Queue = asyncio.Queue()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        cookies = dict(request.cookies)
+        inherited_headers = [(name, value) for name, value in request.scope['headers']
+                             if name.lower() not in _batch_only_headers]
+
+        async def dispatch(sub_request: _SubRequest) -> None:
+            async with semaphore:
+                await results.put(await self._dispatch(request, sub_request, inherited_headers, cookies))
+
+        async def dispatch_groups(groups: typing.Sequence[typing.Sequence[_SubRequest]]) -> None:
+            for group in groups:
+                await asyncio.gather(*(dispatch(sub_request) for sub_request in group))
+
+        # Every unsafe entry is a group of its own, between the groups of the safe entries before and after it
+        groups: typing.List[typing.List[_SubRequest]] = [[]]
+        for index, entry in enumerate(entries):
+            try:
+                sub_request = _SubRequest(index, entry)
+            except BatchError as e:
+                entry_id = entry.get('id') if isinstance(entry, dict) else None
+                await results.put(self._error_line(index, entry_id, 400, str(e)))
+                continue
+            if sub_request.path == request.path:
+                await results.put(self._error_line(index, sub_request.id, 400, 'Batches can not be nested'))
+            elif sub_request.method in SAFE_METHODS:
+                groups[-1].append(sub_request)
+            else:
+                groups.extend(([sub_request], []))
+        task = asyncio.ensure_future(dispatch_groups([group for group in groups if group]))
+
+        try:
+            for _ in range(len(entries)):
+                yield await results.get()
+        finally:
+            # The client disconnected or the response failed, the remaining entries are not needed
+            task.cancel()
+
+    async def _dispatch(self, request: HTTPRequest, sub_request: _SubRequest, inherited_headers: ASGIHeaders,
+                        cookies: typing.Dict[str, str]) -> bytes:
+        overridden = {name for name, _ in sub_request.headers}
+        headers = [header for header in inherited_headers if header[0].lower() not in overridden]
+        headers.extend(sub_request.headers)
+        if cookies and b'cookie' not in overridden:
+            cookie_header = '; '.join(f'{name}={value}' for name, value in cookies.items())
+            headers.append((b'cookie', cookie_header.encode('latin-1')))
+
+        scope: ASGIScope = {
+            **request.scope,
+            'method': sub_request.method,
+            'path': sub_request.path,
+            'raw_path': sub_request.path.encode('utf8'),
+            'query_string': sub_request.query_string,
+            'headers': headers,
+        }
+        body_sent = False
+
+        async def receive() -> ASGIMessage:
+            nonlocal body_sent
+            if body_sent:
+                # Wait for the batch to be completed, like a client that keeps the connection open
+                await asyncio.Future()
+            body_sent = True
+            return {'type': 'http.request', 'body': sub_request.body, 'more_body': False}
+
+        status = 500
+        response_headers: ASGIHeaders = []
+        body = []
+
+        async def send(message: ASGIMessage) -> None:
+            nonlocal status, response_headers
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                response_headers = message.get('headers', [])
+            elif message['type'] == 'http.response.body':
+                body.append(message.get('body', b''))
+
+        try:
+            await request.app(scope, receive, send)
+        except Exception:
+            return self._error_line(sub_request.index, sub_request.id, 500, 'Internal Server Error')
+
+        for name, value in response_headers:
+            if name.lower() == b'set-cookie':
+                self._update_cookies(cookies, value.decode('latin-1'))
+        return self._line(sub_request, status, response_headers, b''.join(body))
+
+    def _update_cookies(self, cookies: typing.Dict[str, str], set_cookie: str) -> None:
+        pair, *attributes = set_cookie.split(';')
+        name, _, value = pair.partition('=')
+        name = name.strip()
+        if not value or self._is_expired(attributes):
+            cookies.pop(name, None)
+        else:
+            cookies.update(parse_cookie_header(pair))
+
+    def _is_expired(self, attributes: typing.Sequence[str]) -> bool:
+        '''Whether a cookie with these Set-Cookie attributes is removed. Max-Age takes precedence over Expires.'''
+        expires = None
+        for attribute in attributes:
+            key, _, value = attribute.partition('=')
+            key = key.strip().lower()
+            if key == 'max-age':
+                try:
+                    return int(value.strip()) <= 0
+                except ValueError:
+                    continue
+            if key == 'expires':
+                expires = value.strip()
+        if expires is None:
+            return False
+        try:
+            return parsedate_to_datetime(expires).timestamp() <= time.time()
+        except (TypeError, ValueError, IndexError):
+            return False
+
+    def _line(self, sub_request: _SubRequest, status: int, headers: ASGIHeaders, body: bytes) -> bytes:
+        content_type = b''
+        for name, value in headers:
+            if name.lower() == b'content-type':
+                content_type = value.split(b';', 1)[0].strip().lower()
+        line = json.dumps({
+            'index': sub_request.index,
+            'id': sub_request.id,
+            'status': status,
+            'headers': [[name.decode('latin-1'), value.decode('latin-1')] for name, value in headers],
+        }, separators=(',', ':')).encode('utf8')
+
+        if not body:
+            return line[:-1] + b',"body":null}\n'
+        if content_type == b'application/json' or content_type.endswith(b'+json'):
+            try:
+                value = json.loads(body.decode('utf8'))
+            except ValueError:
+                # Not valid JSON, it is sent as text
+                pass
+            else:
+                if b'\n' not in body:
+                    # Already JSON on a single line, it is embedded without encoding it again
+                    return line[:-1] + b',"body":' + body + b'}\n'
+                # Pretty printed JSON would break the lines, it is encoded again
+                encoded = json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf8')
+                return line[:-1] + b',"body":' + encoded + b'}\n'
+        try:
+            encoded = json.dumps(body.decode('utf8'), ensure_ascii=False).encode('utf8')
+        except UnicodeDecodeError:
+            encoded = b'"' + base64.b64encode(body) + b'","encoding":"base64"'
+        return line[:-1] + b',"body":' + encoded + b'}\n'
+
+    def _error_line(self, index: int, entry_id: typing.Any, status: int, message: str) -> bytes:
+        return json.dumps({'index': index, 'id': entry_id, 'status': status, 'headers': [], 'error': message},
+                          separators=(',', ':')).encode('utf8') + b'\n'
@@ -23,6 +23,11 @@ class PathRegisterError(Exception):
     pass
 
 
+class AppFrozen(Exception):
+    '''The app is frozen, it is not possible to register anything anymore'''
+    pass
+
+
 class HTTPException(Exception):
     '''Base exception for all http errors to be handled by the error handlers'''
 
@@ -46,3 +51,9 @@ class HTTP404(HTTPException):
 class HTTP405(HTTPException):
     status_code = 405
     message = 'Method Not Allowed'
+
+
+class RecordTooLarge(HTTPException):
+    '''A record of a streamed request body is larger than the limit'''
+    status_code = 413
+    message = 'Record Too Large'
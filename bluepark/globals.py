@@ -1,3 +1,4 @@
+import contextvars
 import operator
 
 empty_object = object()
@@ -5,9 +6,7 @@ empty_object = object()
 
 def simple_proxy_method_proxy(func):
     def inner(self, *args):
-        if self._wrapped == empty_object:
-            raise RuntimeError('Proxy object is empty')
-        return func(self._wrapped, *args)
+        return func(self._get_wrapped(), *args)
 
     return inner
 
@@ -24,6 +23,11 @@ class SimpleProxy:
     def _wrap(self, obj):
         self._wrapped = obj
 
+    def _get_wrapped(self):
+        if self._wrapped is empty_object:
+            raise RuntimeError('Proxy object is empty')
+        return self._wrapped
+
     __getattr__ = simple_proxy_method_proxy(getattr)
     __delattr__ = simple_proxy_method_proxy(delattr)
 
@@ -31,7 +35,7 @@ class SimpleProxy:
         if name == '_wrapped':
             self.__dict__["_wrapped"] = value
         else:
-            setattr(self._wrapped, name, value)
+            setattr(self._get_wrapped(), name, value)
 
     __str__ = simple_proxy_method_proxy(str)
     __bool__ = simple_proxy_method_proxy(bool)
@@ -54,4 +58,44 @@ class SimpleProxy:
     __contains__ = simple_proxy_method_proxy(operator.contains)
 
 
-current_app = SimpleProxy()
+class ContextProxy(SimpleProxy):
+    '''
+    A proxy object for the value of a context variable, so every asyncio task sees its own object.
+
+    The object given to `_wrap` is used when the context variable is not set, outside of a request for example.
+    '''
+
+    def __init__(self, context_var: contextvars.ContextVar):
+        super().__init__()
+        self.__dict__['_context_var'] = context_var
+
+    def _get_wrapped(self):
+        obj = self._context_var.get(self._wrapped)
+        if obj is empty_object:
+            raise RuntimeError(f'Working outside of {self._context_var.name} context')
+        return obj
+
+
+# The app and the request that are being handled by the current asyncio task. They are set by the ASGI handlers.
+app_context: contextvars.ContextVar = contextvars.ContextVar('app')
+request_context: contextvars.ContextVar = contextvars.ContextVar('request')
+
+current_app = ContextProxy(app_context)
+current_request = ContextProxy(request_context)
+
+
+def get_current_app():
+    '''
+    Return the app that is handling the current request, or the last created app outside of a request.
+
+    It is faster than the attribute access through the `current_app` proxy, use it in hot code.
+    '''
+    app = app_context.get(current_app._wrapped)
+    if app is empty_object:
+        raise RuntimeError('No app is created')
+    return app
+
+
+def get_current_request():
+    '''Return the request that is being handled by the current asyncio task, or None.'''
+    return request_context.get(None)
@@ -0,0 +1,177 @@
+import asyncio
+import collections
+import sys
+import threading
+import time
+import traceback
+import typing
+
+from .response import JSONResponse
+from .tracing import REQUEST_START, ROUTE_MATCHED, RESPONSE_END
+from .utils.types import ASGIScope
+
+
+def _percentile(sorted_values: typing.Sequence[float], percent: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))
+    return sorted_values[index]
+
+
+class LoopMonitor:
+    '''
+    Measure the scheduling lag of the event loop and detect code that blocks it.
+
+    A task sleeps for `interval` seconds in a loop and records how late it is woken up. A watchdog thread checks
+    that task is still making progress, when it is not for more than `block_threshold` seconds, the stack of the
+    event loop thread is captured and attributed to the route of the request that is being handled.
+
+    Use `install` to start the monitor with the first request of an app and register `readiness_view` to report
+    the state of the loop.
+
+    :param interval: Seconds between two lag measurements.
+    :param block_threshold: Seconds the loop can be blocked before a blocking event is recorded.
+    :param unhealthy_lag: The loop is reported unhealthy when the median lag of the last `sustained_samples`
+    measurements is above this many seconds.
+    :param sustained_samples: Number of measurements to consider for health.
+    :param window: Number of lag measurements to keep for percentiles.
+    :param max_events: Number of blocking events to keep.
+    :param stack_limit: Number of frames to capture for blocking events.
+    '''
+
+    def __init__(self, interval: float = 0.1, block_threshold: float = 0.1, unhealthy_lag: float = 0.05,
+                 sustained_samples: int = 10, window: int = 600, max_events: int = 50,
+                 stack_limit: int = 30) -> None:
+        self.interval = interval
+        self.block_threshold = block_threshold
+        self.unhealthy_lag = unhealthy_lag
+        self.sustained_samples = sustained_samples
+        self.stack_limit = stack_limit
+
+        # Measured lags in seconds
+        self.lags: typing.Deque[float] = collections.deque(maxlen=window)
+        self.blocking_events: typing.Deque[dict] = collections.deque(maxlen=max_events)
+        self.blocking_event_count = 0
+
+        self._loop: typing.Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: typing.Optional[int] = None
+        self._task: typing.Optional[asyncio.Task] = None
+        self._watchdog: typing.Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+        self._heartbeat = 0.0
+        # The blocking event that is in progress, the watchdog records it and the loop completes its duration
+        self._current_block: typing.Optional[dict] = None
+        # Route names of the requests that are being handled by their task
+        self._routes: typing.MutableMapping[asyncio.Task, str] = {}
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def install(self, app) -> None:
+        '''Subscribe to the lifecycle hooks of the app. The monitor is started with the first request.'''
+        for event in (REQUEST_START, ROUTE_MATCHED, RESPONSE_END):
+            app.add_hook(event, self)
+
+    def __call__(self, event: str, timestamp: int, scope: ASGIScope, **details) -> None:
+        if event == REQUEST_START:
+            if not self.running:
+                self.start()
+        elif event == ROUTE_MATCHED:
+            self._routes[asyncio.current_task()] = details['rule'].rule_name
+        elif event == RESPONSE_END:
+            self._routes.pop(asyncio.current_task(), None)
+
+    def start(self) -> None:
+        '''Start measuring. It must be called from the event loop thread while the loop is running.'''
+        if self.running:
+            return
+        self._loop = asyncio.get_event_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._task = self._loop.create_task(self._measure())
+        self._stop_event.clear()
+        self._watchdog = threading.Thread(target=self._watch, name='bluepark-loop-watchdog', daemon=True)
+        self._watchdog.start()
+
+    def stop(self) -> None:
+        if not self.running:
+            return
+        self._task.cancel()
+        self._task = None
+        self._stop_event.set()
+        self._watchdog.join()
+        self._watchdog = None
+
+    async def _measure(self) -> None:
+        while True:
+            expected = self._loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, self._loop.time() - expected))
+            self._heartbeat = time.monotonic()
+
+            current_block = self._current_block
+            if current_block is not None:
+                self._current_block = None
+                current_block['duration'] = self._heartbeat - current_block['started']
+
+    def _watch(self) -> None:
+        while not self._stop_event.wait(self.block_threshold / 2):
+            if self._current_block is not None:
+                # Already recorded the current blocking event
+                continue
+            blocked_since = self._heartbeat + self.interval
+            if time.monotonic() - blocked_since < self.block_threshold:
+                continue
+
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = traceback.format_stack(frame, limit=self.stack_limit) if frame is not None else []
+            del frame
+            task = asyncio.current_task(self._loop)
+            self._current_block = {
+                'started': blocked_since,
+                'time': time.time(),
+                'duration': None,
+                'route': self._routes.get(task),
+                'stack': stack,
+            }
+            self.blocking_events.append(self._current_block)
+            self.blocking_event_count += 1
+
+    @property
+    def blocked(self) -> bool:
+        '''Whether the loop is blocked at the moment.'''
+        return self._current_block is not None
+
+    @property
+    def healthy(self) -> bool:
+        if self.blocked:
+            return False
+        recent = sorted(list(self.lags)[-self.sustained_samples:])
+        if len(recent) < self.sustained_samples:
+            return True
+        return _percentile(recent, 50) <= self.unhealthy_lag
+
+    def percentiles(self) -> typing.Dict[str, float]:
+        '''Return percentiles of the measured lags in seconds.'''
+        lags = sorted(self.lags)
+        return {
+            'p50': _percentile(lags, 50),
+            'p90': _percentile(lags, 90),
+            'p99': _percentile(lags, 99),
+            'max': lags[-1] if lags else 0.0,
+        }
+
+    def report(self) -> dict:
+        return {
+            'healthy': self.healthy,
+            'blocked': self.blocked,
+            'lag': self.percentiles(),
+            'blocking_event_count': self.blocking_event_count,
+            'blocking_events': list(self.blocking_events),
+        }
+
+    async def readiness_view(self, request) -> JSONResponse:
+        '''A view function that responds with 503 when the loop lag is sustained, 200 otherwise.'''
+        report = self.report()
+        return JSONResponse(report, status=200 if report['healthy'] else 503)
@@ -0,0 +1,226 @@
+import asyncio
+import functools
+import multiprocessing
+import os
+import time
+import typing
+from concurrent.futures import ProcessPoolExecutor
+
+from .request import HTTPRequest
+from .response import HTTPBaseResponse, JSONResponse, RawResponse
+from .utils.types import HTTPView
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:  # Python < 3.8
+    resource_tracker = shared_memory = None
+
+
+class OffloadedRequest:
+    '''
+    The part of a request that is sent to the worker process of an offloaded view.
+
+    Offloaded views are called with this object instead of the request, and the URL parameters as keyword arguments,
+    like `view(request, **params)`. They must be sync functions that can be pickled, functions defined at the top
+    level of a module.
+    '''
+    __slots__ = ('method', 'scheme', 'path', 'query_string', 'headers', 'body')
+
+    def __init__(self, request: HTTPRequest, body: typing.Optional[bytes]) -> None:
+        self.method = request.method
+        self.scheme = request.scheme
+        self.path = request.path
+        self.query_string = request.query_string
+        self.headers = request.headers
+        self.body = body
+
+
+def _write_shared(data: bytes) -> str:
+    '''Copy the data to a new shared memory block and return its name. The reader unlinks it.'''
+    block = shared_memory.SharedMemory(create=True, size=len(data))
+    try:
+        block.buf[:len(data)] = data
+        return block.name
+    finally:
+        block.close()
+
+
+def _read_shared(name: str, size: int, unlink: bool) -> bytes:
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        return bytes(block.buf[:size])
+    finally:
+        block.close()
+        if unlink:
+            block.unlink()
+
+
+def _unlink_shared(name: str) -> None:
+    block = shared_memory.SharedMemory(name=name)
+    block.close()
+    block.unlink()
+
+
+def _warm(views: typing.Sequence[HTTPView]) -> int:
+    '''Run in every worker at startup. Unpickling the views imports their modules.'''
+    return os.getpid()
+
+
+def _call_view(view_function: HTTPView, request: OffloadedRequest, params: dict,
+               shared_body: typing.Optional[typing.Tuple[str, int]], shared_memory_threshold: int) -> tuple:
+    '''
+    Call the view in the worker process and return the response as `(status, headers, body, shared body, seconds)`.
+    Bodies larger than the threshold are passed in shared memory instead of being pickled through the pipe.
+    '''
+    start = time.perf_counter()
+    if shared_body is not None:
+        request.body = _read_shared(*shared_body, unlink=False)
+
+    response: HTTPBaseResponse = view_function(request, **params)
+    headers = response.get_headers()
+    body = response.render()
+
+    shared_response_body = None
+    if shared_memory is not None and len(body) > shared_memory_threshold:
+        shared_response_body = (_write_shared(body), len(body))
+        body = None
+    return response.status, headers, body, shared_response_body, time.perf_counter() - start
+
+
+class OffloadPool:
+    '''
+    A pool of worker processes for CPU bound views, so they don't hold the GIL of the event loop thread and can use
+    all cores.
+
+    Register views with the `offload` argument of `route` or `add_rule`:
+
+        pool = OffloadPool(max_workers=4)
+        pool.install(app)
+
+        @router.route('/thumbnails/<int:size>/', methods=['POST'], offload=pool)
+        def thumbnail(request, size):
+            return RawResponse(resize(request.body, size), headers=[(b'content-type', b'image/png')])
+
+    The request body is received on the event loop and sent to the worker with the method, path, query string and
+    headers, see `OffloadedRequest`. The response is rendered in the worker and sent back as status, headers and body
+    bytes. Bodies larger than `shared_memory_threshold` bytes are passed in shared memory.
+
+    :param max_workers: Number of worker processes, defaults to the number of CPUs.
+    :param mp_context: Multiprocessing context, for example `multiprocessing.get_context('spawn')`.
+    :param shared_memory_threshold: Size in bytes above which bodies are passed in shared memory.
+    '''
+
+    def __init__(self, max_workers: int = None, mp_context: multiprocessing.context.BaseContext = None,
+                 shared_memory_threshold: int = 64 * 1024) -> None:
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.mp_context = mp_context
+        self.shared_memory_threshold = shared_memory_threshold
+        self.views: typing.List[HTTPView] = []
+        self._executor: typing.Optional[ProcessPoolExecutor] = None
+
+        self._started_at = time.monotonic()
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.in_flight = 0
+        # Seconds spent in views by the workers
+        self.busy_time = 0.0
+        # Bytes passed in shared memory
+        self.shared_memory_bytes = 0
+
+    def install(self, app) -> None:
+        '''Start the workers at the lifespan startup of the app and stop them at shutdown.'''
+        app.add_startup_handler(self.start)
+        app.add_shutdown_handler(self.stop)
+
+    def wrap(self, view_function: HTTPView) -> HTTPView:
+        '''Return an async view that calls the view function in the pool.'''
+        self.views.append(view_function)
+
+        @functools.wraps(view_function)
+        async def wrapper(request: HTTPRequest, **params) -> HTTPBaseResponse:
+            return await self.run(view_function, request, params)
+
+        return wrapper
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            if resource_tracker is not None:
+                # Workers must share the tracker of this process, otherwise their own trackers would report the shared
+                # memory blocks that are unlinked here as leaked
+                resource_tracker.ensure_running()
+            self._executor = ProcessPoolExecutor(self.max_workers, mp_context=self.mp_context)
+        return self._executor
+
+    async def start(self) -> None:
+        '''Start all workers and import the modules of the offloaded views in them.'''
+        executor = self._get_executor()
+        loop = asyncio.get_event_loop()
+        await asyncio.gather(*(loop.run_in_executor(executor, _warm, self.views) for _ in range(self.max_workers)))
+        self._started_at = time.monotonic()
+
+    async def stop(self) -> None:
+        if self._executor is not None:
+            executor, self._executor = self._executor, None
+            await asyncio.get_event_loop().run_in_executor(None, executor.shutdown)
+
+    async def run(self, view_function: HTTPView, request: HTTPRequest, params: dict) -> HTTPBaseResponse:
+        '''Call the view function in a worker and return its response.'''
+        body = await request.body_as_bytes()
+        shared_body = None
+        if shared_memory is not None and len(body) > self.shared_memory_threshold:
+            shared_body = (_write_shared(body), len(body))
+            body = None
+        offloaded_request = OffloadedRequest(request, body)
+
+        self.submitted += 1
+        self.in_flight += 1
+        loop = asyncio.get_event_loop()
+        try:
+            status, headers, body, shared_response_body, busy_time = await loop.run_in_executor(
+                self._get_executor(), _call_view, view_function, offloaded_request, params, shared_body,
+                self.shared_memory_threshold
+            )
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.in_flight -= 1
+            if shared_body is not None:
+                self.shared_memory_bytes += shared_body[1]
+                _unlink_shared(shared_body[0])
+
+        self.completed += 1
+        self.busy_time += busy_time
+        if shared_response_body is not None:
+            self.shared_memory_bytes += shared_response_body[1]
+            body = _read_shared(*shared_response_body, unlink=True)
+        return RawResponse(body, status=status, headers=headers)
+
+    @property
+    def queue_depth(self) -> int:
+        '''Number of calls waiting for a free worker.'''
+        return max(0, self.in_flight - self.max_workers)
+
+    @property
+    def utilization(self) -> float:
+        '''Ratio of the time the workers spent in views since the pool was started.'''
+        elapsed = time.monotonic() - self._started_at
+        return min(1.0, self.busy_time / (elapsed * self.max_workers)) if elapsed > 0 else 0.0
+
+    def report(self) -> dict:
+        return {
+            'workers': self.max_workers,
+            'busy_workers': min(self.in_flight, self.max_workers),
+            'queue_depth': self.queue_depth,
+            'utilization': round(self.utilization, 4),
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'failed': self.failed,
+            'busy_time': round(self.busy_time, 3),
+            'shared_memory_bytes': self.shared_memory_bytes,
+        }
+
+    async def view(self, request: HTTPRequest) -> JSONResponse:
+        '''A view that returns `report()`, register it on an admin route.'''
+        return JSONResponse(self.report())
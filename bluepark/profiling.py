@@ -0,0 +1,171 @@
+import asyncio
+import collections
+import cProfile
+import os
+import random
+import sys
+import threading
+import time
+import typing
+
+from .request import HTTPRequest
+from .response import HTTPBaseResponse
+from .utils.signing import get_signer, BadSignature
+from .utils.types import HTTPMiddleware, HTTPView
+
+# Message signed in the value of the profile header
+_PROFILE_MESSAGE = b'profile'
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})'
+
+
+class SamplingProfiler:
+    '''
+    Statistical profiler that samples the stack of a thread from a background thread.
+
+    The profiled thread is not interrupted, so the overhead is limited to the sampling thread holding the GIL for a
+    short time on each tick. Samples are aggregated as collapsed stacks, which can be rendered by flamegraph tools.
+
+    :param interval: Seconds between two samples.
+    :param thread_id: Identifier of the thread to sample. Defaults to the thread that calls `start`.
+    :param max_depth: Stacks deeper than this are truncated from the root.
+    '''
+
+    def __init__(self, interval: float = 0.005, thread_id: int = None, max_depth: int = 128) -> None:
+        self.interval = interval
+        self.thread_id = thread_id
+        self.max_depth = max_depth
+
+        # Number of samples by collapsed stack
+        self.samples: typing.Counter[str] = collections.Counter()
+        self._stop_event = threading.Event()
+        self._thread: typing.Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        '''Start sampling. Calling it when the profiler is running has no effect.'''
+        if self.running:
+            return
+        if self.thread_id is None:
+            self.thread_id = threading.get_ident()
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='bluepark-sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        '''Stop sampling. Samples collected so far are kept.'''
+        if not self.running:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+
+    def toggle(self) -> bool:
+        '''Start the profiler if it is stopped, stop it otherwise. Return whether it is running.'''
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+        return self.running
+
+    def reset(self) -> None:
+        self.samples = collections.Counter()
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.samples[self._collapse(frame)] += 1
+            # Do not keep a reference to the frame of the running thread
+            del frame
+
+    def _collapse(self, frame) -> str:
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            names.append(_frame_name(frame))
+            frame = frame.f_back
+        names.reverse()
+        return ';'.join(names)
+
+    def collapsed(self) -> str:
+        '''Return the samples in collapsed stack format, one `frame;frame;frame count` line for each stack.'''
+        return ''.join(f'{stack} {count}\n' for stack, count in self.samples.most_common())
+
+    def write_collapsed(self, path: str) -> None:
+        with open(path, 'w') as f:
+            f.write(self.collapsed())
+
+
+def profile_header_value(secret_key: str) -> str:
+    '''Return a signed value for the profile header that enables profiling of a single request.'''
+    return get_signer(secret_key).sign(_PROFILE_MESSAGE)
+
+
+class profile_middleware:
+    '''
+    Profile requests with cProfile and write the stats to `directory`, in a sub directory for each route.
+
+    A request is profiled when it has the profile header signed with `SESSION_SECRET_KEY` (see
+    `profile_header_value`) or when it is randomly picked by `sample_rate`. Stats files can be loaded with `pstats`.
+
+    cProfile is deterministic and profiles the whole thread, so other requests that are handled by the event loop
+    while the profiled request is waiting will show up in its stats as well. Only one request is profiled at a time.
+
+    :param directory: Directory to write `.prof` files into.
+    :param sample_rate: Ratio of the requests to profile, between 0 and 1.
+    :param header_name: Name of the request header that enables profiling.
+    :param max_age: Number of seconds a signed header value is valid for.
+    '''
+
+    def __init__(self, directory: str, sample_rate: float = 0.0, header_name: str = 'x-bluepark-profile',
+                 max_age: int = 300) -> None:
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.header_name = header_name.lower()
+        self.max_age = max_age
+        self._profiling = False
+
+    def _should_profile(self, request: HTTPRequest) -> bool:
+        if self._profiling:
+            return False
+        if self.sample_rate and random.random() < self.sample_rate:
+            return True
+
+        header_value = request.headers.get(self.header_name)
+        if header_value is None:
+            return False
+        signer = get_signer(request.app.settings['SESSION_SECRET_KEY'])
+        try:
+            return signer.unsign(header_value, max_age=self.max_age) == _PROFILE_MESSAGE
+        except BadSignature:
+            return False
+
+    async def __call__(self, request: HTTPRequest, nxt: typing.Union[HTTPMiddleware, HTTPView]) -> HTTPBaseResponse:
+        if not self._should_profile(request):
+            return await nxt()
+
+        self._profiling = True
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            try:
+                return await nxt()
+            finally:
+                profile.disable()
+                route = request.url_rule.rule_name if request.url_rule is not None else 'unmatched'
+                loop = asyncio.get_event_loop()
+                await loop.run_in_executor(None, self._dump, profile, route)
+        finally:
+            self._profiling = False
+
+    def _dump(self, profile: cProfile.Profile, route: str) -> None:
+        directory = os.path.join(self.directory, route)
+        os.makedirs(directory, exist_ok=True)
+        profile.dump_stats(os.path.join(directory, f'{time.time():.6f}-{os.getpid()}.prof'))
@@ -1,31 +1,55 @@
 import json
 import re
-from http.cookies import SimpleCookie
-from typing import Optional, AsyncGenerator
+from types import SimpleNamespace
+from typing import Any, AsyncGenerator, Callable, List, Optional, TYPE_CHECKING, Union
 
-from .app import BluePark
-from .exceptions import (HTTPConnectionClosed, BodyAlreadyReceived)
-from .utils.decorators import cached_property
+from .exceptions import (HTTPConnectionClosed, BodyAlreadyReceived, RecordTooLarge)
+from .utils.cookies import parse_cookie_header
 from .utils.types import ASGIScope, ASGIReceive, ASGIMessage
 
+if TYPE_CHECKING:
+    from .app import BluePark
+
 _media_type_from_content_type_re = re.compile(r'\s*(?P<mime>[^\s;]+)', re.I)
 _charset_from_content_type_re = re.compile(r';\s*charset=(?P<charset>[^\s;]+)', re.I)
 _boundary_from_content_type_re = re.compile(r';\s*boundary=(?P<boundary>[^\s;]+)', re.I)
 
+# Marks lazily computed attributes that can be None when they are computed
+_not_parsed = object()
+
+
+# Returned by the decoders of `_iter_records` for the records to skip
+_skip = object()
+
+
+def _decode_json_record(record: bytes) -> Any:
+    if not record or record.isspace():
+        return _skip
+    return json.loads(record)
+
 
 class BaseRequest:
-    headers: dict = None
+    __slots__ = ('app', 'scope', 'receive', '_header_encoding', '_headers', 'url_rule')
 
-    def __init__(self, app: BluePark, scope: ASGIScope, receive: ASGIReceive) -> None:
+    def __init__(self, app: 'BluePark', scope: ASGIScope, receive: ASGIReceive) -> None:
         self.app = app
         self.scope = scope
         self.receive = receive
 
         # charset encodings to be used
-        self._header_encoding = app.settings['DEFAULT_HEADER_ENCODING']
+        self._header_encoding = app.header_encoding
+
+        # a dict that holding header keys and values, parsed on first access
+        self._headers: Optional[dict] = None
 
-        # a dict that holding header keys and values
-        self.headers = {}
+        # The URL rule that matches the request path. It is set by the dispatcher after routing.
+        self.url_rule = None
+
+    @property
+    def headers(self) -> dict:
+        if self._headers is None:
+            self._parse_headers()
+        return self._headers
 
     def _parse_headers(self):
         '''
@@ -33,20 +57,31 @@ class BaseRequest:
 
         All header names are converted to lowercase by default.
         '''
-        self.headers = {header_name.decode(self._header_encoding).lower(): header_value.decode(self._header_encoding)
-                        for header_name, header_value in self.scope['headers']}
+        self._headers = {header_name.decode(self._header_encoding).lower(): header_value.decode(self._header_encoding)
+                         for header_name, header_value in self.scope['headers']}
 
 
 class HTTPHeaderParserMixin:
-    # Parsed content type header as dict
-    content_type: dict = None
+    # Attributes are stored in the slots of the request class
+    __slots__ = ()
 
-    # All request cookies as dict
-    cookies: dict = None
+    @property
+    def content_type(self) -> dict:
+        '''Parsed content type header as dict'''
+        if self._content_type is None:
+            self._parse_content_type()
+        return self._content_type
+
+    @property
+    def cookies(self) -> dict:
+        '''All request cookies as dict'''
+        if self._cookies is None:
+            self._parse_cookies()
+        return self._cookies
 
     def _parse_content_type(self) -> None:
         '''Parse Content-Type header and try to get mimetype. charset, boundary.'''
-        self.content_type = {}
+        self._content_type = {}
         content_type = self.headers.get('content-type', '')
 
         mime_re_result = _media_type_from_content_type_re.search(content_type)
@@ -54,43 +89,49 @@ class HTTPHeaderParserMixin:
         boundary_re_result = _boundary_from_content_type_re.search(content_type)
 
         if mime_re_result:
-            self.content_type['media-type'] = mime_re_result.group('mime')
+            self._content_type['media-type'] = mime_re_result.group('mime')
         if charset_re_result:
-            self.content_type['charset'] = charset_re_result.group('charset')
+            self._content_type['charset'] = charset_re_result.group('charset')
         if boundary_re_result:
-            self.content_type['boundary'] = boundary_re_result.group('boundary')
+            self._content_type['boundary'] = boundary_re_result.group('boundary')
 
     def _parse_cookies(self) -> None:
-        '''Parse Cookies header and build a dict.'''
-        self.cookies = {}
-        cookie_string = self.headers.get('cookie', '')
-        cookie_parser = SimpleCookie()
-        cookie_parser.load(cookie_string)
-
-        for key, obj in cookie_parser.items():
-            self.cookies[key] = obj.value
+        '''
+        Parse Cookie headers and build a dict. HTTP/2 clients can split the cookies into multiple headers, they are
+        read from the scope so none of them is lost.
+        '''
+        cookie_headers = [value for name, value in self.scope['headers'] if name.lower() == b'cookie']
+        if not cookie_headers:
+            self._cookies = {}
+        elif len(cookie_headers) == 1:
+            self._cookies = parse_cookie_header(cookie_headers[0].decode(self._header_encoding))
+        else:
+            self._cookies = parse_cookie_header('; '.join(value.decode(self._header_encoding)
+                                                          for value in cookie_headers))
 
     @property
     def charset(self) -> str:
         '''Charset to be used to decode request body, designated by content-type header.'''
-        return self.content_type.get('charset', self.app.settings['DEFAULT_REQUEST_CHARSET'])
+        return self.content_type.get('charset', self.app.request_charset)
 
     @property
     def media_type(self) -> Optional[str]:
         '''Return the media-type of the request designated by content-type header.'''
         return self.content_type.get('media-type', None)
 
-    @cached_property
+    @property
     def content_length(self) -> Optional[int]:
         '''Return CONTENT-LENGTH header as int or None.'''
-        content_length = self.headers.get('content-length', None)
+        if self._content_length is _not_parsed:
+            self._content_length = None
+            content_length = self.headers.get('content-length', None)
 
-        if content_length is not None:
-            try:
-                return max(0, int(content_length))
-            except (ValueError, TypeError):
-                pass
-        return None
+            if content_length is not None:
+                try:
+                    self._content_length = max(0, int(content_length))
+                except (ValueError, TypeError):
+                    pass
+        return self._content_length
 
     @property
     def _form_boundary(self) -> Optional[str]:
@@ -98,37 +139,64 @@ class HTTPHeaderParserMixin:
 
 
 class HTTPBaseRequest(BaseRequest, HTTPHeaderParserMixin):
-    # Boolean value signifying if there is additional content to come (as part of a Request message
-    _has_more_body = True
+    __slots__ = (
+        'method', 'scheme', 'http_version', 'path', '_query_string', 'script_path',
+        '_has_more_body', 'body', 'text', 'json',
+        '_content_type', '_cookies', '_content_length', 'session', '_state',
+    )
 
-    # All http body in bytes
-    body: bytes = None
+    def __init__(self, app: 'BluePark', scope: ASGIScope, receive: ASGIReceive) -> None:
+        super().__init__(app, scope, receive)
 
-    # Body as string
-    text: str = None
+        # Boolean value signifying if there is additional content to come (as part of a Request message
+        self._has_more_body = True
 
-    # Body as json object
-    json: dict = None
+        # All http body in bytes
+        self.body: Optional[bytes] = None
 
-    def __init__(self, app: BluePark, scope: ASGIScope, receive: ASGIReceive) -> None:
-        super().__init__(app, scope, receive)
+        # Body as string
+        self.text: Optional[str] = None
+
+        # Body as json object
+        self.json: Optional[dict] = None
+
+        # Headers are parsed lazily, on first access
+        self._content_type: Optional[dict] = None
+        self._cookies: Optional[dict] = None
+        self._content_length = _not_parsed
+
+        # Session object, it is set by the session middleware
+        self.session = None
+        self._state: Optional[SimpleNamespace] = None
 
-        # Order of the method calls below is important.
         self._parse_scope()
-        self._parse_headers()
-        self._parse_content_type()
-        self._parse_cookies()
 
     def _parse_scope(self) -> None:
         '''Define ASGI attributes for the request'''
+        scope = self.scope
+        self.method = scope.get('method', '')
+        self.scheme = scope.get('scheme', 'http')
+        self.http_version = scope.get('http_version', '1.1')
+        self.path = scope.get('path')
+        self._query_string = None
+        self.script_path = scope.get('root_path', '')
 
-        self.method = self.scope.get('method', '')
-        self.scheme = self.scope.get('scheme', 'http')
-        self.http_version = self.scope.get('http_version', '1.1')
-        self.path = self.scope.get('path')
-        self.query_string = self.scope.get('query_string', b'').decode(self._header_encoding)
-        self.full_path = self.path + self.query_string
-        self.script_path = self.scope.get('root_path', '')
+    @property
+    def query_string(self) -> str:
+        if self._query_string is None:
+            self._query_string = self.scope.get('query_string', b'').decode(self._header_encoding)
+        return self._query_string
+
+    @property
+    def full_path(self) -> str:
+        return self.path + self.query_string
+
+    @property
+    def state(self) -> SimpleNamespace:
+        '''A namespace for middleware and views to store arbitrary data for the request.'''
+        if self._state is None:
+            self._state = SimpleNamespace()
+        return self._state
 
     async def next_http_message(self) -> ASGIMessage:
         '''Receive and return next http message. Raise exception if the connection is closed.'''
@@ -144,10 +212,10 @@ class HTTPBaseRequest(BaseRequest, HTTPHeaderParserMixin):
         return {}
 
     async def stream_http_body(self) -> AsyncGenerator[bytes, None]:
-        '''Await for next http message and yield the body until `has_more_body` is False.'''
+        '''Await for next http message and yield the body until `more_body` is False.'''
         while self._has_more_body:
             message = await self.next_http_message()
-            self._has_more_body = message.get('has_more_body', False)
+            self._has_more_body = message.get('more_body', False)
             yield message.get('body', b'')
 
     async def receive_http_body(self) -> None:
@@ -155,9 +223,10 @@ class HTTPBaseRequest(BaseRequest, HTTPHeaderParserMixin):
         if not self._has_more_body:
             raise BodyAlreadyReceived()
 
-        self.body = b''
+        chunks = []
         async for body in self.stream_http_body():
-            self.body += body
+            chunks.append(body)
+        self.body = b''.join(chunks)
 
     async def body_as_bytes(self) -> Optional[bytes]:
         '''
@@ -203,7 +272,101 @@ class HTTPBaseRequest(BaseRequest, HTTPHeaderParserMixin):
 
         return self.json
 
+    async def _record_chunks(self, max_record_size: Optional[int]) -> AsyncGenerator[List[bytes], None]:
+        '''
+        Yield the complete lines of every chunk of the body without the line endings, as the body is received. Only
+        a chunk and the current record are kept in memory, a record longer than `max_record_size` raises
+        `RecordTooLarge`.
+        '''
+        if max_record_size is None:
+            max_record_size = self.app.settings['MAX_RECORD_SIZE']
+        too_large = f'Records can be at most {max_record_size} bytes'
+
+        # The start of a record that continues in the next chunk
+        partial = bytearray()
+        async for chunk in self._body_chunks():
+            records = chunk.split(b'\n')
+            if len(records) == 1:
+                partial += chunk
+                if len(partial) > max_record_size:
+                    raise RecordTooLarge(message=too_large)
+                continue
+            if partial:
+                partial += records[0]
+                records[0] = bytes(partial)
+                partial.clear()
+            # The last one is not complete, it is the start of the next record or empty
+            partial += records.pop()
+            if len(partial) > max_record_size:
+                raise RecordTooLarge(message=too_large)
+
+            for index, record in enumerate(records):
+                if len(record) > max_record_size:
+                    raise RecordTooLarge(message=too_large)
+                if record.endswith(b'\r'):
+                    records[index] = record[:-1]
+            yield records
+
+        if partial:
+            yield [bytes(partial[:-1] if partial.endswith(b'\r') else partial)]
+
+    async def _body_chunks(self) -> AsyncGenerator[bytes, None]:
+        '''The body if it is already received, otherwise the chunks of the body as they are received.'''
+        if self.body is not None:
+            yield self.body
+        else:
+            async for chunk in self.stream_http_body():
+                yield chunk
+
+    async def _iter_records(self, decode: Callable[[bytes], Any], max_record_size: Optional[int],
+                            batch_size: Optional[int]) -> AsyncGenerator[Any, None]:
+        '''Yield the decoded records, or lists of up to `batch_size` of them. Records decoded to `_skip` are skipped.'''
+        number = 0
+        batch = []
+        async for records in self._record_chunks(max_record_size):
+            for record in records:
+                number += 1
+                try:
+                    item = decode(record)
+                except ValueError as e:
+                    raise ValueError(f'Record {number} can not be decoded: {e}') from e
+                if item is _skip:
+                    continue
+                if not batch_size:
+                    yield item
+                    continue
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+    def iter_lines(self, max_record_size: int = None,
+                   batch_size: int = None) -> AsyncGenerator[Union[str, List[str]], None]:
+        '''
+        Yield the lines of the body decoded with `self.charset`, as the body is received, so large bodies are read in
+        constant memory. Line endings are removed.
+
+        :param max_record_size: Maximum size of a line in bytes, defaults to the `MAX_RECORD_SIZE` setting. A longer
+            line raises `RecordTooLarge`, that is turned into a 413 response by the default error handler.
+        :param batch_size: Yield lists of up to this many lines instead of single lines.
+        '''
+        charset = self.charset
+        return self._iter_records(lambda record: record.decode(charset), max_record_size, batch_size)
+
+    def iter_ndjson(self, max_record_size: int = None,
+                    batch_size: int = None) -> AsyncGenerator[Union[Any, List[Any]], None]:
+        '''
+        Yield the records of a newline delimited JSON body, as the body is received. Empty lines are skipped. A record
+        that is not valid JSON raises `ValueError` with its number.
+
+        :param max_record_size: Maximum size of a record in bytes, defaults to the `MAX_RECORD_SIZE` setting.
+        :param batch_size: Yield lists of up to this many records, for example to insert them in bulk.
+        '''
+        return self._iter_records(_decode_json_record, max_record_size, batch_size)
+
 
 class HTTPRequest(HTTPBaseRequest):
     '''HTTP 1.1 Request'''
-    pass
+    __slots__ = ()
@@ -1,36 +1,71 @@
+import datetime
 import json
 import typing
-from http.cookies import SimpleCookie
 
-from . import current_app
+from .globals import get_current_app
+from .settings import DEFAULT_SETTINGS
 from .exceptions import HTTPResponseAlreadyStarted
+from .utils.cookies import set_cookie_header
 from .utils.structures import CaseInsensitiveDict
 from .utils.types import ASGIHeaders
 
 
 class HTTPBaseResponse:
+    __slots__ = ('status', '_mime_type', 'charset', '_header_encoding', '_response_started', '_headers',
+                 '_extra_headers', '_rendered_body')
+
+    # Default mime type of the response class. It can be overridden for a response with the `mime_type` argument.
     mime_type = None
 
+    # Streaming responses send their body in chunks from `iter_chunks` and can't be rendered
+    streaming = False
+
+    # Frozen responses are sent with the prebuilt ASGI messages in `messages` and can't be changed
+    frozen = False
+
     def __init__(self, status: int = 200, mime_type: str = None) -> None:
         self.status = status
-        if mime_type is not None:
-            self.mime_type = mime_type
+        self._mime_type = mime_type if mime_type is not None else self.mime_type
+
+        # Settings are resolved by the app once, see `BluePark._resolve_settings`
+        try:
+            app = get_current_app()
+        except RuntimeError:
+            # There is no app in the worker processes of an offload pool, unless the module of the view creates one
+            self._header_encoding = DEFAULT_SETTINGS['DEFAULT_HEADER_ENCODING']
+            self.charset = DEFAULT_SETTINGS['DEFAULT_RESPONSE_CHARSET']
+        else:
+            self._header_encoding = app.header_encoding
+            self.charset = app.response_charset
 
-        self._header_encoding = current_app.settings['DEFAULT_HEADER_ENCODING']
         self._response_started = False
-        self.headers = CaseInsensitiveDict()
-        self._extra_headers = []
-        self.charset = current_app.settings['DEFAULT_RESPONSE_CHARSET']
+        # Created on first use, most responses do not have custom headers or cookies. The extra headers, the cookies,
+        # are already encoded.
+        self._headers: typing.Optional[CaseInsensitiveDict] = None
+        self._extra_headers: typing.Optional[ASGIHeaders] = None
+
+        # Body encoded by `render`
+        self._rendered_body: typing.Optional[bytes] = None
+
+    @property
+    def headers(self) -> CaseInsensitiveDict:
+        if self._headers is None:
+            self._headers = CaseInsensitiveDict()
+        return self._headers
 
     def get_headers(self) -> ASGIHeaders:
         '''Return the list of headers in ASGI header format.'''
-        headers = []
-        self.headers.setdefault('content-type', self._content_type)
-        for name, value in self.headers.items():
-            headers.append((name.encode(self._header_encoding), value.encode(self._header_encoding)))
+        encoding = self._header_encoding
+        if self._headers is None:
+            headers = [(b'content-type', self._content_type.encode(encoding))]
+        else:
+            headers = []
+            self._headers.setdefault('content-type', self._content_type)
+            for name, value in self._headers.items():
+                headers.append((name.encode(encoding), value.encode(encoding)))
 
-        for name, value in self._extra_headers:
-            headers.append((name.encode(self._header_encoding), value.encode(self._header_encoding)))
+        if self._extra_headers is not None:
+            headers.extend(self._extra_headers)
         return headers
 
     def set_cookie(
@@ -38,7 +73,7 @@ class HTTPBaseResponse:
             key: str,
             value: str = '',
             max_age: int = None,
-            expires: typing.Union[int, str] = None,
+            expires: typing.Union[int, datetime.datetime, str] = None,
             path: str = '/',
             domain: str = None,
             secure: bool = False,
@@ -51,46 +86,48 @@ class HTTPBaseResponse:
         :param key: The key of the cookie.
         :param value: The value of the cookie.
         :param max_age: Number of seconds. Expires cookie after that much seconds.
-        :param expires: Should be a datetime object or UNIX timestamp.
+        :param expires: A datetime, a number of seconds from now, or a date string in the HTTP format.
         :param path: Limits the cookie to a given path.
         :param domain: Specifies allowed hosts to receive the cookie. If unspecified, it defaults to the host of the
         current document location, excluding subdomains.
         :param secure: If True, the cookie will only be available on HTTPS.
         :param http_only: If True cookies are inaccessible to JavaScript's document.cookie.
         :param same_site: Let servers require that a cookie shouldn't be sent with cross-site requests. The same-site
-        attribute can have one of two values: `strict` or `lax`.
+        attribute can have one of three values: `strict`, `lax` or `none`.
         '''
         if self._response_started:
             raise HTTPResponseAlreadyStarted("You can't set cookie after response has started")
 
-        cookie = SimpleCookie()
-        cookie[key] = value
-        cookie[key]['path'] = path
-        if max_age is not None:
-            cookie[key]['max-age'] = max_age
-        if expires is not None:
-            cookie[key]['expires'] = expires
-        if domain is not None:
-            cookie[key]['domain'] = domain
-        if secure:
-            cookie[key]['secure'] = True
-        if http_only:
-            cookie[key]['httponly'] = True
-
-        cookie_string = cookie.output(header='').strip()
-        if same_site is not None:
-            cookie_string = cookie_string.rstrip(';') + f'; SameSite={same_site}'
-        self._extra_headers.append(('set-cookie', cookie_string))
+        cookie = set_cookie_header(key, value, max_age, expires, path, domain, secure, http_only, same_site,
+                                   self._header_encoding)
+        if self._extra_headers is None:
+            self._extra_headers = []
+        self._extra_headers.append((b'set-cookie', cookie))
 
     @property
     def _content_type(self):
-        return f'{self.mime_type}; charset={self.charset}'
+        return f'{self._mime_type}; charset={self.charset}'
 
     def body_as_bytes(self) -> bytes:
         raise NotImplementedError()
 
+    def render(self) -> bytes:
+        '''
+        Return the body as bytes. The body is encoded once, so middleware can read the body without encoding it
+        again when it is sent. The content should not be changed after the body is rendered.
+        '''
+        if self._rendered_body is None:
+            self._rendered_body = self.body_as_bytes()
+        return self._rendered_body
+
+    def freeze(self) -> 'FrozenResponse':
+        '''Return a `FrozenResponse` of this response, see `FrozenResponse`.'''
+        return FrozenResponse(self)
+
 
 class TextResponse(HTTPBaseResponse):
+    __slots__ = ('content',)
+
     mime_type = 'text/html'
 
     def __init__(self, content: str, *args, **kwargs):
@@ -102,6 +139,8 @@ class TextResponse(HTTPBaseResponse):
 
 
 class JSONResponse(HTTPBaseResponse):
+    __slots__ = ('content',)
+
     mime_type = 'application/json'
 
     def __init__(self, content: dict, *args, **kwargs):
@@ -110,3 +149,125 @@ class JSONResponse(HTTPBaseResponse):
 
     def body_as_bytes(self) -> bytes:
         return json.dumps(self.content, ensure_ascii=False, separators=(",", ":")).encode(self.charset)
+
+
+class RawResponse(HTTPBaseResponse):
+    '''A response with a body that is already encoded and headers that are already in ASGI format.'''
+    __slots__ = ('body', 'raw_headers')
+
+    def __init__(self, body: bytes, status: int = 200, headers: ASGIHeaders = ()) -> None:
+        super().__init__(status)
+        self.body = body
+        self.raw_headers = list(headers)
+
+    def get_headers(self) -> ASGIHeaders:
+        encoding = self._header_encoding
+        headers = list(self.raw_headers)
+        if self._headers is not None:
+            for name, value in self._headers.items():
+                headers.append((name.encode(encoding), value.encode(encoding)))
+        if self._extra_headers is not None:
+            headers.extend(self._extra_headers)
+        return headers
+
+    def body_as_bytes(self) -> bytes:
+        return self.body
+
+
+class StreamingResponse(HTTPBaseResponse):
+    '''
+    A response with a body that is sent in chunks as `content` yields them. `content` is an async iterable of bytes or
+    strings, strings are encoded with the charset of the response.
+
+    The body is not known before it is sent, `render` raises `TypeError`.
+    '''
+    __slots__ = ('content',)
+
+    mime_type = 'text/plain'
+    streaming = True
+
+    def __init__(self, content: typing.AsyncIterable[typing.Union[bytes, str]], *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.content = content
+
+    def body_as_bytes(self) -> bytes:
+        raise TypeError('The body of a streaming response is only available by `iter_chunks`')
+
+    async def iter_chunks(self) -> typing.AsyncIterator[bytes]:
+        async for chunk in self.content:
+            yield chunk.encode(self.charset) if isinstance(chunk, str) else chunk
+
+
+class FrozenResponse(HTTPBaseResponse):
+    '''
+    A response for constant bodies, like configuration or health checks. The body and the headers are rendered once
+    and the ASGI `http.response.start` and `http.response.body` messages are built when it is created, the same
+    instance is returned by every request:
+
+        flags = {'new_checkout': False}
+        flags_response = JSONResponse(flags).freeze()
+
+        @router.route('/flags/')
+        async def get_flags(request):
+            return flags_response
+
+    `refresh` renders the messages again after the content of the response changed, or from a new response:
+
+        flags['new_checkout'] = True
+        flags_response.refresh()
+
+    A frozen response can't be changed, `set_cookie` and `headers` raise `TypeError`. `thaw` returns a `RawResponse`
+    with the same status, headers and body that can be changed, the session middleware uses it to set its cookie.
+
+    :param response: The response to freeze, it can't be a streaming response.
+    '''
+    __slots__ = ('response', 'messages')
+
+    frozen = True
+
+    def __init__(self, response: HTTPBaseResponse) -> None:
+        super().__init__(response.status)
+        self.response = response
+        # The `http.response.start` and `http.response.body` messages, replaced together by `refresh`
+        self.messages: typing.Tuple[dict, dict] = ({}, {})
+        self.refresh()
+
+    def refresh(self, response: HTTPBaseResponse = None) -> None:
+        '''
+        Render the messages again, from `response` if it is given, otherwise from the content of the frozen response.
+        '''
+        if response is not None:
+            self.response = response
+        response = self.response
+        if response.streaming or response.frozen:
+            raise TypeError('Only responses with a body that can be rendered can be frozen')
+
+        response._rendered_body = None
+        body = response.render()
+        self.status = response.status
+        self.messages = (
+            # The messages are shared by all requests, the headers are a tuple so they are not changed by mistake
+            {'type': 'http.response.start', 'status': response.status, 'headers': tuple(response.get_headers())},
+            {'type': 'http.response.body', 'body': body, 'more_body': False},
+        )
+
+    def thaw(self) -> RawResponse:
+        '''Return a response with the same status, headers and body that can be changed.'''
+        start, body = self.messages
+        return RawResponse(body['body'], status=start['status'], headers=start['headers'])
+
+    @property
+    def headers(self) -> CaseInsensitiveDict:
+        raise TypeError("A frozen response can't be changed, use `thaw` to get a copy")
+
+    def set_cookie(self, *args, **kwargs) -> None:
+        raise TypeError("A frozen response can't be changed, use `thaw` to get a copy")
+
+    def get_headers(self) -> ASGIHeaders:
+        return list(self.messages[0]['headers'])
+
+    def body_as_bytes(self) -> bytes:
+        return self.messages[1]['body']
+
+    def render(self) -> bytes:
+        return self.messages[1]['body']
@@ -1,17 +1,31 @@
+import hashlib
+import json
+import os
 import re
+import types
 import typing
 
-from .exceptions import PathRegisterError
-from .utils.converters import CONVERTERS
-from .utils.types import RequestMethods, HTTPView
+from .exceptions import PathRegisterError, AppFrozen
+from .utils.concurrency import ensure_async_view, ensure_async_middleware
+from .utils.converters import CONVERTERS, BaseConverter, IntConverter, StringConverter, UUIDConverter
+from .utils.types import RequestMethods, HTTPView, HTTPMiddleware
+
+if typing.TYPE_CHECKING:
+    from .offload import OffloadPool
 
 _PATH_PARAM_REGEX = re.compile(
     r'<(?:(?P<type>[^>:]+):)?(?P<name>\w+)>'
 )
 
+# Bump when the format of the route cache file changes
+ROUTE_CACHE_VERSION = 1
+
+# Paths with these characters are matched as regular expressions, so they can't be looked up by the path
+_REGEX_SPECIAL_CHARS = frozenset('.^$*+?{}[]\\|()')
+
 
-def _parse_path(path: str) -> typing.Tuple[typing.Pattern, dict]:
-    '''Return path string as regex and converters'''
+def _parse_path(path: str) -> typing.Tuple[str, dict]:
+    '''Return path string as regex source and converters'''
     path_regex = '^'
     converters = {}
     last_index = 0
@@ -32,30 +46,174 @@ def _parse_path(path: str) -> typing.Tuple[typing.Pattern, dict]:
         last_index = match.end()
 
     path_regex += f'{path[last_index:]}$'
-    return re.compile(path_regex), converters
+    return path_regex, converters
+
+
+def _literal_prefix(path: str) -> str:
+    '''Return the beginning of the path that is matched literally by its regex.'''
+    match = _PATH_PARAM_REGEX.search(path)
+    if match:
+        path = path[:match.start()]
+    for index, char in enumerate(path):
+        if char in _REGEX_SPECIAL_CHARS:
+            return path[:index]
+    return path
+
+
+# Converters that match one or more characters of a single path segment
+_SEGMENT_CONVERTERS = (IntConverter, StringConverter, UUIDConverter)
+
+# A path segment, the string of a literal segment, or the literal strings and the converters of the other segments
+_Segment = typing.Union[str, typing.Tuple[typing.Union[str, BaseConverter], ...]]
+
+
+def _split_segments(path: str) -> typing.Tuple[typing.List[_Segment], bool]:
+    '''
+    Split the path at the slashes. Return the segments, and whether every segment is matched without the slashes
+    around it and without regular expression characters.
+    '''
+    segments = []
+    is_regular = True
+    for segment in path.split('/'):
+        if '<' not in segment:
+            segments.append(segment)
+            is_regular = is_regular and _REGEX_SPECIAL_CHARS.isdisjoint(segment)
+            continue
+        tokens = []
+        last_index = 0
+        for match in _PATH_PARAM_REGEX.finditer(segment):
+            if match.start() > last_index:
+                tokens.append(segment[last_index:match.start()])
+            tokens.append(CONVERTERS[match.group('type')])
+            last_index = match.end()
+        if last_index < len(segment):
+            tokens.append(segment[last_index:])
+        segments.append(tuple(tokens))
+        is_regular = is_regular and _is_regular_segment(segments[-1])
+    return segments, is_regular
+
+
+def _is_regular_segment(segment: _Segment) -> bool:
+    if isinstance(segment, str):
+        return _REGEX_SPECIAL_CHARS.isdisjoint(segment)
+    return all(_REGEX_SPECIAL_CHARS.isdisjoint(token) if isinstance(token, str)
+               else type(token) in _SEGMENT_CONVERTERS for token in segment)
+
+
+def _segment_covers(segment: _Segment, other: _Segment) -> bool:
+    '''Whether every string that `other` matches is matched by `segment`. Only obvious cases are detected.'''
+    if segment == other:
+        return True
+    if isinstance(segment, str) or not _is_regular_segment(segment) or not _is_regular_segment(other):
+        return False
+    if isinstance(other, str):
+        pattern = ''.join(token if isinstance(token, str) else token.regex for token in segment)
+        return re.fullmatch(pattern, other) is not None
+    # Any segment that is not empty
+    return len(segment) == 1 and type(segment[0]) is StringConverter
+
+
+def _segments_cover(segments: typing.Sequence[_Segment], other: typing.Sequence[_Segment]) -> bool:
+    '''Whether every path that `other` matches is matched by `segments`. Only obvious cases are detected.'''
+    for index, segment in enumerate(segments):
+        if index == len(segments) - 1 and segment == (CONVERTERS['path'],):
+            # A path parameter at the end matches the rest of any path that is not empty
+            rest = other[index:]
+            return len(rest) > 1 or (len(rest) == 1 and rest[0] != '' and
+                                     all(not isinstance(token, str) or _REGEX_SPECIAL_CHARS.isdisjoint(token)
+                                         for token in rest[0]))
+        if index >= len(other) or not _segment_covers(segment, other[index]):
+            return False
+    return len(segments) == len(other)
+
+
+class _RuleNode:
+    '''A node of the tree of dynamic rules that `MainRouter._build_tables` finds the shadowing rules with.'''
+    __slots__ = ('literals', 'patterns', 'rule')
+
+    def __init__(self) -> None:
+        # Child nodes of the literal segments by their string, and of the other segments by their tokens
+        self.literals: typing.Dict[str, '_RuleNode'] = {}
+        self.patterns: typing.Dict[_Segment, '_RuleNode'] = {}
+        # The first rule whose segments end at this node
+        self.rule: typing.Optional['URLRule'] = None
+
+    def add(self, segments: typing.Sequence[_Segment], rule: 'URLRule') -> None:
+        node = self
+        for segment in segments:
+            children = node.literals if isinstance(segment, str) else node.patterns
+            child = children.get(segment)
+            if child is None:
+                child = children[segment] = _RuleNode()
+            node = child
+        if node.rule is None:
+            node.rule = rule
+
+    def covering_rules(self, segments: typing.Sequence[_Segment]) -> typing.List['URLRule']:
+        '''Return the rules that match every path that the segments match.'''
+        nodes = [self]
+        for segment in segments:
+            next_nodes = []
+            for node in nodes:
+                if isinstance(segment, str):
+                    child = node.literals.get(segment)
+                    if child is not None:
+                        next_nodes.append(child)
+                if node.patterns:
+                    next_nodes.extend(child for pattern, child in node.patterns.items()
+                                      if _segment_covers(pattern, segment))
+            if not next_nodes:
+                return []
+            nodes = next_nodes
+        return [node.rule for node in nodes if node.rule is not None]
 
 
 class URLRule:
-    '''Represents a registered URL(path).'''
+    '''
+    Represents a registered URL(path).
+
+    The regex is compiled on first use, so registering thousands of rules does not pay for compiling the rules that
+    are never tried. `literal_prefix` lets the router skip a rule without running its regex.
+
+    `middleware` are the middleware of the router followed by the middleware of the route. They run after the app
+    middleware, only for the requests that match this rule.
+    '''
+    __slots__ = ('original_path', 'pattern', '_regex', 'literal_prefix', 'converters', 'view_function', 'rule_name',
+                 'methods', 'parsed_params', 'middleware')
 
     def __init__(
             self,
             original_path: str,
-            regex: typing.Pattern,
+            pattern: str,
             converters: dict,
             view_function: HTTPView,
             rule_name: str,
-            methods: RequestMethods
+            methods: RequestMethods,
+            middleware: typing.Sequence[HTTPMiddleware] = ()
     ):
         self.original_path = original_path
-        self.regex = regex
+        self.pattern = pattern
+        self._regex: typing.Optional[typing.Pattern] = None
+        self.literal_prefix = _literal_prefix(original_path)
         self.converters = converters
         self.view_function = view_function
         self.rule_name = rule_name
         self.methods = methods
+        self.middleware = tuple(middleware)
 
         self.parsed_params: dict = None
 
+    @property
+    def regex(self) -> typing.Pattern:
+        if self._regex is None:
+            self._regex = re.compile(self.pattern)
+        return self._regex
+
+    @property
+    def is_static(self) -> bool:
+        '''Whether the path is matched by string equality.'''
+        return not self.converters and self.literal_prefix == self.original_path
+
     def is_method_allowed(self, method: str):
         '''Return whether the `method` is in `self.methods` or not.'''
         return method in self.methods
@@ -65,6 +223,8 @@ class URLRule:
         Return True if path matches the regex.
         Parse URL parameters and build a dict with their converted values for later use.
         '''
+        if not path.startswith(self.literal_prefix):
+            return False
         match = self.regex.match(path)
         if match:
             params = match.groupdict()
@@ -73,19 +233,62 @@ class URLRule:
         return False
 
 
+def _route_table_key(rules: typing.Sequence[URLRule]) -> str:
+    '''
+    Return a hash of everything the routing tables are built from. The patterns are made of the paths and the
+    converters, they are not hashed.
+    '''
+    digest = hashlib.sha256(f'{ROUTE_CACHE_VERSION}\n'.encode('utf-8'))
+    digest.update(''.join(f'{name}\0{converter.regex}\n' for name, converter in sorted(CONVERTERS.items()))
+                  .encode('utf-8'))
+    # Most rules have the same methods, they are sorted once
+    methods = {}
+    for rule_methods in {rule.methods for rule in rules}:
+        methods[rule_methods] = ','.join(sorted(rule_methods))
+    # Fields are separated with characters that can't be in the names, the paths or the methods
+    digest.update(''.join(f'{rule.rule_name}\0{rule.original_path}\0{methods[rule.methods]}\n' for rule in rules)
+                  .encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _save_route_table(cache_path: str, cache_key: str, tables: typing.Tuple[list, list]) -> None:
+    '''Write the routing tables to the cache file. Workers may race to write it, so it is replaced atomically.'''
+    static_rules, dynamic_rules = tables
+    cache = {
+        'key': cache_key,
+        'static': [rule.rule_name for rule in static_rules],
+        'dynamic': [rule.rule_name for rule in dynamic_rules],
+    }
+    temp_path = f'{cache_path}.{os.getpid()}.tmp'
+    try:
+        with open(temp_path, 'w') as f:
+            json.dump(cache, f)
+        os.replace(temp_path, cache_path)
+    except OSError:
+        # The cache only saves time on the next start, it is not worth failing the startup
+        pass
+
+
 class BaseRouter:
     # Default HTTP methods to be used
     _default_http_methods = ('GET', 'HEAD', 'OPTIONS')
 
-    def __init__(self, default_http_methods: RequestMethods = None, prefix: str = '/') -> None:
+    def __init__(self, default_http_methods: RequestMethods = None, prefix: str = '/',
+                 middleware: typing.Sequence[HTTPMiddleware] = (), pool: str = None) -> None:
         # Holds all of the url rules for this router
         self._rules: typing.MutableMapping[str, URLRule] = {}
 
+        # Name of the app thread pool to run the sync views and middleware of this router in
+        self.pool = pool
+
+        # Middleware to run only for the rules of this router, after the app middleware
+        self.middleware = tuple(ensure_async_middleware(m, pool) for m in middleware)
+
         # Prefix to be added the beginning of every url registered using this router
         self.prefix = self.normalize_prefix(prefix)
 
         if default_http_methods is not None:
-            self._default_http_methods = (method.upper() for method in default_http_methods)
+            self._default_http_methods = tuple(method.upper() for method in default_http_methods)
 
     def normalize_prefix(self, prefix: str) -> str:
         '''Check if prefix has leading slash. Remove trailing slash.'''
@@ -109,15 +312,21 @@ class BaseRouter:
         '''Return given path with prefix.'''
         return f'{self.prefix.rstrip("/")}{path}'
 
-    def add_rule(self, path: str, view_function: HTTPView,
-                 rule_name: str = None, methods: RequestMethods = None) -> None:
+    def add_rule(self, path: str, view_function: HTTPView, rule_name: str = None, methods: RequestMethods = None,
+                 middleware: typing.Sequence[HTTPMiddleware] = (), pool: str = None,
+                 offload: 'OffloadPool' = None) -> None:
         '''
         Add a new url rule to the rules.
 
+        Sync view functions and middleware are called in a thread pool of the app, see `BluePark.add_thread_pool`.
+
         :param path:
         :param view_function:
         :param rule_name:
         :param methods:
+        :param middleware: Middleware to run only for this rule, after the app and the router middleware.
+        :param pool: Name of the thread pool for the sync view and middleware, defaults to the pool of the router.
+        :param offload: A process pool to call the view in, for CPU bound views, see `bluepark.offload.OffloadPool`.
         '''
 
         if rule_name is None:
@@ -129,29 +338,38 @@ class BaseRouter:
         else:
             methods = [method.upper() for method in methods]
 
+        pool = pool or self.pool
+        middleware = tuple(ensure_async_middleware(m, pool) for m in middleware)
+        if offload is not None:
+            view_function = offload.wrap(view_function)
+
         normalized_path = self.normalize_path(path)
         prefixed_path = self.prefixed_path(normalized_path)
 
         path_regex, path_converters = _parse_path(prefixed_path)
         rule = URLRule(
             original_path=prefixed_path,
-            regex=path_regex,
+            pattern=path_regex,
             converters=path_converters,
-            view_function=view_function,
+            view_function=ensure_async_view(view_function, pool),
             rule_name=rule_name,
-            methods=methods
+            methods=methods,
+            middleware=self.middleware + tuple(middleware)
         )
         self._add_rule(rule_name, rule)
 
     def _add_rule(self, rule_name: str, rule: URLRule):
-        # TODO, raise error if rule_name is already registered
+        if rule_name in self._rules:
+            raise PathRegisterError(f'Rule name is already registered: {rule_name}')
         self._rules[rule_name] = rule
 
-    def route(self, path: str, rule_name: str = None, methods: RequestMethods = None) -> typing.Callable:
-        '''A decorator for add_rule.'''
+    def route(self, path: str, rule_name: str = None, methods: RequestMethods = None,
+              middleware: typing.Sequence[HTTPMiddleware] = (), pool: str = None,
+              offload: 'OffloadPool' = None) -> typing.Callable:
+        '''A decorator for add_rule. The view function is returned as it is, so offloaded views can be pickled.'''
 
         def wrapper(view_function: HTTPView):
-            self.add_rule(path, view_function, rule_name, methods)
+            self.add_rule(path, view_function, rule_name, methods, middleware, pool, offload)
             return view_function
 
         return wrapper
@@ -165,11 +383,140 @@ class MainRouter(BaseRouter):
     Singleton main router. Every URL rule ends up here.
     '''
 
+    _frozen = False
+
+    # Tables built by `freeze`. Rules without URL parameters by their path, and the rest in registration order.
+    _static_rules: typing.Mapping[str, URLRule] = None
+    _dynamic_rules: typing.Tuple[URLRule, ...] = None
+
+    def _add_rule(self, rule_name: str, rule: URLRule):
+        if self._frozen:
+            raise AppFrozen(f"You can't add a rule after the app is frozen: {rule_name}")
+        super()._add_rule(rule_name, rule)
+
+    def freeze(self, cache_path: typing.Optional[str] = None) -> None:
+        '''
+        Validate the rules and build the lookup tables. No rules can be added after this.
+
+        Raise `PathRegisterError` for a rule that can never be matched because an earlier rule matches all of its
+        paths, see `_build_tables` for the overlaps that are detected.
+
+        :param cache_path: Path of a file to keep the validated tables in. When the file was written for the same
+            rules, the tables are loaded from it and the validation, which has to compile and run the regexes of the
+            rules, is skipped. The file is rewritten when the rules change.
+        '''
+        rules = tuple(self._rules.values())
+        for rule in rules:
+            rule.methods = frozenset(rule.methods)
+
+        tables = None
+        if cache_path is not None:
+            cache_key = _route_table_key(rules)
+            tables = self._load_tables(cache_path, cache_key)
+
+        if tables is None:
+            tables = self._build_tables(rules)
+            if cache_path is not None:
+                _save_route_table(cache_path, cache_key, tables)
+
+        static_rules, dynamic_rules = tables
+        for rule in static_rules:
+            rule.parsed_params = {}
+
+        self._static_rules = types.MappingProxyType({rule.original_path: rule for rule in static_rules})
+        self._dynamic_rules = tuple(dynamic_rules)
+        self._frozen = True
+
+    def _build_tables(self, rules: typing.Sequence[URLRule]) -> typing.Tuple[list, list]:
+        '''
+        Validate the rules and return the static and the dynamic ones.
+
+        A rule is shadowed when an earlier rule matches every path it matches. The static rules are checked exactly.
+        A dynamic rule is shadowed by a rule with the same pattern, or by a rule whose segments cover its segments:
+        a literal segment covers the same literal, `<str:...>` covers any segment without a slash, `<int:...>` and
+        `<uuid:...>` cover the literals they match, and `<path:...>` as the last segment covers the rest of the path.
+        Other overlaps, like regular expression characters in the paths, are not detected.
+        '''
+        static_rules = {}
+        dynamic_rules = []
+        dynamic_rules_by_pattern = {}
+        # Dynamic rules with regular segments by their segments, see `_split_segments`
+        rule_tree = _RuleNode()
+        # The other dynamic rules and their segments, by their literal prefix
+        irregular_rules_by_prefix: typing.Dict[str, list] = {}
+        rule_indexes = {}
+
+        def irregular_rules(prefix: str) -> list:
+            # Only the rules whose literal prefix is a prefix of the path can match it
+            if not irregular_rules_by_prefix:
+                return []
+            return [item for index in range(len(prefix) + 1)
+                    for item in irregular_rules_by_prefix.get(prefix[:index], ())]
+
+        def check_shadowed(rule: URLRule, shadowing_rules: typing.List[URLRule]) -> None:
+            if shadowing_rules:
+                shadowing_rule = min(shadowing_rules, key=rule_indexes.__getitem__)
+                raise PathRegisterError(f'Rule {rule.rule_name} is shadowed by {shadowing_rule.rule_name}')
+
+        for rule_index, rule in enumerate(rules):
+            rule_indexes[rule] = rule_index
+
+            if rule.is_static:
+                path = rule.original_path
+                if path in static_rules:
+                    check_shadowed(rule, [static_rules[path]])
+                check_shadowed(rule, rule_tree.covering_rules(path.split('/')))
+                check_shadowed(rule, [earlier_rule for earlier_rule, _ in irregular_rules(path)
+                                      if earlier_rule.regex.match(path)])
+                static_rules[path] = rule
+                continue
+
+            if rule.pattern in dynamic_rules_by_pattern:
+                check_shadowed(rule, [dynamic_rules_by_pattern[rule.pattern]])
+            segments, is_regular = _split_segments(rule.original_path)
+            shadowing_rules = rule_tree.covering_rules(segments) if is_regular else []
+            shadowing_rules.extend(earlier_rule
+                                   for earlier_rule, earlier_segments in irregular_rules(rule.literal_prefix)
+                                   if _segments_cover(earlier_segments, segments))
+            check_shadowed(rule, shadowing_rules)
+
+            dynamic_rules_by_pattern[rule.pattern] = rule
+            if is_regular:
+                rule_tree.add(segments, rule)
+            else:
+                irregular_rules_by_prefix.setdefault(rule.literal_prefix, []).append((rule, segments))
+            dynamic_rules.append(rule)
+
+        return list(static_rules.values()), dynamic_rules
+
+    def _load_tables(self, cache_path: str, cache_key: str) -> typing.Optional[typing.Tuple[list, list]]:
+        '''Return the static and the dynamic rules from the cache file, or None if it is missing or stale.'''
+        try:
+            with open(cache_path) as f:
+                cache = json.load(f)
+            if cache.get('key') != cache_key:
+                return None
+            return [self._rules[name] for name in cache['static']], [self._rules[name] for name in cache['dynamic']]
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return None
+
     def get_rule_for_path(self, path: str) -> typing.Optional[URLRule]:
         '''
         Iterate over all registered rules and try to math the path with rule regex.
         Return the rule if it matches the path. Return None if no rule matches.
+
+        Once the router is frozen, rules without URL parameters are found with a single dict lookup. Validation in
+        `freeze` guarantees that it returns the same rule as trying all rules in order.
         '''
+        if self._frozen:
+            rule = self._static_rules.get(path)
+            if rule is not None:
+                return rule
+            for rule in self._dynamic_rules:
+                if rule.match(path):
+                    return rule
+            return None
+
         for rule in self._rules.values():
             if rule.match(path):
                 return rule
@@ -0,0 +1,306 @@
+'''
+A pre-fork server: a supervisor process forks workers that serve the app with uvicorn on a shared listening socket.
+
+    python -m bluepark test:app --workers 4 --max-requests 10000 --max-memory 512
+
+- The listening socket is created by the supervisor and inherited by the workers. With `--reuse-port` every worker
+  binds its own socket with `SO_REUSEPORT` and the kernel balances the connections between them.
+- Crashed workers are restarted. Workers that crash right after they start are restarted with an increasing delay.
+- Workers exit after `--max-requests` requests and are replaced. The RSS of the workers is checked every
+  `--check-interval` seconds, a worker using more than `--max-memory` MB is replaced.
+- `SIGHUP` reloads the workers. A new worker is forked for every worker, and the old workers are stopped as the new
+  ones become ready, so there are always as many workers accepting connections. The app is imported by the workers,
+  so the new workers run the new code.
+- `SIGTERM` and `SIGINT` stop the workers gracefully, they are killed after `--graceful-timeout` seconds.
+
+Workers are forked, it runs on POSIX systems. The RSS is read from `/proc`, memory limits are not checked where it is
+not available.
+'''
+import importlib
+import logging
+import multiprocessing
+import os
+import random
+import select
+import signal
+import socket
+import threading
+import time
+import typing
+
+try:
+    import uvicorn
+except ImportError:  # uvicorn is only needed to run the server
+    uvicorn = None
+
+logger = logging.getLogger('bluepark.server')
+
+# Workers that exit sooner than this after they are started are restarted with a delay
+MIN_UPTIME = 1.0
+MAX_RESTART_DELAY = 10.0
+
+
+def load_app(path: str):
+    '''Import `module:attribute`.'''
+    module_name, _, attribute = path.partition(':')
+    return getattr(importlib.import_module(module_name), attribute or 'app')
+
+
+def create_socket(host: str, port: int, reuse_port: bool = False, backlog: int = 2048) -> socket.socket:
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _rss(pid: int) -> typing.Optional[int]:
+    '''Return the resident memory of the process in bytes, or None if it can't be read.'''
+    try:
+        with open(f'/proc/{pid}/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _run_worker(app_path: str, sock: typing.Optional[socket.socket], address: typing.Tuple[str, int],
+                max_requests: typing.Optional[int], log_level: str, ready: 'multiprocessing.synchronize.Event') -> None:
+    '''The main function of a worker process.'''
+    signal.set_wakeup_fd(-1)
+    for signum in (signal.SIGHUP, signal.SIGCHLD, signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, signal.SIG_DFL)
+
+    if sock is None:
+        sock = create_socket(*address, reuse_port=True)
+    config = uvicorn.Config(load_app(app_path), log_level=log_level, limit_max_requests=max_requests)
+    server = uvicorn.Server(config)
+
+    def notify_ready() -> None:
+        while not server.started and not server.should_exit:
+            time.sleep(0.05)
+        if server.started:
+            ready.set()
+
+    threading.Thread(target=notify_ready, daemon=True).start()
+    server.run(sockets=[sock])
+    if not ready.is_set():
+        # The app could not be started, the supervisor restarts the worker with a delay
+        raise SystemExit(3)
+
+
+class Worker:
+    __slots__ = ('process', 'ready', 'generation', 'started_at', 'replace', 'stop_deadline')
+
+    def __init__(self, process: multiprocessing.Process, ready: 'multiprocessing.synchronize.Event',
+                 generation: int) -> None:
+        self.process = process
+        self.ready = ready
+        self.generation = generation
+        self.started_at = time.monotonic()
+        # Set when a new worker should take the place of this one
+        self.replace = False
+        # Set when the worker is asked to stop, it is killed after the deadline
+        self.stop_deadline: typing.Optional[float] = None
+
+
+class Supervisor:
+    '''
+    Forks `workers` worker processes and keeps them running, see the module docstring.
+
+    :param app: The app to serve, as `module:attribute`.
+    :param host: Address to listen on, the local loopback by default.
+    :param port: Port to listen on.
+    :param workers: Number of workers, defaults to the number of CPUs.
+    :param reuse_port: Bind a socket with `SO_REUSEPORT` in every worker, instead of sharing the supervisor socket.
+    :param max_requests: Replace a worker after this many requests, 0 to disable.
+    :param max_requests_jitter: A random number up to this is added to `max_requests` of each worker, so the workers
+        are not replaced at the same time.
+    :param max_memory: Replace a worker that uses more than this many bytes of memory, 0 to disable.
+    :param graceful_timeout: Seconds a stopping worker has to finish its requests before it is killed.
+    :param check_interval: Seconds between two checks of the memory of the workers.
+    :param log_level: Log level of uvicorn in the workers.
+    '''
+
+    def __init__(self, app: str, host: str = '127.0.0.1', port: int = 8000, workers: int = None,
+                 reuse_port: bool = False, max_requests: int = 0, max_requests_jitter: int = 0, max_memory: int = 0,
+                 graceful_timeout: float = 30, check_interval: float = 1.0, log_level: str = 'info') -> None:
+        self.app = app
+        self.host = host
+        self.port = port
+        self.worker_count = workers or os.cpu_count() or 1
+        self.reuse_port = reuse_port
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.max_memory = max_memory
+        self.graceful_timeout = graceful_timeout
+        self.check_interval = check_interval
+        self.log_level = log_level
+
+        self.workers: typing.List[Worker] = []
+        self.generation = 0
+        self._context = multiprocessing.get_context('fork')
+        self._socket: typing.Optional[socket.socket] = None
+        self._signals: typing.List[int] = []
+        self._stopping = False
+
+        # Consecutive crashes right after start, and the time the next worker can be started at
+        self._crashes = 0
+        self._restart_at = 0.0
+
+        self.restarts = 0
+        self.recycled = 0
+
+    def run(self) -> int:
+        if uvicorn is None:
+            raise RuntimeError('uvicorn is required to run the server: pip install uvicorn')
+
+        if not self.reuse_port:
+            self._socket = create_socket(self.host, self.port)
+        wakeup_reader, wakeup_writer = os.pipe()
+        os.set_blocking(wakeup_reader, False)
+        os.set_blocking(wakeup_writer, False)
+        signal.set_wakeup_fd(wakeup_writer)
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+            signal.signal(signum, self._handle_signal)
+
+        logger.info('Listening on %s:%s with %s workers', self.host, self.port, self.worker_count)
+        try:
+            while not self._stopping:
+                self._handle_signals()
+                self._reap()
+                self._check_memory()
+                self._replace()
+                self._spawn()
+                self._kill_overdue()
+                select.select([wakeup_reader], [], [], self.check_interval)
+                try:
+                    os.read(wakeup_reader, 4096)
+                except BlockingIOError:
+                    pass
+            self._stop_all()
+        finally:
+            signal.set_wakeup_fd(-1)
+            os.close(wakeup_reader)
+            os.close(wakeup_writer)
+            if self._socket is not None:
+                self._socket.close()
+        return 0
+
+    def _handle_signal(self, signum: int, frame) -> None:
+        self._signals.append(signum)
+
+    def _handle_signals(self) -> None:
+        while self._signals:
+            signum = self._signals.pop(0)
+            if signum == signal.SIGHUP:
+                self.reload()
+            elif signum in (signal.SIGTERM, signal.SIGINT):
+                logger.info('Stopping')
+                self._stopping = True
+
+    def reload(self) -> None:
+        '''Replace all workers with new ones, the old ones are stopped as the new ones become ready.'''
+        logger.info('Reloading')
+        self.generation += 1
+        self._crashes = 0
+        self._restart_at = 0.0
+
+    def _spawn_worker(self) -> None:
+        max_requests = None
+        if self.max_requests:
+            max_requests = self.max_requests + random.randint(0, self.max_requests_jitter)
+        ready = self._context.Event()
+        process = self._context.Process(
+            target=_run_worker, name='bluepark-worker',
+            args=(self.app, self._socket, (self.host, self.port), max_requests, self.log_level, ready)
+        )
+        process.start()
+        self.workers.append(Worker(process, ready, self.generation))
+        logger.info('Started worker %s', process.pid)
+
+    def _is_current(self, worker: Worker) -> bool:
+        return worker.generation == self.generation and not worker.replace and worker.stop_deadline is None
+
+    def _spawn(self) -> None:
+        missing = self.worker_count - sum(1 for worker in self.workers if self._is_current(worker))
+        if missing > 0 and time.monotonic() >= self._restart_at:
+            for _ in range(missing):
+                self._spawn_worker()
+
+    def _reap(self) -> None:
+        now = time.monotonic()
+        for worker in list(self.workers):
+            if worker.ready.is_set() and self._crashes:
+                self._crashes = 0
+            if worker.process.is_alive():
+                continue
+            self.workers.remove(worker)
+            if worker.stop_deadline is not None or self._stopping:
+                continue
+
+            exitcode = worker.process.exitcode
+            if exitcode == 0 and worker.ready.is_set():
+                # Served max_requests requests
+                self.recycled += 1
+                logger.info('Worker %s exited after its maximum number of requests', worker.process.pid)
+                continue
+
+            self.restarts += 1
+            logger.warning('Worker %s exited with code %s', worker.process.pid, exitcode)
+            if now - worker.started_at < MIN_UPTIME and not worker.ready.is_set():
+                self._crashes += 1
+                delay = min(MAX_RESTART_DELAY, 0.1 * 2 ** self._crashes)
+                self._restart_at = now + delay
+                logger.warning('Worker crashed on start, restarting in %.1f seconds', delay)
+
+    def _check_memory(self) -> None:
+        if not self.max_memory:
+            return
+        for worker in self.workers:
+            if worker.replace or worker.stop_deadline is not None:
+                continue
+            rss = _rss(worker.process.pid)
+            if rss is not None and rss > self.max_memory:
+                logger.info('Worker %s uses %s MB, replacing it', worker.process.pid, rss // (1024 * 1024))
+                worker.replace = True
+                self.recycled += 1
+
+    def _replace(self) -> None:
+        '''Stop the workers that are replaced, as long as the ready workers are enough without them.'''
+        old = [worker for worker in self.workers
+               if worker.stop_deadline is None and (worker.replace or worker.generation != self.generation)]
+        if not old:
+            return
+        ready = sum(1 for worker in self.workers if self._is_current(worker) and worker.ready.is_set())
+        # Capacity that is left when an old worker is stopped
+        for worker in old[:max(0, ready + len(old) - self.worker_count)]:
+            self._stop_worker(worker)
+
+    def _stop_worker(self, worker: Worker) -> None:
+        worker.stop_deadline = time.monotonic() + self.graceful_timeout
+        if worker.process.is_alive():
+            os.kill(worker.process.pid, signal.SIGTERM)
+
+    def _kill_overdue(self) -> None:
+        now = time.monotonic()
+        for worker in self.workers:
+            if worker.stop_deadline is not None and now > worker.stop_deadline and worker.process.is_alive():
+                logger.warning('Worker %s did not stop in time, killing it', worker.process.pid)
+                os.kill(worker.process.pid, signal.SIGKILL)
+
+    def _stop_all(self) -> None:
+        for worker in self.workers:
+            if worker.stop_deadline is None:
+                self._stop_worker(worker)
+        deadline = time.monotonic() + self.graceful_timeout
+        for worker in self.workers:
+            worker.process.join(max(0.0, deadline - time.monotonic()))
+        for worker in self.workers:
+            if worker.process.is_alive():
+                os.kill(worker.process.pid, signal.SIGKILL)
+                worker.process.join()
+        self.workers = []
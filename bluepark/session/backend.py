@@ -1,5 +1,16 @@
-from bluepark import current_app
-from bluepark.utils.signing import hmac_json_dumps, hmac_json_loads, BadSignature
+import copy
+import secrets
+import time
+import typing
+
+from bluepark.globals import get_current_app
+from bluepark.utils.signing import hmac_json_loads_timestamped, get_signer, BadSignature, Signer
+from bluepark.utils.structures import LRUCache
+from .serializers import BaseSerializer, CompactSerializer
+from .stores import BaseSessionStore
+
+# Marks a session that is loaded, or that has nothing to load
+_loaded = object()
 
 
 class BaseSession:
@@ -7,13 +18,36 @@ class BaseSession:
 
     def __init__(self, secret_key: str):
         # Holds the session data
-        self._session = {}
+        self._data = {}
         self.secret_key = secret_key
 
+        # The cookie string given to `load_lazily`, until the session is loaded
+        self._pending_cookie_string = _loaded
+
         # Designates if any session key is changed. This flag should be set manually if
         # the value of an mutable type is changed.
         self.modified = False
 
+    @property
+    def _session(self) -> dict:
+        if self._pending_cookie_string is not _loaded:
+            cookie_string, self._pending_cookie_string = self._pending_cookie_string, _loaded
+            self.load(cookie_string)
+        return self._data
+
+    @_session.setter
+    def _session(self, value: dict) -> None:
+        self._pending_cookie_string = _loaded
+        self._data = value
+
+    @property
+    def loaded(self) -> bool:
+        return self._pending_cookie_string is _loaded
+
+    def load_lazily(self, cookie_string: str) -> None:
+        '''Load the session from the cookie string when it is accessed for the first time.'''
+        self._pending_cookie_string = cookie_string
+
     def __setitem__(self, key, value):
         self._session[key] = value
         self.modified = True
@@ -66,18 +100,150 @@ class BaseSession:
     def save(self) -> None:
         raise NotImplementedError()
 
+    async def load_async(self, cookie_string: str) -> None:
+        '''Called by `session_middleware`. Sessions that don't need I/O to load are loaded lazily.'''
+        self.load_lazily(cookie_string)
+
+    async def save_async(self) -> None:
+        '''Called by `session_middleware` when the session is modified, it sets `cookie_string`.'''
+        self.save()
+
+    async def delete_async(self) -> None:
+        '''Called by `session_middleware` when the session is modified and empty.'''
+        pass
+
+    async def touch_async(self) -> bool:
+        '''
+        Called by `session_middleware` when the session is not modified. Return True to set the session cookie again,
+        to extend its expiry.
+        '''
+        return False
+
 
 class CookieSession(BaseSession):
+    '''
+    Session stored in a signed cookie.
+
+    The session is encoded by `serializer`. Cookies in the formats of the previous versions, signed JSON and the
+    legacy `:` separated format, can still be loaded. They are written in the new format when the session is saved.
+
+    Recently verified cookies are kept in `verified_cookies` with their payload and timestamp, so the requests of the
+    same client skip the signature check and JSON decoding. Entries are keyed by the signing settings as well, a
+    cookie verified with a key that is not used anymore is never found.
+    '''
+
+    # Shared by all sessions of the process. Set its `maxsize` to 0 to disable it.
+    verified_cookies = LRUCache(maxsize=1024)
+
+    serializer: BaseSerializer = CompactSerializer()
+
+    def _signer(self, settings) -> Signer:
+        return get_signer(self.secret_key, settings['SESSION_OLD_SECRET_KEYS'], settings['SESSION_SIGNING_DIGEST'])
+
+    def _decode(self, cookie_string: str, settings) -> typing.Tuple[dict, int]:
+        '''Verify the cookie and return the session and the time it was signed at.'''
+        if ':' in cookie_string:
+            return hmac_json_loads_timestamped(cookie_string, self.secret_key, settings['SESSION_OLD_SECRET_KEYS'])
+        payload, timestamp = self._signer(settings).unsign_timestamped(cookie_string)
+        return self.serializer.loads(payload), timestamp
 
     def load(self, cookie_string: str) -> None:
         if cookie_string is None:
             return
-        try:
-            self._session = hmac_json_loads(message=cookie_string,
-                                            key=self.secret_key,
-                                            max_age=current_app.settings['SESSION_COOKIE_MAX_AGE'])
-        except BadSignature:
-            pass
+
+        settings = get_current_app().settings
+        cache_key = (self.secret_key, tuple(settings['SESSION_OLD_SECRET_KEYS']), settings['SESSION_SIGNING_DIGEST'],
+                     cookie_string)
+        entry = self.verified_cookies.get(cache_key)
+        if entry is None:
+            try:
+                entry = self._decode(cookie_string, settings)
+            except (BadSignature, ValueError):
+                return
+            self.verified_cookies[cache_key] = entry
+
+        payload, timestamp = entry
+        if timestamp + settings['SESSION_COOKIE_MAX_AGE'] < time.time():
+            self.verified_cookies.pop(cache_key)
+            return
+
+        # The cached payload is shared, mutable values are copied so changing them does not change the cache
+        self._session = {key: copy.deepcopy(value) if isinstance(value, (dict, list)) else value
+                         for key, value in payload.items()}
 
     def save(self):
-        self.cookie_string = hmac_json_dumps(self._session, key=self.secret_key)
+        self.cookie_string = self._signer(get_current_app().settings).sign(self.serializer.dumps(self._session))
+
+
+class StoreSession(BaseSession):
+    '''
+    Session stored server side in `store`, the cookie carries only the signed session id.
+
+    The expiry of the session in the store is the authority, the cookie is not checked for its age. Sessions that are
+    read but not modified are not written again, their expiry is extended at most once every `SESSION_TOUCH_INTERVAL`
+    seconds.
+
+        store = SQLiteSessionStore('sessions.db')
+        store.install(app)
+        app.add_http_middleware(session_middleware(StoreSession, store=store))
+    '''
+
+    def __init__(self, secret_key: str, store: BaseSessionStore) -> None:
+        super().__init__(secret_key)
+        self.store = store
+        self.session_id: typing.Optional[str] = None
+        # Unix time the session expires at in the store
+        self.expires_at: typing.Optional[float] = None
+
+    def _signer(self, settings) -> Signer:
+        return get_signer(self.secret_key, settings['SESSION_OLD_SECRET_KEYS'], settings['SESSION_SIGNING_DIGEST'])
+
+    def _session_id(self, cookie_string: str, settings) -> typing.Optional[str]:
+        try:
+            return self._signer(settings).unsign_timestamped(cookie_string)[0].decode('ascii')
+        except (BadSignature, UnicodeDecodeError):
+            return None
+
+    async def load_async(self, cookie_string: str) -> None:
+        if cookie_string is None:
+            return
+        session_id = self._session_id(cookie_string, get_current_app().settings)
+        if session_id is None:
+            return
+        stored = await self.store.get(session_id)
+        if stored is not None:
+            self.session_id = session_id
+            self._session, self.expires_at = stored
+
+    async def save_async(self) -> None:
+        settings = get_current_app().settings
+        if self.session_id is None:
+            self.session_id = secrets.token_urlsafe(24)
+        ttl = settings['SESSION_COOKIE_MAX_AGE']
+        await self.store.set(self.session_id, self._session, ttl)
+        self.expires_at = time.time() + ttl
+        self.cookie_string = self._signer(settings).sign(self.session_id.encode('ascii'))
+
+    async def delete_async(self) -> None:
+        if self.session_id is not None:
+            await self.store.delete(self.session_id)
+            self.session_id = None
+
+    async def touch_async(self) -> bool:
+        if self.session_id is None:
+            return False
+        settings = get_current_app().settings
+        ttl = settings['SESSION_COOKIE_MAX_AGE']
+        now = time.time()
+        if self.expires_at - now < ttl - settings['SESSION_TOUCH_INTERVAL']:
+            await self.store.touch(self.session_id, ttl)
+            self.expires_at = now + ttl
+            self.cookie_string = self._signer(settings).sign(self.session_id.encode('ascii'))
+            return True
+        return False
+
+    def load(self, cookie_string: str) -> None:
+        raise NotImplementedError('StoreSession is loaded by `load_async`')
+
+    def save(self) -> None:
+        raise NotImplementedError('StoreSession is saved by `save_async`')
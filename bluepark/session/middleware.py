@@ -1,40 +1,136 @@
-from typing import Type, Union
+from typing import Optional, Type, Union
 
 from bluepark.request import HTTPRequest
 from bluepark.response import HTTPBaseResponse
 from bluepark.utils.types import HTTPMiddleware, HTTPView
 from .backend import BaseSession
+from .stores import BaseSessionStore
+
+
+# The value of the session cookie when the session is split into chunks, followed by the number of chunks
+CHUNKED_MARKER = '*'
+
+
+# Size of the largest Cookie header that is accepted, the number of chunks a client can send is limited by it
+MAX_COOKIE_HEADER_SIZE = 8192
+
+
+def _max_chunk_count(chunk_size: int) -> int:
+    return -(-MAX_COOKIE_HEADER_SIZE // chunk_size)
+
+
+def _chunk_count(value: Optional[str], max_count: int) -> Optional[int]:
+    '''
+    Return the number of chunks of a chunked session cookie, 0 if the session is not chunked, or None if the cookie
+    is not valid. The count is sent by the client, larger counts than the chunks a Cookie header can hold are not
+    valid.
+    '''
+    if value is None or not value.startswith(CHUNKED_MARKER):
+        return 0
+    try:
+        count = int(value[len(CHUNKED_MARKER):])
+    except ValueError:
+        return None
+    return count if 0 < count <= max_count else None
+
+
+def _thaw(response: HTTPBaseResponse) -> HTTPBaseResponse:
+    '''Frozen responses are shared by requests, the cookies are set on a copy.'''
+    return response.thaw() if response.frozen else response
 
 
 class session_middleware:
-    '''Add session object to the request and use backend class to store the session.'''
+    '''
+    Add session object to the request and use backend class to store the session.
 
-    def __init__(self, backend: Type[BaseSession]) -> None:
+    The session is loaded when it is accessed for the first time, the requests that don't use it don't pay for it.
+
+    A cookie string longer than `SESSION_COOKIE_CHUNK_SIZE` is split into `<name>.0`, `<name>.1`, ... cookies, and
+    the value of the session cookie is the number of chunks, so sessions larger than the 4 KB cookie limit of the
+    browsers still work. Chunks that are not needed anymore are expired. A session can have at most the chunks that
+    fit in a Cookie header of `MAX_COOKIE_HEADER_SIZE` bytes, a larger count in a cookie is treated as no session and
+    saving a larger session raises `ValueError`.
+
+    The session is written only when it is modified. A session that is read but not modified may ask for its cookie
+    to be set again with `touch_async`, to extend its expiry.
+
+    :param backend: The session class.
+    :param store: Store of server side sessions, passed to the backend, see `StoreSession`.
+    '''
+
+    def __init__(self, backend: Type[BaseSession], store: BaseSessionStore = None) -> None:
         self.backend_class = backend
+        self.store = store
+
+    def _create_session(self, secret_key: str) -> BaseSession:
+        if self.store is None:
+            return self.backend_class(secret_key)
+        return self.backend_class(secret_key, self.store)
 
     async def __call__(self, request: HTTPRequest, nxt: Union[HTTPMiddleware, HTTPView]) -> Type[HTTPBaseResponse]:
-        session_cookie_name = request.app.settings['SESSION_COOKIE_NAME']
+        settings = request.app.settings
+        session_cookie_name = settings['SESSION_COOKIE_NAME']
         session_cookie_string = request.cookies.get(session_cookie_name)
-        request.session = self.backend_class(request.app.settings['SESSION_SECRET_KEY'])
-        request.session.load(session_cookie_string)
+        chunk_count = _chunk_count(session_cookie_string, _max_chunk_count(settings['SESSION_COOKIE_CHUNK_SIZE']))
+        if chunk_count is None:
+            session_cookie_string = None
+        elif chunk_count:
+            session_cookie_string = self._join_chunks(request, session_cookie_name, chunk_count)
+
+        request.session = self._create_session(request.app.settings['SESSION_SECRET_KEY'])
+        await request.session.load_async(session_cookie_string)
         response = await nxt()
         if not request.session.modified:
+            if await request.session.touch_async():
+                response = _thaw(response)
+                self._set_cookie(response, session_cookie_name, request.session.cookie_string, request.app.settings)
             return response
 
+        response = _thaw(response)
+        chunks = []
         if not request.session.is_empty:
-            request.session.save()
-            response.set_cookie(
-                key=request.app.settings['SESSION_COOKIE_NAME'],
-                value=request.session.cookie_string,
-                max_age=request.app.settings['SESSION_COOKIE_MAX_AGE'],
-                path=request.app.settings['SESSION_COOKIE_PATH'],
-                http_only=request.app.settings['SESSION_COOKIE_HTTPONLY']
-            )
+            await request.session.save_async()
+            cookie_string = request.session.cookie_string
+            chunk_size = settings['SESSION_COOKIE_CHUNK_SIZE']
+            if len(cookie_string) > chunk_size:
+                chunks = [cookie_string[i:i + chunk_size] for i in range(0, len(cookie_string), chunk_size)]
+                if len(chunks) > _max_chunk_count(chunk_size):
+                    # It could not be read back from the Cookie header
+                    raise ValueError(f'The session is too large to be stored in cookies: {len(cookie_string)} bytes')
+                cookie_string = f'{CHUNKED_MARKER}{len(chunks)}'
+
+            self._set_cookie(response, session_cookie_name, cookie_string, settings)
+            for index, chunk in enumerate(chunks):
+                self._set_cookie(response, f'{session_cookie_name}.{index}', chunk, settings)
         else:
             # If the dictionary is empty, expire current session string on client.
-            response.set_cookie(
-                key=request.app.settings['SESSION_COOKIE_NAME'],
-                value='',
-                expires=0
-            )
+            await request.session.delete_async()
+            response.set_cookie(key=session_cookie_name, value='', expires=0, path=settings['SESSION_COOKIE_PATH'])
+
+        # Expire the chunk cookies sent by the client that are not needed anymore
+        chunk_prefix = f'{session_cookie_name}.'
+        for name in request.cookies:
+            if name.startswith(chunk_prefix):
+                index = name[len(chunk_prefix):]
+                if index.isdigit() and int(index) >= len(chunks):
+                    response.set_cookie(key=name, value='', expires=0, path=settings['SESSION_COOKIE_PATH'])
         return response
+
+    def _join_chunks(self, request: HTTPRequest, name: str, count: int) -> Optional[str]:
+        '''Return the joined chunks, or None if one of them is missing.'''
+        chunks = []
+        for index in range(count):
+            chunk = request.cookies.get(f'{name}.{index}')
+            if chunk is None:
+                return None
+            chunks.append(chunk)
+        return ''.join(chunks)
+
+    def _set_cookie(self, response: HTTPBaseResponse, name: str, value: str, settings) -> None:
+        response.set_cookie(
+            key=name,
+            value=value,
+            max_age=settings['SESSION_COOKIE_MAX_AGE'],
+            path=settings['SESSION_COOKIE_PATH'],
+            http_only=settings['SESSION_COOKIE_HTTPONLY']
+        )
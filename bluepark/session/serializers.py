@@ -0,0 +1,202 @@
+import json
+import random
+import struct
+import typing
+import zlib
+
+# The first byte of a payload tells its format. JSON payloads of the previous format start with `{`.
+COMPACT_FORMAT = 1
+COMPRESSED_COMPACT_FORMAT = 2
+
+_double = struct.Struct('>d')
+
+
+class SerializationError(ValueError):
+    '''The session can't be encoded or the payload can't be decoded'''
+    pass
+
+
+class BaseSerializer:
+    '''Turns the session dict into the bytes that are signed and stored in the cookie, and back.'''
+
+    def dumps(self, obj: dict) -> bytes:
+        raise NotImplementedError()
+
+    def loads(self, data: bytes) -> dict:
+        raise NotImplementedError()
+
+
+class JSONSerializer(BaseSerializer):
+    '''Compact JSON, the format of the session cookies before `CompactSerializer`.'''
+
+    def dumps(self, obj: dict) -> bytes:
+        return json.dumps(obj, separators=(',', ':')).encode('utf8')
+
+    def loads(self, data: bytes) -> dict:
+        return json.loads(data.decode('utf8'))
+
+
+def _write_varint(parts: list, value: int) -> None:
+    while value > 0x7f:
+        parts.append(bytes(((value & 0x7f) | 0x80,)))
+        value >>= 7
+    parts.append(bytes((value,)))
+
+
+def _encode(parts: list, value: typing.Any) -> None:
+    # bool before int, bool is a subclass of int
+    if value is None:
+        parts.append(b'n')
+    elif value is True:
+        parts.append(b't')
+    elif value is False:
+        parts.append(b'f')
+    elif isinstance(value, int):
+        parts.append(b'i')
+        # Zigzag encoding keeps small negative numbers short
+        _write_varint(parts, value * 2 if value >= 0 else -value * 2 - 1)
+    elif isinstance(value, float):
+        parts.append(b'd')
+        parts.append(_double.pack(value))
+    elif isinstance(value, str):
+        encoded = value.encode('utf8')
+        parts.append(b's')
+        _write_varint(parts, len(encoded))
+        parts.append(encoded)
+    elif isinstance(value, (list, tuple)):
+        parts.append(b'l')
+        _write_varint(parts, len(value))
+        for item in value:
+            _encode(parts, item)
+    elif isinstance(value, dict):
+        parts.append(b'm')
+        _write_varint(parts, len(value))
+        for key, item in value.items():
+            if not isinstance(key, str):
+                raise SerializationError(f'Session keys must be strings: {key!r}')
+            _encode(parts, key)
+            _encode(parts, item)
+    else:
+        raise SerializationError(f'Unsupported session value type: {type(value).__name__}')
+
+
+def _read_varint(data: bytes, position: int) -> typing.Tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+def _decode(data: bytes, position: int) -> typing.Tuple[typing.Any, int]:
+    tag = data[position]
+    position += 1
+    if tag == 0x6e:  # n
+        return None, position
+    if tag == 0x74:  # t
+        return True, position
+    if tag == 0x66:  # f
+        return False, position
+    if tag == 0x69:  # i
+        value, position = _read_varint(data, position)
+        return (value >> 1) if not value & 1 else -((value + 1) >> 1), position
+    if tag == 0x64:  # d
+        return _double.unpack_from(data, position)[0], position + _double.size
+    if tag == 0x73:  # s
+        length, position = _read_varint(data, position)
+        return data[position:position + length].decode('utf8'), position + length
+    if tag == 0x6c:  # l
+        count, position = _read_varint(data, position)
+        items = []
+        for _ in range(count):
+            item, position = _decode(data, position)
+            items.append(item)
+        return items, position
+    if tag == 0x6d:  # m
+        count, position = _read_varint(data, position)
+        mapping = {}
+        for _ in range(count):
+            key, position = _decode(data, position)
+            mapping[key], position = _decode(data, position)
+        return mapping, position
+    raise SerializationError(f'Unknown tag: {tag}')
+
+
+class CompactSerializer(BaseSerializer):
+    '''
+    A compact binary encoding of JSON compatible values, compressed with zlib when it is larger than
+    `compress_threshold` bytes and compression makes it smaller. The first byte is the format version.
+
+    Payloads in JSON format are still read, so cookies written before switching to this serializer stay valid.
+
+    The size of a sample of the sessions is compared to their JSON size, see `stats`.
+
+    :param compress_threshold: Size in bytes above which the payload is compressed.
+    :param level: zlib compression level.
+    :param stats_sample_rate: Ratio of the sessions to compare with their JSON size, between 0 and 1.
+    '''
+
+    def __init__(self, compress_threshold: int = 200, level: int = 6, stats_sample_rate: float = 0.1) -> None:
+        self.compress_threshold = compress_threshold
+        self.level = level
+        self.stats_sample_rate = stats_sample_rate
+        self._json = JSONSerializer()
+
+        # Number of sampled sessions, and their total size in JSON and in this format
+        self.sampled = 0
+        self.json_bytes = 0
+        self.compact_bytes = 0
+
+    def dumps(self, obj: dict) -> bytes:
+        parts = []
+        _encode(parts, obj)
+        data = b''.join(parts)
+
+        if len(data) > self.compress_threshold:
+            compressed = zlib.compress(data, self.level)
+            if len(compressed) < len(data):
+                data = bytes((COMPRESSED_COMPACT_FORMAT,)) + compressed
+            else:
+                data = bytes((COMPACT_FORMAT,)) + data
+        else:
+            data = bytes((COMPACT_FORMAT,)) + data
+
+        if self.stats_sample_rate and random.random() < self.stats_sample_rate:
+            self.sampled += 1
+            self.json_bytes += len(self._json.dumps(obj))
+            self.compact_bytes += len(data)
+        return data
+
+    def loads(self, data: bytes) -> dict:
+        if not data:
+            raise SerializationError('Empty payload')
+        version = data[0]
+        try:
+            if version == COMPACT_FORMAT:
+                obj, _ = _decode(data, 1)
+            elif version == COMPRESSED_COMPACT_FORMAT:
+                obj, _ = _decode(zlib.decompress(data[1:]), 0)
+            else:
+                return self._json.loads(data)
+        except (IndexError, UnicodeDecodeError, struct.error, zlib.error) as e:
+            raise SerializationError(f'Payload is not valid: {e}')
+
+        if not isinstance(obj, dict):
+            raise SerializationError('Payload is not a dict')
+        return obj
+
+    @property
+    def stats(self) -> dict:
+        '''Average size of the sampled sessions in JSON and in this format, and the bytes saved per session.'''
+        if not self.sampled:
+            return {'sampled': 0, 'average_json_bytes': 0, 'average_bytes': 0, 'average_bytes_saved': 0}
+        return {
+            'sampled': self.sampled,
+            'average_json_bytes': self.json_bytes / self.sampled,
+            'average_bytes': self.compact_bytes / self.sampled,
+            'average_bytes_saved': (self.json_bytes - self.compact_bytes) / self.sampled,
+        }
@@ -0,0 +1,274 @@
+import asyncio
+import collections
+import logging
+import sqlite3
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+from .serializers import BaseSerializer, CompactSerializer
+
+logger = logging.getLogger('bluepark.session')
+
+# A stored session and the unix time it expires at
+StoredSession = typing.Tuple[dict, float]
+
+
+class BaseSessionStore:
+    '''
+    Async storage of server side sessions by session id, see `bluepark.session.backend.StoreSession`.
+
+    Sessions are stored serialized, so the dict returned by `get` is never shared between requests.
+    '''
+
+    async def get(self, session_id: str) -> typing.Optional[StoredSession]:
+        '''Return the session and its expiry time, or None if it does not exist or it is expired.'''
+        raise NotImplementedError()
+
+    async def set(self, session_id: str, data: dict, ttl: int) -> None:
+        raise NotImplementedError()
+
+    async def delete(self, session_id: str) -> None:
+        raise NotImplementedError()
+
+    async def touch(self, session_id: str, ttl: int) -> None:
+        '''Extend the expiry time of the session without writing its data.'''
+        raise NotImplementedError()
+
+    async def close(self) -> None:
+        pass
+
+    def install(self, app) -> None:
+        '''Close the store at the lifespan shutdown of the app.'''
+        app.add_shutdown_handler(self.close)
+
+
+class MemorySessionStore(BaseSessionStore):
+    '''
+    Sessions in the memory of the process. Expired sessions are removed when they are read, and the least recently
+    used sessions are evicted when the total size of the stored sessions is over `max_bytes`.
+
+    Sessions are not shared between worker processes, it suits single process deployments and tests.
+
+    :param max_bytes: Memory budget for the serialized sessions.
+    :param serializer: Serializer of the stored sessions.
+    '''
+
+    # Estimated memory used by an entry besides the serialized session
+    entry_overhead = 200
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, serializer: BaseSerializer = None) -> None:
+        self.max_bytes = max_bytes
+        self.serializer = serializer or CompactSerializer(stats_sample_rate=0)
+        self.size = 0
+        self.evicted = 0
+        self._sessions: typing.MutableMapping[str, typing.Tuple[bytes, float]] = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    async def get(self, session_id: str) -> typing.Optional[StoredSession]:
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            return None
+        data, expires_at = entry
+        if expires_at < time.time():
+            self._remove(session_id)
+            return None
+        self._sessions.move_to_end(session_id)
+        return self.serializer.loads(data), expires_at
+
+    async def set(self, session_id: str, data: dict, ttl: int) -> None:
+        self._remove(session_id)
+        encoded = self.serializer.dumps(data)
+        self._sessions[session_id] = (encoded, time.time() + ttl)
+        self.size += len(encoded) + self.entry_overhead
+
+        while self.size > self.max_bytes and self._sessions:
+            self._remove(next(iter(self._sessions)))
+            self.evicted += 1
+
+    async def delete(self, session_id: str) -> None:
+        self._remove(session_id)
+
+    async def touch(self, session_id: str, ttl: int) -> None:
+        entry = self._sessions.get(session_id)
+        if entry is not None:
+            self._sessions[session_id] = (entry[0], time.time() + ttl)
+            self._sessions.move_to_end(session_id)
+
+    def _remove(self, session_id: str) -> None:
+        entry = self._sessions.pop(session_id, None)
+        if entry is not None:
+            self.size -= len(entry[0]) + self.entry_overhead
+
+
+# Operations waiting to be written by `SQLiteSessionStore`
+_SET = 'set'
+_DELETE = 'delete'
+_TOUCH = 'touch'
+
+
+class SQLiteSessionStore(BaseSessionStore):
+    '''
+    Sessions in a SQLite database, so they survive restarts and are shared by the workers on the same machine.
+
+    Queries run in a single thread, the event loop is never blocked by the database. Writes are collected for
+    `batch_interval` seconds and written in a single transaction, reads see the writes that are not written yet.
+    Expired sessions are deleted every `cleanup_interval` seconds.
+
+    Call `close`, or register it with `install`, to write the pending writes at shutdown.
+
+    :param path: Path of the database file.
+    :param batch_interval: Seconds to collect writes for.
+    :param cleanup_interval: Seconds between two deletes of expired sessions.
+    :param serializer: Serializer of the stored sessions.
+    '''
+
+    def __init__(self, path: str, batch_interval: float = 0.05, cleanup_interval: float = 300,
+                 serializer: BaseSerializer = None) -> None:
+        self.path = path
+        self.batch_interval = batch_interval
+        self.cleanup_interval = cleanup_interval
+        self.serializer = serializer or CompactSerializer(stats_sample_rate=0)
+
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix='bluepark-sessions')
+        self._connection: typing.Optional[sqlite3.Connection] = None
+        self._last_cleanup = time.time()
+
+        # Operations by session id. `_pending` collects new operations while `_writing` is being written.
+        self._pending: typing.MutableMapping[str, tuple] = {}
+        self._writing: typing.Mapping[str, tuple] = {}
+        self._flush_task: typing.Optional[asyncio.Task] = None
+
+        # Number of batches and operations written
+        self.batches = 0
+        self.writes = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS sessions '
+                '(id TEXT PRIMARY KEY, data BLOB NOT NULL, expires_at REAL NOT NULL)'
+            )
+            self._connection.commit()
+        return self._connection
+
+    async def _run(self, func: typing.Callable, *args) -> typing.Any:
+        return await asyncio.get_event_loop().run_in_executor(self._executor, func, *args)
+
+    def _select(self, session_id: str) -> typing.Optional[typing.Tuple[bytes, float]]:
+        return self._connect().execute('SELECT data, expires_at FROM sessions WHERE id = ?', (session_id,)).fetchone()
+
+    async def get(self, session_id: str) -> typing.Optional[StoredSession]:
+        operation = self._pending.get(session_id) or self._writing.get(session_id)
+        if operation is not None and operation[0] == _DELETE:
+            return None
+        if operation is not None and operation[0] == _SET:
+            data, expires_at = operation[1], operation[2]
+        else:
+            row = await self._run(self._select, session_id)
+            if row is None:
+                return None
+            data, expires_at = row
+            if operation is not None:
+                expires_at = operation[2]
+
+        if expires_at < time.time():
+            return None
+        return self.serializer.loads(data), expires_at
+
+    async def set(self, session_id: str, data: dict, ttl: int) -> None:
+        self._add(session_id, (_SET, self.serializer.dumps(data), time.time() + ttl))
+
+    async def delete(self, session_id: str) -> None:
+        self._add(session_id, (_DELETE, None, None))
+
+    async def touch(self, session_id: str, ttl: int) -> None:
+        expires_at = time.time() + ttl
+        operation = self._pending.get(session_id)
+        if operation is not None and operation[0] == _SET:
+            self._add(session_id, (_SET, operation[1], expires_at))
+        elif operation is None or operation[0] == _TOUCH:
+            self._add(session_id, (_TOUCH, None, expires_at))
+
+    def _add(self, session_id: str, operation: tuple) -> None:
+        self._pending[session_id] = operation
+        if self._flush_task is None:
+            self._flush_task = asyncio.get_event_loop().create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.batch_interval)
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        '''Write the pending operations.'''
+        if not self._pending or self._writing:
+            return
+        self._writing, self._pending = self._pending, {}
+        try:
+            await self._run(self._write, self._writing)
+        except Exception:
+            # For example `database is locked`, the operations are written with the next batch
+            logger.exception('Writing %s session operations failed, they are retried', len(self._writing))
+            self._restore(self._writing)
+        finally:
+            self._writing = {}
+        # Operations that were added while writing
+        if self._pending and self._flush_task is None:
+            self._flush_task = asyncio.get_event_loop().create_task(self._flush_later())
+
+    def _restore(self, operations: typing.Mapping[str, tuple]) -> None:
+        '''Add operations that could not be written back to the pending ones, without overriding newer operations.'''
+        for session_id, operation in operations.items():
+            newer = self._pending.get(session_id)
+            if newer is None:
+                self._pending[session_id] = operation
+            elif newer[0] == _TOUCH and operation[0] == _SET:
+                # The newer touch extends the expiry of the data that is not written yet
+                self._pending[session_id] = (_SET, operation[1], newer[2])
+            elif newer[0] == _TOUCH and operation[0] == _DELETE:
+                self._pending[session_id] = operation
+
+    def _write(self, operations: typing.Mapping[str, tuple]) -> None:
+        connection = self._connect()
+        with connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO sessions (id, data, expires_at) VALUES (?, ?, ?)',
+                [(session_id, data, expires_at) for session_id, (op, data, expires_at) in operations.items()
+                 if op == _SET]
+            )
+            connection.executemany(
+                'UPDATE sessions SET expires_at = ? WHERE id = ?',
+                [(expires_at, session_id) for session_id, (op, _, expires_at) in operations.items() if op == _TOUCH]
+            )
+            connection.executemany(
+                'DELETE FROM sessions WHERE id = ?',
+                [(session_id,) for session_id, (op, _, _) in operations.items() if op == _DELETE]
+            )
+            now = time.time()
+            if now - self._last_cleanup > self.cleanup_interval:
+                connection.execute('DELETE FROM sessions WHERE expires_at < ?', (now,))
+                self._last_cleanup = now
+        self.batches += 1
+        self.writes += len(operations)
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        while self._writing:
+            await asyncio.sleep(self.batch_interval)
+        await self.flush()
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        if self._pending:
+            logger.error('%s session operations could not be written before closing', len(self._pending))
+        if self._connection is not None:
+            await self._run(self._connection.close)
+            self._connection = None
+        self._executor.shutdown(wait=False)
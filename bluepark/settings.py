@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Optional, Callable
 
 DEFAULT_SETTINGS = {
     'DEBUG': False,
@@ -16,6 +16,12 @@ DEFAULT_SETTINGS = {
     # Secret key to be used sign session cookies
     'SESSION_SECRET_KEY': 'When',
 
+    # Keys that were used before SESSION_SECRET_KEY, newest first. Cookies signed with them are still accepted.
+    'SESSION_OLD_SECRET_KEYS': (),
+
+    # hashlib algorithm of the HMAC that signs session cookies
+    'SESSION_SIGNING_DIGEST': 'sha256',
+
     # Name to be used in cookies for session
     'SESSION_COOKIE_NAME': 'session',
 
@@ -26,12 +32,63 @@ DEFAULT_SETTINGS = {
     'SESSION_COOKIE_PATH': '/',
 
     # Makes cookies inaccessible by javascript code
-    'SESSION_COOKIE_HTTPONLY': True
+    'SESSION_COOKIE_HTTPONLY': True,
+
+    # Maximum length of a session cookie value. Longer sessions are split into `<name>.0`, `<name>.1`, ... cookies.
+    'SESSION_COOKIE_CHUNK_SIZE': 3800,
+
+    # Minimum seconds between two extensions of the expiry of a server side session that is read but not modified
+    'SESSION_TOUCH_INTERVAL': 60,
+
+    # Maximum size in bytes of a record read by `request.iter_lines` and `request.iter_ndjson`
+    'MAX_RECORD_SIZE': 1024 * 1024,
+
+    # A file to cache the validated routing tables in, so the workers of a deployment validate the routes only once
+    'ROUTE_CACHE_PATH': None,
+
+    # Number of threads of the default pool that runs sync views and middleware
+    'THREAD_POOL_MAX_WORKERS': 32,
 
 }
 
 
 class Settings(dict):
+    '''
+    Settings dictionary. `on_change` is called after every modification, so values derived from the settings can be
+    resolved once instead of being looked up on every use.
+    '''
 
-    def __init__(self, defaults: Optional[dict]) -> None:
+    def __init__(self, defaults: Optional[dict], on_change: Callable[[], None] = None) -> None:
         super(Settings, self).__init__(defaults or {})
+        self._on_change = on_change
+
+    def _changed(self) -> None:
+        if self._on_change is not None:
+            self._on_change()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._changed()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._changed()
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._changed()
+
+    def setdefault(self, key, default=None):
+        value = super().setdefault(key, default)
+        self._changed()
+        return value
+
+    def pop(self, key, *args):
+        value = super().pop(key, *args)
+        self._changed()
+        return value
+
+    def clear(self):
+        super().clear()
+        self._changed()
+
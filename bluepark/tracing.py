@@ -0,0 +1,117 @@
+import json
+import os
+import typing
+
+from .utils.types import ASGIScope
+
+# Request lifecycle events that hooks can subscribe to.
+REQUEST_START = 'request_start'
+ROUTE_MATCHED = 'route_matched'
+MIDDLEWARE_ENTER = 'middleware_enter'
+MIDDLEWARE_EXIT = 'middleware_exit'
+VIEW_ENTER = 'view_enter'
+VIEW_EXIT = 'view_exit'
+RESPONSE_START = 'response_start'
+RESPONSE_END = 'response_end'
+
+HOOK_EVENTS = (
+    REQUEST_START,
+    ROUTE_MATCHED,
+    MIDDLEWARE_ENTER,
+    MIDDLEWARE_EXIT,
+    VIEW_ENTER,
+    VIEW_EXIT,
+    RESPONSE_START,
+    RESPONSE_END,
+)
+
+
+def callable_name(func: typing.Callable) -> str:
+    '''Return a readable name for a view or middleware, which may be a function or a callable instance.'''
+    return getattr(func, '__qualname__', None) or type(func).__qualname__
+
+
+class ChromeTraceExporter:
+    '''
+    Write request lifecycle events as Chrome trace events.
+
+    The output uses the JSON array format of the Trace Event Format, which can be loaded by chrome://tracing and
+    Perfetto. Events are written as they happen, the closing bracket is optional for that format so a trace file of a
+    process that has been killed can still be loaded.
+
+    Every request gets its own track (`tid`), so spans of concurrent requests do not overlap.
+    '''
+
+    def __init__(self, file: typing.Union[str, typing.TextIO]) -> None:
+        if isinstance(file, str):
+            self._file = open(file, 'w')
+            self._owns_file = True
+        else:
+            self._file = file
+            self._owns_file = False
+
+        self._pid = os.getpid()
+        self._next_tid = 1
+        # Track ids of the requests that are being handled, by id of their scope.
+        self._tids: typing.MutableMapping[int, int] = {}
+        self._separator = ''
+        self._file.write('[')
+
+    def install(self, app) -> None:
+        '''Subscribe to all lifecycle events of the given app.'''
+        for event in HOOK_EVENTS:
+            app.add_hook(event, self)
+
+    def __call__(self, event: str, timestamp: int, scope: ASGIScope, **details) -> None:
+        if event == REQUEST_START:
+            self._tids[id(scope)] = self._next_tid
+            self._next_tid += 1
+            self._begin(scope, f'{scope.get("method", "")} {scope.get("path", "")}', timestamp)
+        elif event == ROUTE_MATCHED:
+            self._complete(scope, f'route {details["rule"].rule_name}', details['start'], timestamp)
+        elif event == MIDDLEWARE_ENTER:
+            self._begin(scope, callable_name(details['middleware']), timestamp)
+        elif event == VIEW_ENTER:
+            self._begin(scope, callable_name(details['view']), timestamp)
+        elif event in (MIDDLEWARE_EXIT, VIEW_EXIT):
+            self._end(scope, timestamp)
+        elif event == RESPONSE_START:
+            self._begin(scope, 'send', timestamp, {'status': details['status']})
+        elif event == RESPONSE_END:
+            if details['status'] is not None:
+                # Close `send` span
+                self._end(scope, timestamp)
+            self._end(scope, timestamp, {'status': details['status']})
+            self._tids.pop(id(scope), None)
+
+    def _write(self, scope: ASGIScope, phase: str, timestamp: int, extra: dict) -> None:
+        trace_event = {
+            'ph': phase,
+            # Trace event timestamps are in microseconds
+            'ts': timestamp / 1000,
+            'pid': self._pid,
+            'tid': self._tids.get(id(scope), 0),
+        }
+        trace_event.update(extra)
+        self._file.write(self._separator + '\n' + json.dumps(trace_event, separators=(',', ':')))
+        self._separator = ','
+
+    def _begin(self, scope: ASGIScope, name: str, timestamp: int, args: dict = None) -> None:
+        self._write(scope, 'B', timestamp, {'name': name, 'args': args or {}})
+
+    def _end(self, scope: ASGIScope, timestamp: int, args: dict = None) -> None:
+        self._write(scope, 'E', timestamp, {'args': args or {}})
+
+    def _complete(self, scope: ASGIScope, name: str, start: int, end: int) -> None:
+        self._write(scope, 'X', start, {'name': name, 'dur': (end - start) / 1000})
+
+    def flush(self) -> None:
+        self._file.flush()
+
+    def close(self) -> None:
+        '''Terminate the JSON array and close the file if it is opened by the exporter.'''
+        self._file.write('\n]\n')
+        if self._owns_file:
+            self._file.close()
+        else:
+            self._file.flush()
@@ -0,0 +1,290 @@
+import asyncio
+import collections
+import functools
+import time
+import typing
+
+from bluepark.response import HTTPBaseResponse, RawResponse
+
+# Separates the positional and the keyword arguments in the keys made by `make_key`
+_kwargs_mark = object()
+
+
+def make_key(*args, **kwargs) -> typing.Hashable:
+    '''Default key function of `async_cache`, the arguments must be hashable.'''
+    if not kwargs:
+        return args
+    return args + (_kwargs_mark,) + tuple(sorted(kwargs.items()))
+
+
+def request_key(request, **params) -> typing.Hashable:
+    '''Key function for cached views, the method, path and query string of the request.'''
+    return request.method, request.path, request.query_string
+
+
+class _CachedResponse:
+    '''A rendered response, every hit gets its own `RawResponse` so middleware can't change the cached one.'''
+    __slots__ = ('status', 'headers', 'body')
+
+    def __init__(self, response: HTTPBaseResponse) -> None:
+        self.status = response.status
+        self.headers = tuple(response.get_headers())
+        self.body = response.render()
+
+    def response(self) -> RawResponse:
+        return RawResponse(self.body, status=self.status, headers=self.headers)
+
+
+def _retrieve_exception(call: asyncio.Future) -> None:
+    if not call.cancelled():
+        call.exception()
+
+
+class _Entry:
+    __slots__ = ('value', 'expires_at', 'stale_until', 'tags')
+
+    def __init__(self, value: typing.Any, expires_at: float, stale_until: float, tags: typing.FrozenSet[str]) -> None:
+        self.value = value
+        self.expires_at = expires_at
+        self.stale_until = stale_until
+        self.tags = tags
+
+
+class AsyncCache:
+    '''
+    Cache of the results of async calls, see `async_cache`.
+
+    - Entries expire `ttl` seconds after they are stored. `ttl` can be a callable that takes the result and returns
+      the seconds, to give each entry its own TTL.
+    - At most `maxsize` entries are kept, the least recently used one is evicted.
+    - Concurrent misses of the same key make a single call, the other callers wait for its result. Streaming
+      responses are not shared, the callers that waited for one make their own call.
+    - An expired entry is still returned for `stale_ttl` seconds while it is refreshed in the background.
+    - Entries can be invalidated by key, or by the tags they were stored with.
+
+    Exceptions are not cached. It must be used from a single event loop.
+
+    :param maxsize: Maximum number of entries.
+    :param ttl: Seconds an entry is fresh, or a callable that returns them for a result.
+    :param stale_ttl: Seconds an expired entry is returned while it is refreshed.
+    '''
+
+    def __init__(self, maxsize: int = 1024, ttl: typing.Union[float, typing.Callable[[typing.Any], float]] = 60,
+                 stale_ttl: float = 0) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+
+        self._entries: typing.MutableMapping[typing.Hashable, _Entry] = collections.OrderedDict()
+        self._tags: typing.Dict[str, typing.Set[typing.Hashable]] = {}
+        # Calls that are running by key
+        self._calls: typing.Dict[typing.Hashable, asyncio.Future] = {}
+        # Incremented by every invalidation, results of calls that started before it are not stored
+        self._generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        # Misses that waited for the call of another miss
+        self.coalesced = 0
+        self.refreshes = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.errors = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: typing.Hashable) -> bool:
+        return key in self._entries
+
+    async def get_or_call(self, key: typing.Hashable, func: typing.Callable[[], typing.Awaitable],
+                          tags: typing.Iterable[str] = ()) -> typing.Any:
+        '''Return the cached result for the key, or await `func()` and cache its result.'''
+        entry = self._entries.get(key)
+        if entry is not None:
+            now = time.monotonic()
+            if now < entry.expires_at:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._value(entry.value)
+            if now < entry.stale_until:
+                self._entries.move_to_end(key)
+                self.stale_hits += 1
+                if key not in self._calls:
+                    self.refreshes += 1
+                    self._start_call(key, func, tags)
+                return self._value(entry.value)
+            self._remove(key)
+
+        self.misses += 1
+        call = self._calls.get(key)
+        coalesced = call is not None
+        if coalesced:
+            self.coalesced += 1
+        else:
+            call = self._start_call(key, func, tags)
+        # Shielded, a cancelled caller does not cancel the call the other callers wait for
+        value = await asyncio.shield(call)
+        if coalesced and isinstance(value, HTTPBaseResponse) and value.streaming:
+            # The body of a streaming response can be read once, it belongs to the caller that made the call
+            return await func()
+        return self._value(value)
+
+    def _start_call(self, key: typing.Hashable, func: typing.Callable[[], typing.Awaitable],
+                    tags: typing.Iterable[str]) -> asyncio.Future:
+        call = asyncio.ensure_future(self._call(key, func, frozenset(tags)))
+        # Nobody awaits the refreshes, their exceptions are only counted
+        call.add_done_callback(_retrieve_exception)
+        self._calls[key] = call
+        return call
+
+    async def _call(self, key: typing.Hashable, func: typing.Callable[[], typing.Awaitable],
+                    tags: typing.FrozenSet[str]) -> typing.Any:
+        generation = self._generation
+        try:
+            value = await func()
+        except BaseException:
+            self.errors += 1
+            raise
+        finally:
+            if self._calls.get(key) is asyncio.current_task():
+                del self._calls[key]
+
+        if isinstance(value, HTTPBaseResponse):
+            if value.streaming:
+                # The body is not known, it is not cached
+                return value
+            stored = _CachedResponse(value)
+        else:
+            stored = value
+        if generation == self._generation:
+            self._store(key, stored, value, tags)
+        return stored
+
+    def _store(self, key: typing.Hashable, stored: typing.Any, value: typing.Any,
+               tags: typing.FrozenSet[str]) -> None:
+        if self.maxsize <= 0:
+            return
+        ttl = self.ttl(value) if callable(self.ttl) else self.ttl
+        expires_at = time.monotonic() + ttl
+        self._remove(key)
+        self._entries[key] = _Entry(stored, expires_at, expires_at + self.stale_ttl, tags)
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+
+        while len(self._entries) > self.maxsize:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _value(self, value: typing.Any) -> typing.Any:
+        return value.response() if isinstance(value, _CachedResponse) else value
+
+    def _remove(self, key: typing.Hashable) -> bool:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        for tag in entry.tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+        return True
+
+    def invalidate(self, key: typing.Hashable) -> bool:
+        '''Remove the entry of the key, return True if there was one. A running call of the key is not stored.'''
+        self._generation += 1
+        self.invalidations += 1
+        self._calls.pop(key, None)
+        return self._remove(key)
+
+    def invalidate_tag(self, tag: str) -> int:
+        '''Remove the entries stored with the tag and return their number. Running calls are not stored.'''
+        self._generation += 1
+        self.invalidations += 1
+        # The tags of the running calls are not indexed, new misses of any key make a new call
+        self._calls.clear()
+        keys = list(self._tags.get(tag, ()))
+        for key in keys:
+            self._remove(key)
+        return len(keys)
+
+    def clear(self) -> None:
+        self._generation += 1
+        self._calls.clear()
+        self._entries.clear()
+        self._tags.clear()
+
+    @property
+    def stats(self) -> dict:
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'refreshes': self.refreshes,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'errors': self.errors,
+            'hit_ratio': round((self.hits + self.stale_hits) / lookups, 4) if lookups else 0.0,
+        }
+
+
+def async_cache(maxsize: int = 1024, ttl: typing.Union[float, typing.Callable[[typing.Any], float]] = 60,
+                stale_ttl: float = 0, key: typing.Callable[..., typing.Hashable] = None,
+                tags: typing.Union[typing.Iterable[str], typing.Callable[..., typing.Iterable[str]]] = (),
+                cache: AsyncCache = None) -> typing.Callable:
+    '''
+    A decorator that caches the results of an async function by its arguments, see `AsyncCache`.
+
+        @async_cache(ttl=30, stale_ttl=300, tags=lambda user_id: [f'user:{user_id}'])
+        async def get_profile(user_id):
+            ...
+
+        get_profile.invalidate(42)
+        get_profile.invalidate_tag('user:42')
+        get_profile.cache.stats
+
+    Views are cached with a key function that does not use the request object itself, like `request_key`. Responses
+    are stored rendered and every hit gets a new `RawResponse`. Headers set by the view, cookies included, are cached
+    with the response.
+
+        @router.route('/products/<int:product_id>/')
+        @async_cache(ttl=10, key=request_key)
+        async def product(request, product_id):
+            ...
+
+    :param maxsize: Maximum number of entries.
+    :param ttl: Seconds a result is fresh, or a callable that returns them for a result.
+    :param stale_ttl: Seconds an expired result is returned while it is refreshed in the background.
+    :param key: Callable that takes the arguments and returns the key, defaults to `make_key`.
+    :param tags: Tags of the results, or a callable that takes the arguments and returns them.
+    :param cache: A cache shared with other functions, so they can be invalidated by the same tags. The keys are
+        prefixed with the name of the function. `maxsize`, `ttl` and `stale_ttl` are ignored when it is given.
+    '''
+    key_function = key or make_key
+
+    def decorator(func: typing.Callable[..., typing.Awaitable]) -> typing.Callable[..., typing.Awaitable]:
+        func_cache = cache if cache is not None else AsyncCache(maxsize, ttl, stale_ttl)
+        prefix = f'{func.__module__}.{func.__qualname__}' if cache is not None else None
+
+        def build_key(*args, **kwargs) -> typing.Hashable:
+            cache_key = key_function(*args, **kwargs)
+            return cache_key if prefix is None else (prefix, cache_key)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            entry_tags = tags(*args, **kwargs) if callable(tags) else tags
+            return await func_cache.get_or_call(build_key(*args, **kwargs), functools.partial(func, *args, **kwargs),
+                                                entry_tags)
+
+        wrapper.cache = func_cache
+        wrapper.invalidate = lambda *args, **kwargs: func_cache.invalidate(build_key(*args, **kwargs))
+        wrapper.invalidate_tag = func_cache.invalidate_tag
+        return wrapper
+
+    return decorator
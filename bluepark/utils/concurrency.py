@@ -0,0 +1,95 @@
+import asyncio
+import contextvars
+import functools
+import inspect
+import typing
+from concurrent.futures import Executor
+
+from .types import HTTPView, HTTPMiddleware
+
+# Name of the thread pool that runs sync views and middleware when no pool is selected
+DEFAULT_THREAD_POOL = 'default'
+
+
+def is_async_callable(obj: typing.Any) -> bool:
+    '''
+    Return whether calling the object returns an awaitable, for functions, partials and callable instances. Sync
+    functions that wrap an async function with `functools.wraps`, like most decorators, are async callables too.
+    '''
+    while True:
+        while isinstance(obj, functools.partial):
+            obj = obj.func
+        if inspect.iscoroutinefunction(obj) or inspect.iscoroutinefunction(getattr(obj, '__call__', None)):
+            return True
+        wrapped = getattr(obj, '__wrapped__', None)
+        if wrapped is None or wrapped is obj:
+            return False
+        obj = wrapped
+
+
+async def _await_result(result: typing.Any) -> typing.Any:
+    '''Await the result of a callable that is not an async function but still returned an awaitable.'''
+    if inspect.isawaitable(result):
+        return await result
+    return result
+
+
+async def run_in_executor(executor: Executor, func: typing.Callable, *args, **kwargs) -> typing.Any:
+    '''
+    Call the sync function in the executor and return its result. The function runs in a copy of the current
+    context, so context variables like `current_app` and `current_request` are available to it.
+    '''
+    context = contextvars.copy_context()
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, functools.partial(context.run, func, *args, **kwargs))
+
+
+def sync_view(view_function: typing.Callable, pool: str = DEFAULT_THREAD_POOL) -> HTTPView:
+    '''
+    Return an async view that calls the sync view function in the thread pool of the app. An awaitable returned by
+    the function is awaited on the event loop.
+    '''
+
+    @functools.wraps(view_function)
+    async def wrapper(request, **kwargs):
+        result = await run_in_executor(request.app.get_thread_pool(pool), view_function, request, **kwargs)
+        return await _await_result(result)
+
+    return wrapper
+
+
+def sync_middleware(middleware: typing.Callable, pool: str = DEFAULT_THREAD_POOL) -> HTTPMiddleware:
+    '''
+    Return an async middleware that calls the sync middleware in the thread pool of the app.
+
+    The sync middleware gets a sync `nxt` callable, it blocks the thread until the rest of the chain returns the
+    response on the event loop. The thread is held meanwhile, so sync views should use another pool than sync
+    middleware, or the pool should be large enough for both, or requests can wait for each other's threads forever.
+    '''
+
+    async def wrapper(request, nxt):
+        loop = asyncio.get_event_loop()
+
+        def sync_nxt():
+            return asyncio.run_coroutine_threadsafe(nxt(), loop).result()
+
+        result = await run_in_executor(request.app.get_thread_pool(pool), middleware, request, sync_nxt)
+        return await _await_result(result)
+
+    wrapper.__name__ = wrapper.__qualname__ = getattr(middleware, '__name__', type(middleware).__name__)
+    wrapper.__wrapped__ = middleware
+    return wrapper
+
+
+def ensure_async_view(view_function: typing.Callable, pool: typing.Optional[str] = None) -> HTTPView:
+    '''Return the view as it is if it is async, otherwise wrap it to run in the thread pool.'''
+    if is_async_callable(view_function):
+        return view_function
+    return sync_view(view_function, pool or DEFAULT_THREAD_POOL)
+
+
+def ensure_async_middleware(middleware: typing.Callable, pool: typing.Optional[str] = None) -> HTTPMiddleware:
+    '''Return the middleware as it is if it is async, otherwise wrap it to run in the thread pool.'''
+    if is_async_callable(middleware):
+        return middleware
+    return sync_middleware(middleware, pool or DEFAULT_THREAD_POOL)
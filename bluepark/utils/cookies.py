@@ -0,0 +1,127 @@
+import datetime
+import re
+import time
+import typing
+from email.utils import formatdate
+
+# Cookie names are RFC 2616 tokens
+_is_legal_name = re.compile(r"[!#$%&'*+\-.^_`|~0-9A-Za-z]+").fullmatch
+
+# RFC 6265 cookie-octets, values with other characters are quoted
+_is_legal_value = re.compile(r'[\x21\x23-\x2b\x2d-\x3a\x3c-\x5b\x5d-\x7e]*').fullmatch
+
+# Escapes in quoted values, as written by `http.cookies.SimpleCookie` and `_quote`
+_escape_re = re.compile(r'\\(?:([0-3][0-7][0-7])|(.))')
+
+_same_site_values = {'strict': 'Strict', 'lax': 'Lax', 'none': 'None'}
+
+
+def _unescape(match: typing.Match) -> str:
+    octal, char = match.groups()
+    return chr(int(octal, 8)) if octal else char
+
+
+def _unquote(value: str) -> str:
+    value = value[1:-1]
+    if '\\' in value:
+        return _escape_re.sub(_unescape, value)
+    return value
+
+
+def _quote(value: str) -> str:
+    '''Quote a value that has characters that are not allowed in cookie values, like `SimpleCookie` does.'''
+    escaped = []
+    for char in value:
+        if char == '"' or char == '\\':
+            escaped.append('\\' + char)
+        elif ord(char) < 256 and not _is_legal_value(char):
+            escaped.append(f'\\{ord(char):03o}')
+        else:
+            escaped.append(char)
+    return '"' + ''.join(escaped) + '"'
+
+
+def parse_cookie_header(header: str) -> typing.Dict[str, str]:
+    '''
+    Parse the value of a `Cookie` request header, `name=value` pairs separated by `;`, into a dict.
+
+    Pairs that are not valid are skipped, the pairs after them are still parsed. When a name is repeated the first
+    value is kept, browsers send the cookie with the most specific path first. Quoted values are unquoted.
+    '''
+    cookies = {}
+    for pair in header.split(';'):
+        name, separator, value = pair.partition('=')
+        if not separator:
+            continue
+        name = name.strip()
+        if not name or name in cookies:
+            continue
+        value = value.strip()
+        if len(value) > 1 and value[0] == '"' and value[-1] == '"':
+            value = _unquote(value)
+        cookies[name] = value
+    return cookies
+
+
+# The date of the last expiry time given as a number of seconds, most cookies are expired with 0
+_last_expires: typing.Tuple[int, str] = (-1, '')
+
+
+def _http_date(timestamp: int) -> str:
+    global _last_expires
+    if _last_expires[0] != timestamp:
+        _last_expires = (timestamp, formatdate(timestamp, usegmt=True))
+    return _last_expires[1]
+
+
+def set_cookie_header(
+        key: str,
+        value: str = '',
+        max_age: int = None,
+        expires: typing.Union[int, datetime.datetime, str] = None,
+        path: str = '/',
+        domain: str = None,
+        secure: bool = False,
+        http_only: bool = False,
+        same_site: str = None,
+        encoding: str = 'latin-1'
+) -> bytes:
+    '''
+    Return the value of a `Set-Cookie` header, see `HTTPBaseResponse.set_cookie` for the arguments.
+
+    Values with characters that RFC 6265 does not allow are quoted, `parse_cookie_header` unquotes them.
+    '''
+    if not _is_legal_name(key):
+        raise ValueError(f'Invalid cookie name: {key!r}')
+    if not _is_legal_value(value):
+        value = _quote(value)
+    parts = [f'{key}={value}']
+
+    if expires is not None:
+        if isinstance(expires, datetime.datetime):
+            if expires.tzinfo is None:
+                expires = expires.replace(tzinfo=datetime.timezone.utc)
+            expires = formatdate(expires.timestamp(), usegmt=True)
+        elif isinstance(expires, (int, float)):
+            expires = _http_date(int(time.time() + expires))
+        parts.append(f'Expires={expires}')
+    if max_age is not None:
+        parts.append(f'Max-Age={int(max_age)}')
+    if domain is not None:
+        if ';' in domain:
+            raise ValueError(f'Invalid cookie domain: {domain!r}')
+        parts.append(f'Domain={domain}')
+    if path is not None:
+        if ';' in path:
+            raise ValueError(f'Invalid cookie path: {path!r}')
+        parts.append(f'Path={path}')
+    if secure:
+        parts.append('Secure')
+    if http_only:
+        parts.append('HttpOnly')
+    if same_site is not None:
+        try:
+            parts.append(f'SameSite={_same_site_values[same_site.lower()]}')
+        except KeyError:
+            raise ValueError(f'Invalid SameSite value: {same_site!r}')
+    return '; '.join(parts).encode(encoding)
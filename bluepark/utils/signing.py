@@ -1,8 +1,12 @@
 import base64
+import binascii
+import functools
 import hashlib
 import hmac
 import json
+import struct
 import time
+import typing
 
 
 class BadSignature(Exception):
@@ -10,7 +14,7 @@ class BadSignature(Exception):
     pass
 
 
-class ExpiredSignature(Exception):
+class ExpiredSignature(BadSignature):
     '''Signature is expired'''
     pass
 
@@ -23,7 +27,89 @@ def b64decode(data: bytes) -> bytes:
     return base64.urlsafe_b64decode(data)
 
 
+# Version byte of the token layout of `Signer`
+TOKEN_VERSION = 1
+
+# Version and timestamp at the beginning of a token
+_token_header = struct.Struct('>BI')
+
+
+class Signer:
+    '''
+    Reusable signer of timestamped tokens.
+
+    A token is the URL safe base64 encoding, without padding, of a single binary string:
+
+        version (1 byte) | timestamp (4 bytes, big endian) | payload | HMAC of the previous parts
+
+    The HMAC state keyed with each key is computed once, and copied for every message. Use `get_signer` to share
+    signers instead of creating one for every message.
+
+    :param key: The key to sign with.
+    :param old_keys: Keys that were used before `key`. Tokens signed with them are still valid, keys are tried newest
+        first, so list the most recent one first. It lets keys be rotated without invalidating existing tokens.
+    :param digest: Name of a `hashlib` algorithm, for example `sha256` or `blake2b`.
+    '''
+
+    def __init__(self, key: typing.Union[str, bytes], old_keys: typing.Sequence[typing.Union[str, bytes]] = (),
+                 digest: str = 'sha256') -> None:
+        self.digest = digest
+        self._macs = [hmac.new(k.encode() if isinstance(k, str) else k, digestmod=digest) for k in (key, *old_keys)]
+        self.digest_size = self._macs[0].digest_size
+
+    def _signature(self, mac: 'hmac.HMAC', data: bytes) -> bytes:
+        mac = mac.copy()
+        mac.update(data)
+        return mac.digest()
+
+    def sign(self, payload: bytes, timestamp: int = None) -> str:
+        '''Return the token of the payload, signed with the current key.'''
+        if timestamp is None:
+            timestamp = int(time.time())
+        data = _token_header.pack(TOKEN_VERSION, timestamp) + payload
+        token = data + self._signature(self._macs[0], data)
+        return base64.urlsafe_b64encode(token).rstrip(b'=').decode('ascii')
+
+    def unsign_timestamped(self, token: str) -> typing.Tuple[bytes, int]:
+        '''Validate the signature and return the payload and the timestamp, without checking the expiry.'''
+        try:
+            token = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        except (binascii.Error, ValueError):
+            raise BadSignature('Token is not valid base64')
+
+        if len(token) < _token_header.size + self.digest_size:
+            raise BadSignature('Token is too short')
+        data, signature = token[:-self.digest_size], token[-self.digest_size:]
+        version, timestamp = _token_header.unpack_from(data)
+        if version != TOKEN_VERSION:
+            raise BadSignature(f'Unknown token version: {version}')
+
+        for mac in self._macs:
+            if hmac.compare_digest(self._signature(mac, data), signature):
+                return data[_token_header.size:], timestamp
+        raise BadSignature('Signature is not valid')
+
+    def unsign(self, token: str, max_age: int = None) -> bytes:
+        '''Return the payload of the token, raise `ExpiredSignature` if it is signed more than `max_age` seconds ago.'''
+        payload, timestamp = self.unsign_timestamped(token)
+        if max_age is not None and timestamp + max_age < time.time():
+            raise ExpiredSignature()
+        return payload
+
+
+@functools.lru_cache(maxsize=32)
+def _get_signer(key: typing.Union[str, bytes], old_keys: tuple, digest: str) -> Signer:
+    return Signer(key, old_keys, digest)
+
+
+def get_signer(key: typing.Union[str, bytes], old_keys: typing.Sequence[typing.Union[str, bytes]] = (),
+               digest: str = 'sha256') -> Signer:
+    '''Return a shared signer for the keys and the digest.'''
+    return _get_signer(key, tuple(old_keys), digest)
+
+
 class HMACSigner:
+    '''Signer of the legacy `message:signature` format. Use `Signer` for new tokens.'''
 
     def __init__(self, key: str, separator: str = ':', encoding: str = 'utf8'):
         self.key = key.encode()
@@ -76,28 +162,53 @@ class TimeStampedHMACSigner(HMACSigner):
         :param max_age: Number of seconds to expire message since the timestamp.
         :return: Return the verified and decoded message.
         '''
+        message, timestamp = self.verify_timestamped(signed_message)
+        if max_age is not None and timestamp + max_age < time.time():
+            raise ExpiredSignature()
+        return message
+
+    def verify_timestamped(self, signed_message: str) -> typing.Tuple[str, int]:
+        '''Validate the signature and return the message and the timestamp, without checking the expiry.'''
         timestamped_message = super().verify(signed_message)
         if self.separator not in timestamped_message:
             raise BadSignature(f'No `{self.separator}` found in message')
         message, timestamp = timestamped_message.rsplit(self.separator, 1)
-        if max_age is None:
-            return message
-        timestamp = int(b64decode(timestamp).decode(self.encoding))
-        if timestamp + max_age < time.time():
-            raise ExpiredSignature()
-        return message
-
-
-def hmac_json_dumps(obj: dict, key: str) -> str:
-    '''Dump the dictionary object as json and sign it using hmac.'''
-    serialized_data = json.dumps(obj, separators=(',', ':')).encode('utf8')
-    serialized_data = b64encode(serialized_data).decode('utf8')
-    signer = TimeStampedHMACSigner(key=key)
-    return signer.sign(serialized_data)
+        try:
+            return message, int(b64decode(timestamp.encode(self.encoding)).decode(self.encoding))
+        except ValueError:
+            raise BadSignature('Timestamp is not valid')
 
 
-def hmac_json_loads(message: str, key: str, max_age: int = None) -> dict:
+def hmac_json_dumps(obj: dict, key: str, old_keys: typing.Sequence[str] = (), digest: str = 'sha256') -> str:
     '''Dump the dictionary object as json and sign it using hmac.'''
-    signer = TimeStampedHMACSigner(key=key)
-    decoded_message = b64decode(signer.verify(message, max_age).encode('utf8')).decode('utf8')
-    return json.loads(decoded_message)
+    return get_signer(key, old_keys, digest).sign(json.dumps(obj, separators=(',', ':')).encode('utf8'))
+
+
+def hmac_json_loads(message: str, key: str, max_age: int = None, old_keys: typing.Sequence[str] = (),
+                    digest: str = 'sha256') -> dict:
+    '''Verify the signed message and return the json object.'''
+    obj, timestamp = hmac_json_loads_timestamped(message, key, old_keys, digest)
+    if max_age is not None and timestamp + max_age < time.time():
+        raise ExpiredSignature()
+    return obj
+
+
+def hmac_json_loads_timestamped(message: str, key: str, old_keys: typing.Sequence[str] = (),
+                                digest: str = 'sha256') -> typing.Tuple[dict, int]:
+    '''
+    Verify the signed message and return the json object and the timestamp it was signed at.
+
+    Messages in the legacy `base64 json:base64 timestamp:base64 signature` format, signed with SHA-1, are still
+    accepted, so existing session cookies stay valid until they are signed again.
+    '''
+    if ':' not in message:
+        payload, timestamp = get_signer(key, old_keys, digest).unsign_timestamped(message)
+        return json.loads(payload.decode('utf8')), timestamp
+
+    for legacy_key in (key, *old_keys):
+        try:
+            signed_data, timestamp = TimeStampedHMACSigner(key=legacy_key).verify_timestamped(message)
+        except (BadSignature, ValueError):
+            continue
+        return json.loads(b64decode(signed_data.encode('utf8')).decode('utf8')), timestamp
+    raise BadSignature('Signature is not valid')
@@ -1,3 +1,8 @@
+import collections
+import threading
+import typing
+
+
 class CaseInsensitiveDict(dict):
     _init_mod = True
 
@@ -38,3 +43,46 @@ class CaseInsensitiveDict(dict):
         for key in self.keys():
             value = self.pop(key)
             self.__setitem__(key.lower(), value)
+
+
+class LRUCache:
+    '''
+    A mapping that keeps at most `maxsize` items and evicts the least recently used one. It is safe to use from
+    multiple threads.
+    '''
+
+    def __init__(self, maxsize: int = 1024) -> None:
+        self.maxsize = maxsize
+        self._items: typing.MutableMapping = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._items.move_to_end(key)
+            except KeyError:
+                return default
+            return self._items[key]
+
+    def __setitem__(self, key, value) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._items.pop(key, default)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __contains__(self, key) -> bool:
+        return key in self._items
@@ -9,7 +9,8 @@ ASGIMessage = typing.Dict[str, typing.Any]
 ASGIReceive = typing.Callable[[], typing.Awaitable[ASGIMessage]]
 ASGISend = typing.Callable[[ASGIMessage], typing.Awaitable[None]]
 ASGIAppInstance = typing.Callable[[ASGIReceive, ASGISend], typing.Awaitable[None]]
-ASGIApp = typing.Callable[[ASGIScope], ASGIAppInstance]
+ASGIApp = typing.Callable[[ASGIScope, ASGIReceive, ASGISend], typing.Awaitable[None]]
+ASGI2App = typing.Callable[[ASGIScope], ASGIAppInstance]
 ASGIHeaders = typing.List[typing.Tuple[bytes, bytes]]
 HTTPResponse = typing.Any
 
@@ -17,3 +18,4 @@ HTTPView = typing.Callable[[typing.Any], typing.Awaitable[HTTPResponse]]
 ErrorHandler = typing.Callable[[typing.Any, Exception], typing.Awaitable[HTTPResponse]]
 HTTPMiddleware = typing.Callable[[typing.Any, typing.Any], typing.Awaitable[HTTPResponse]]
 RequestMethods = typing.Iterable[str]
+Hook = typing.Callable[..., None]
@@ -1,5 +1,8 @@
+import sys
+
 import uvicorn
 
+from bluepark.accesslog import access_log_middleware, DEFAULT_TEXT_FORMAT
 from bluepark.app import BluePark
 from bluepark.response import JSONResponse, TextResponse
 from bluepark.routing import Router
@@ -15,17 +18,10 @@ app.add_router(user_router)
 app.add_router(blue_router)
 
 
-async def middleware_logger(request, next_middleware):
-    print(f'New request for: {request.method} - {request.path}')
-    response = await next_middleware()
-    print('Request ends')
-    return response
-
-
 # Middleware are called in order before calling the view function
 # Every middleware must await for next_middleware
 # At the end, next_middleware will reach the view function.
-app.add_http_middleware(middleware_logger)
+access_log_middleware(sys.stdout, log_format=DEFAULT_TEXT_FORMAT).install(app)
 app.add_http_middleware(session_middleware(backend=CookieSession))
 
 
@@ -60,7 +56,7 @@ async def user_list_view(request, id):
 
 
 @blue_router.route('/users/<int:id>/dragons/<str:name>/', methods=['GET', 'POST'])
-async def user_list_view(request, id, name):
+async def user_dragon_view(request, id, name):
     return TextResponse(f'User {id} and dragon {name}')
 
 